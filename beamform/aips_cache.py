@@ -0,0 +1,391 @@
+"""
+Compile AIPS calibration tables into a binary cache.
+
+Parsing the FRING, selfcal and bandpass text tables exported from AIPS
+takes seconds, and every beamforming job used to do it again. This
+module parses them once into a ``.npy`` file holding the per-antenna,
+per-polarisation solutions along with a hash of the tables' contents.
+Beamforming jobs memory-map the cache instead, and fall back to parsing
+the tables if the hash shows the cache was made from different tables.
+:class:`AipsGainSolutions` turns the solutions into the calibration the
+beamformer applies to each antenna.
+
+Usage (from the directory holding the AIPS tables and their README):
+    python aips_cache.py -b bandpass.bp.txt -o aips_solns.npy
+"""
+import glob
+import hashlib
+import os
+import sys
+import tempfile
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+
+import numpy as np
+from scipy.interpolate import interp1d
+
+from parse_aips import aipscor
+
+# bump if the contents of the cache change
+CACHE_VERSION = 2
+POLS = "xy"
+NANT = 36
+
+# antenna name to index mapping
+ant_map = {}
+for i in range(NANT):
+    ant_map[f"ak{i+1:02d}"] = i
+
+
+def _main():
+    args = get_args()
+    fring_f, sc_f = find_tables()
+    compile_solutions(fring_f, sc_f, args.b, outfile=args.o)
+
+
+def get_args():
+    parser = ArgumentParser(
+        description="Compile AIPS calibration tables into a binary cache",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-b", help="AIPS bandpass table (.bp.txt)")
+    parser.add_argument(
+        "-o", help="Output cache file", default="aips_solns.npy"
+    )
+    return parser.parse_args()
+
+
+def find_tables():
+    """Get the FRING and selfcal table filenames from the AIPS README
+
+    :return: FRING delays and selfcal table filenames
+    :rtype: tuple(str, str)
+    """
+    fring_f = None
+    sc_f = None
+    readme = glob.glob("README*")
+    if len(readme) == 1:
+        with open(readme[0]) as fl:
+            for line in fl:
+                if "delays" in line and ".sn.txt" in line:
+                    fring_f = line.split()[0]
+                if "selfcal" in line and ".sn.txt" in line:
+                    sc_f = line.split()[0]
+                    print(f"FOUND SELFCAL FILE: {sc_f}")
+    else:
+        print("No or multiple readme file exists for AIPS")
+        sys.exit(1)
+
+    return fring_f, sc_f
+
+
+def tables_hash(fring_f, sc_f, bp_f):
+    """Hash the contents of the AIPS tables
+
+    Only the contents are hashed, so the same tables extracted to a
+    different directory give the same hash.
+
+    :return: Hex digest of the tables' contents
+    :rtype: str
+    """
+    h = hashlib.sha256(f"aips_cache v{CACHE_VERSION}".encode())
+    for fname in (fring_f, sc_f, bp_f):
+        with open(fname, "rb") as fl:
+            content = fl.read()
+        h.update(len(content).to_bytes(8, "little"))
+        h.update(content)
+    return h.hexdigest()
+
+
+def compile_solutions(
+    fring_f, sc_f, bp_f, ants=range(NANT), pols=POLS, outfile=None
+):
+    """Parse AIPS tables into arrays of solutions.
+
+    Antennas missing from the tables are left as NaN in the bandpass and
+    delay, and have a gain of 0, as in
+    :class:`AipsGainSolutions`.
+
+    :param fring_f: FRING delays table (.sn.txt)
+    :type fring_f: str
+    :param sc_f: Selfcal table (.sn.txt)
+    :type sc_f: str
+    :param bp_f: Bandpass table (.bp.txt)
+    :type bp_f: str
+    :param ants: Zero-based indices of the antennas to parse
+    :type ants: iterable of int, optional
+    :param pols: Polarisations to parse
+    :type pols: str, optional
+    :param outfile: If given, the cache file to write the solutions to.
+        Only do this when parsing all antennas and polarisations.
+    :type outfile: str, optional
+    :return: Solutions with keys ``bandpass`` (npol, nant, nfreq),
+        ``delay_fring`` (npol, nant) in seconds, ``gain`` (npol, nant)
+        (inverse FRING x selfcal gain) and ``hash``
+    :rtype: dict
+    """
+    print("Parsing AIPS tables")
+    nfreq = None
+    with open(bp_f) as fl:
+        for line in fl:
+            if "TFDIM11" in line:
+                nfreq = int(line.split()[2])
+
+    aips_cor = aipscor(fring_f, sc_f, bp_f)
+
+    bandpass = np.full((len(POLS), NANT, nfreq), np.nan, dtype=np.complex128)
+    delay_fring = np.full((len(POLS), NANT), np.nan)
+    gain = np.zeros((len(POLS), NANT), dtype=np.complex128)
+
+    for pol in pols:
+        ip = POLS.index(pol)
+        for iant in ants:
+            print(f"Loading antenna {iant} pol {pol}")
+            bandpass[ip, iant] = aips_cor.get_phase_bandpass(iant, pol)
+            delay_fring[ip, iant] = aips_cor.get_delay_fring(iant, pol)
+            try:
+                g = aips_cor.get_phase_fring(
+                    iant, pol
+                ) * aips_cor.get_phase_selfcal(iant, pol)
+                gain[ip, iant] = 1 / g  # inverse of gain
+            except Exception as e:
+                print(e)
+
+    sols = {
+        "bandpass": bandpass,
+        "delay_fring": delay_fring,
+        "gain": gain,
+        "hash": tables_hash(fring_f, sc_f, bp_f),
+    }
+
+    if outfile is not None:
+        save_solutions(sols, outfile)
+
+    return sols
+
+
+def save_solutions(sols, fname):
+    """Write solutions to a cache file
+
+    The solutions are stored as a single uncompressed structured record so
+    :func:`load_solutions` can memory-map them. They are written to a
+    temporary file and renamed, so concurrent jobs never see a partial
+    file.
+
+    :param sols: Solutions as returned by :func:`compile_solutions`
+    :type sols: dict
+    :param fname: Cache file to write
+    :type fname: str
+    """
+    dtype = [
+        (k, sols[k].dtype, sols[k].shape)
+        for k in ("bandpass", "delay_fring", "gain")
+    ]
+    rec = np.zeros((), dtype=dtype + [("hash", "U64")])
+    for k in rec.dtype.names:
+        rec[k] = sols[k]
+
+    print(f"Saving AIPS solutions cache to {fname}")
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(fname)), suffix=".npy"
+    )
+    try:
+        with os.fdopen(fd, "wb") as fl:
+            np.save(fl, rec)
+        os.replace(tmp, fname)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def load_solutions(fname, fring_f, sc_f, bp_f):
+    """Load cached solutions, checking they match the given tables
+
+    :param fname: Cache file written by :func:`compile_solutions`
+    :type fname: str
+    :return: Solutions as returned by :func:`compile_solutions`, or None
+        if the cache does not exist or was made from different tables
+    :rtype: dict or None
+    """
+    if not os.path.exists(fname):
+        return None
+
+    rec = np.load(fname, mmap_mode="r")
+    sols = {k: rec[k] for k in rec.dtype.names}
+
+    if str(sols["hash"]) != tables_hash(fring_f, sc_f, bp_f):
+        print(f"WARNING: {fname} does not match AIPS tables, ignoring it")
+        return None
+
+    print(f"Loaded AIPS solutions from {fname}")
+    return sols
+
+
+class AipsGainSolutions:
+    # FIXME: Should provide the three file names separately, and selfcal should be optional
+    def __init__(
+        self, ants, values, bp_c_root=None, pol=None, freqs=None
+    ):
+        """Loads AIPS exported bandpass, delay, and gain selfcal solutions.
+        Expects 3 files whose root matches that of the bp file given
+
+        """
+        print("Using AIPS bandpass solutions")
+
+        # look for a README and get fring, selfcal filenames
+        fring_f, sc_f = find_tables()
+
+        if values.an == None:
+            # beamforming all antennas in this process
+            loadantennas = [ant_map[ant.antname] for ant in ants]
+        else:
+            antname = ants[values.an].antname
+            iant = ant_map[antname]
+            loadantennas = [iant]
+
+        # Use the compiled solutions if they were made from these tables,
+        # otherwise parse the tables (and write the cache if one was asked
+        # for but doesn't exist yet)
+        aips_cache = getattr(values, "aips_cache", None)
+        sols = None
+        if aips_cache is not None:
+            sols = load_solutions(aips_cache, fring_f, sc_f, bp_c_root)
+            if sols is None and not os.path.exists(aips_cache):
+                sols = compile_solutions(
+                    fring_f, sc_f, bp_c_root, outfile=aips_cache
+                )
+        if sols is None:
+            sols = compile_solutions(
+                fring_f, sc_f, bp_c_root, ants=loadantennas, pols=pol
+            )
+        ipol = POLS.index(pol)
+
+        nfreq = sols["bandpass"].shape[-1]
+        fmax = freqs[0] + 0.5  # in MHz
+        bw = len(freqs)  # in MHz
+        self.freqs = (
+            -np.arange(float(nfreq)) / nfreq * bw
+            + fmax
+            - float(bw) / nfreq / 2
+        ) / 1e3  # reassign freqs in GHz
+        self.bp_real = np.full(
+            (nfreq, 36), np.nan, dtype=np.complex64
+        )
+        self.bp_imag = np.full(
+            (nfreq, 36), np.nan, dtype=np.complex64
+        )
+        g_real = np.full((1, 36), np.nan, dtype=np.complex64)
+        g_imag = np.full((1, 36), np.nan, dtype=np.complex64)
+
+        for iant in loadantennas:
+            print(f"Loading antenna {iant} from {loadantennas}")
+            bp = sols["bandpass"][ipol, iant].copy()
+            bp = np.fliplr([bp])[0]  # decreasing order
+
+            # fring delay
+            delta_t_fring_ns = sols["delay_fring"][ipol, iant] * 1e9
+            phases = delta_t_fring_ns * self.freqs
+            phases -= phases[
+                int(len(phases) / 2)
+            ]  # TODO! READ THE REFERENCE FREQUENCY AND SET TO THAT REFERENCE
+
+            bp *= np.exp(np.pi * 2j * phases, dtype=np.complex64)
+
+            g = sols["gain"][ipol, iant]
+            bp = np.conj(bp)
+            self.bp_real[:, iant] = np.real(bp)
+            self.bp_imag[:, iant] = np.imag(bp)
+            g_real[0, iant] = np.real(g)
+            g_imag[0, iant] = np.imag(g)
+        print("Finished loading bandpasses")
+
+        self.bp_real_interp = [
+            interp1d(
+                self.freqs,
+                self.bp_real[:, iant],
+                fill_value=(
+                    self.bp_real[0, iant],
+                    self.bp_real[-1, iant],
+                ),
+                bounds_error=False,
+            )
+            for iant in range(36)
+        ]
+        self.bp_imag_interp = [
+            interp1d(
+                self.freqs,
+                self.bp_imag[:, iant],
+                fill_value=(
+                    self.bp_imag[0, iant],
+                    self.bp_imag[-1, iant],
+                ),
+                bounds_error=False,
+            )
+            for iant in range(36)
+        ]
+        self.bp_coeff = None
+
+        # Complex bandpasses on an increasing frequency grid, for
+        # get_solution_vector
+        self.freqs_sorted = self.freqs[::-1]
+        self.bp_sorted = np.ascontiguousarray(
+            (self.bp_real.real + 1j * self.bp_imag.real)[::-1].T,
+            dtype=np.complex128,
+        )
+
+        self.g_real = g_real
+        self.g_imag = g_imag
+        print("Finished AIPS solutions init")
+
+    def get_solution(self, iant, time, freq_ghz):
+        """
+        Get solution including time and bandpass
+        iant - antenna index (zero-based from the full array of 36 antennas, not the subset for this observation)
+        time - some version of time. Ignored for now
+        freq_ghz - frequency float in Ghz
+        """
+        if self.bp_real is None:
+            # no bandpass/gain solution was passed
+            bp_value = np.array([1])
+        elif self.bp_coeff is not None:  # Use AIPS polyfit coefficient
+            bp_fit = np.poly1d(self.bp_coeff[iant, 0, :]) + 1j * np.poly1d(
+                self.bp_coeff[iant, 1, :]
+            )
+            bp_value = bp_fit(freq_ghz * 1e3)
+        else:
+            # AIPS polyfit coefficient doesn't exist. Use Miriad/AIPS
+            # bandpass interpolation
+            f_real = self.bp_real_interp[iant](freq_ghz)
+            f_imag = self.bp_imag_interp[iant](freq_ghz)
+            bp_value = f_real + 1j * f_imag
+
+        g_value = self.g_real[0, iant] + 1j * self.g_imag[0, iant]
+        total_value = bp_value * g_value
+
+        return total_value
+
+    def get_solution_vector(self, iant, freq_ghz):
+        """
+        Vectorised get_solution for the bandpass interpolation, evaluating
+        the solutions at every fine channel in one np.interp call rather
+        than through the interp1d objects
+        iant - antenna index (zero-based from the full array of 36 antennas, not the subset for this observation)
+        freq_ghz - array of frequencies in GHz, of any shape
+        """
+        if self.bp_real is None or self.bp_coeff is not None:
+            return self.get_solution(iant, 0, freq_ghz)
+
+        # NOTE: the edge values match the interp1d fill_value above, which
+        # extrapolates with the highest-frequency solution below the band
+        # and the lowest-frequency solution above it
+        bp = self.bp_sorted[iant]
+        bp_value = np.interp(
+            freq_ghz, self.freqs_sorted, bp, left=bp[-1], right=bp[0]
+        )
+
+        g_value = self.g_real[0, iant] + 1j * self.g_imag[0, iant]
+
+        return bp_value * g_value
+
+
+if __name__ == "__main__":
+    _main()
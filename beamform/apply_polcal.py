@@ -55,6 +55,8 @@ def get_args():
 
     ## additional arguments
     parser.add_argument("--fast", help = "Apply zero-padding to fasten fft", action = "store_true")
+    parser.add_argument("--no_delay", help = "Don't apply the X delay and phase solutions, e.g. because they "
+                        "were folded into beamforming (craftcor_tab.py --fold_polcal)", action = "store_true")
 
     args = parser.parse_args()
 
@@ -90,9 +92,35 @@ def load_data(args):
     Y = np.load(args.y, mmap_mode = 'r')
 
     # load in polcal solutions
+    par = load_soln(args.soln)
+    
+
+    return X, Y, par
+
+
+
+
+
+
+
+
+
+
+def load_soln(fname):
+    """
+    Load pol cal solutions
+
+    #== inputs ==#
+    fname:          Pol cal solutions file
+
+    #== outputs ==#
+    par:            Pol cal solutions
+
+    """
+
     par = empty_class()
 
-    with open(args.soln, 'r') as f:
+    with open(fname, 'r') as f:
         par.psi = float(f.readline().split(':')[1])        # rotation offsert
         par.rm = float(f.readline().split(':')[1])         # rotation measure
         par.tau = float(f.readline().split(':')[1])        # time delay
@@ -101,9 +129,42 @@ def load_data(args):
         par.Vfrac = float(f.readline().split(':')[1])      # Circular fraction free parameter
         par.alpha = float(f.readline().split(':')[1])      # ellipticity angle
         par.ellipticity = int(f.readline().split(':')[1])   # boolean, if ellipticity was modelled or not
-    
 
-    return X, Y, par
+    return par
+
+
+
+
+
+
+
+
+
+
+def delay_phases(par, fmin, fmax, nchan, i0 = 0, i1 = None):
+    """
+    Phases applied to the X polarisation spectrum to correct the delay and
+    phase offset between X and Y. Channel 0 is at fmax and channel nchan-1
+    at fmin, i.e. the same order as the fine spectrum.
+
+    #== inputs ==#
+    par:            polcal solutions
+    fmin:           Frequency of the last channel [MHz]
+    fmax:           Frequency of the first channel [MHz]
+    nchan:          Number of channels in the spectrum
+    i0:             First channel to return
+    i1:             Channel to stop at, defaults to nchan
+
+    #== outputs ==#
+    phases:         Complex phases of channels i0 to i1
+
+    """
+    if i1 is None:
+        i1 = nchan
+
+    f_fine = fmax - np.arange(i0, i1) * ((fmax - fmin) / (nchan - 1))
+
+    return np.exp(-2j * np.pi * f_fine * par.tau - par.phi * 1j)
 
 
 
@@ -131,26 +192,27 @@ def apply_soln(args, X, Y, par):
     """
     print("[APPLY POLCAL]: Applying Polarisation leakage solutions...")
 
-    ## Apply pol leakage solutions via Fourier Transform
-    # FFT
-    next_size = X.size
-    if args.fast:
-        next_size = next_fast_len(next_size)
-        print(f"Zero-padding to speed up FFT: {X.size} -> {next_size}")
-        print("Note: the more relative zero padding, the less accurate the results...")
-    
-    X_cal = fft(X, next_size)
-
-    # apply rotation
-    f_fine = np.linspace(args.cfreq - args.bw/2, args.cfreq + args.bw/2*(next_size/X.size), 
-                         next_size)[::-1]
-    X_cal *= np.exp(-2j * np.pi * f_fine * par.tau - par.phi * 1j)
-
-    # iFFT
-    X_cal = ifft(X_cal, next_size)[:X.size]
-
-    # free up memory
-    f_fine = None
+    if args.no_delay:
+        print("[APPLY POLCAL]: Delay and phase already applied, skipping...")
+        X_cal = X
+
+    else:
+        ## Apply pol leakage solutions via Fourier Transform
+        # FFT
+        next_size = X.size
+        if args.fast:
+            next_size = next_fast_len(next_size)
+            print(f"Zero-padding to speed up FFT: {X.size} -> {next_size}")
+            print("Note: the more relative zero padding, the less accurate the results...")
+        
+        X_cal = fft(X, next_size)
+
+        # apply rotation
+        X_cal *= delay_phases(par, args.cfreq - args.bw/2,
+                              args.cfreq + args.bw/2*(next_size/X.size), next_size)
+
+        # iFFT
+        X_cal = ifft(X_cal, next_size)[:X.size]
 
 
     
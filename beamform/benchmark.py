@@ -0,0 +1,350 @@
+"""
+End-to-end throughput benchmark of the beamforming stages on synthetic
+data.
+
+Writes (or reuses) a data set from :mod:`synth_data`, then runs the
+stages of the beamform pipeline on it in one process:
+
+1. per antenna: read the crop, fringe rotate, fine channelise and
+   calibrate (:class:`tab_engine.TabEngine` with
+   :class:`aips_cache.AipsGainSolutions`), and save the fine spectrum
+2. sum the antennas (:func:`sum.do_sum`)
+3. make the deripple coefficients and deripple
+   (:func:`deripple.deripple`)
+4. coherently dedisperse (:func:`dedisperse.dedisperse_blocks`)
+5. inverse FFT (:func:`ifft.do_ifft`)
+
+With ``--fold``, derippling and dedispersion are folded into the first
+stage (:class:`fold_gains.FoldedGains`, as ``craftcor_tab.py --fold_*``)
+and stages 3 and 4 are skipped.
+
+Every stage is timed with :func:`stage_metrics.stage`, so ``--metrics``
+or ``CELEBI_METRICS`` records it alongside the production jobs, and a
+summary table is printed at the end along with the S/N of the recovered
+burst. A drop in S/N means a stage has broken the data, a rise in a
+stage's time or memory means it has regressed.
+
+The first stage is not ``craftcor_tab.py`` itself:
+``AntennaSource.do_f_tab`` reads through ``vcraft``, whose packing the
+synthetic files do not claim to follow, and the delay model needs
+``calc11``. It drives the reader, engine and calibration classes that
+``do_f_tab`` uses instead, so the delay model, cropping and checkpointing
+of ``do_f_tab`` are not measured. The delays are zero, so the fringe
+rotation is still done but rotates by zero.
+
+Usage:
+    python benchmark.py --workdir /tmp/celebi_bench --metrics bench.jsonl
+"""
+import functools
+import os
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser, Namespace
+from contextlib import contextmanager
+
+import numpy as np
+
+import deripple_cache
+import synth_data
+from aips_cache import AipsGainSolutions
+from dedisperse import dedisperse_blocks
+from deripple import deripple
+from fold_gains import FoldedGains, filter_deripple_gains
+from fringe import FringeRotator
+from ifft import do_ifft
+from stage_metrics import configure as configure_metrics, stage
+from sum import do_sum, do_weighted_sum, find_files
+from tab_engine import TabEngine
+from voltage_reader import CardReader
+
+FILTER_FNAME = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    ".deripple_coeffs",
+    "ADE_R6_OSFIR.mat",
+)
+
+LABEL = "synth_frb"
+
+
+def _main():
+    args = get_args()
+    configure_metrics(args.metrics, job="benchmark")
+    run(args)
+
+
+def get_args():
+    parser = ArgumentParser(
+        description="Benchmark the beamforming stages on synthetic data",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    synth_data.add_dataset_args(parser)
+    parser.add_argument(
+        "--workdir",
+        default="celebi_bench",
+        help="Directory for the synthetic data and intermediate files",
+    )
+    parser.add_argument(
+        "--reuse",
+        action="store_true",
+        help="Reuse the synthetic data already in workdir",
+    )
+    parser.add_argument(
+        "--cpus", type=int, default=1, help="Number of threads for the FFTs"
+    )
+    parser.add_argument(
+        "--fft_batch",
+        type=int,
+        default=8,
+        help="Number of coarse channels fine channelised at once",
+    )
+    parser.add_argument(
+        "--read_workers",
+        type=int,
+        default=0,
+        help="Read the vcraft files of each antenna this many at a time, "
+        "ahead of the FFTs. With 0, each antenna's crop is read in one go.",
+    )
+    parser.add_argument(
+        "--weighted_sum",
+        action="store_true",
+        help="Weight the antennas by their inverse noise when summing",
+    )
+    parser.add_argument(
+        "--fold",
+        action="store_true",
+        help="Deripple and dedisperse during beamforming rather than after "
+        "summing",
+    )
+    parser.add_argument(
+        "--filter",
+        default=FILTER_FNAME,
+        help="PFB filter used to make the deripple coefficients",
+    )
+    parser.add_argument(
+        "--metrics", help="JSON lines file to append stage metrics to"
+    )
+    return parser.parse_args()
+
+
+def run(args):
+    """Run the benchmark
+
+    :param args: Command line arguments
+    :type args: :class:`argparse.Namespace`
+    :return: Stage metric records
+    :rtype: list[dict]
+    """
+    records = []
+
+    @contextmanager
+    def timed(name, **info):
+        with stage(name, **info) as record:
+            yield record
+        records.append(record)
+
+    workdir = args.workdir
+    if args.reuse and os.path.exists(os.path.join(workdir, "synth.npz")):
+        print(f"Reusing synthetic data in {workdir}")
+        info = synth_data.load_info(workdir)
+    else:
+        with timed("generate", nant=args.nant, nsamp=args.nsamp):
+            info = synth_data.write_dataset(
+                workdir,
+                nant=args.nant,
+                nchan=args.nchan,
+                chan_per_card=args.chan_per_card,
+                nsamp=args.nsamp,
+                nbits=args.nbits,
+                fmax=args.fmax,
+                DM=args.DM,
+                pulse_time=args.pulse_time,
+                width_us=args.width_us,
+                amp=args.amp,
+                pols=args.pols,
+                seed=args.seed,
+            )
+
+    nant = int(info["nant"])
+    nchan = int(info["nchan"])
+    nsamp = int(info["nsamp"])
+    freqs = np.asarray(info["freqs"])
+    DM = float(info["DM"])
+    pol = str(info["pols"])[0]
+    nfine = 27 * nsamp // 32
+    nguard = 5 * nsamp // 64
+    ants = [synth_data.ant_name(i) for i in range(nant)]
+
+    # AipsGainSolutions finds the tables from the README in the working
+    # directory, as in the beamform jobs
+    cwd = os.getcwd()
+    os.chdir(os.path.join(workdir, "aips"))
+    try:
+        with timed("calibration_load", nant=nant):
+            aips = AipsGainSolutions(
+                [Namespace(antname=ant) for ant in ants],
+                Namespace(an=None, aips_cache=None),
+                "synth.bandpass.bp.txt",
+                pol,
+                freqs,
+            )
+    finally:
+        os.chdir(cwd)
+
+    # fine channel frequency offsets, running the same way as in do_f_tab
+    fine_freqs = -(np.arange(nfine, dtype=float) - nfine / 2) / nfine
+
+    gains = None
+    if args.fold:
+        gains = FoldedGains(
+            nchan,
+            nfine,
+            deripple=filter_deripple_gains(args.filter, nsamp, nfine),
+            DM=DM,
+            f0=freqs.mean(),
+        )
+
+    for iant, ant in enumerate(ants):
+        vfile = synth_data.SyntheticMux.open(workdir, ant, pol)
+        fringe = FringeRotator.from_delays(freqs, np.zeros(nsamp))
+        engine = TabEngine(
+            fringe,
+            nguard,
+            fine_freqs,
+            1,
+            functools.partial(aips.get_solution_vector, iant),
+            workers=args.cpus,
+            batch=args.fft_batch,
+            gain=gains,
+        )
+        out = np.zeros((1, nchan * nfine, 1), dtype=np.complex64)
+
+        if args.read_workers > 0:
+            # the files are read during the fft stage, ahead of the FFTs
+            groups = CardReader(
+                vfile, 0, nsamp, workers=args.read_workers,
+                timer=lambda **kw: timed("vfile.read", ant=ant, **kw),
+            )
+        else:
+            with timed("vfile.read", ant=ant, nsamp=nsamp):
+                rawd = vfile.read(0, nsamp)
+            groups = (
+                (c0, rawd[:, c0:c0 + args.fft_batch].T)
+                for c0 in range(0, nchan, args.fft_batch)
+            )
+        with timed("fft", ant=ant, nsamp=nsamp):
+            for c0, block in groups:
+                engine.process(c0, block, out[0, :, 0])
+        del groups, vfile
+
+        with timed("save", ant=ant):
+            np.save(
+                os.path.join(workdir, f"{LABEL}_{ant}_{pol}_f_filtered.npy"),
+                out,
+            )
+        del out
+
+    fnames = sorted(find_files(workdir, LABEL, pol))
+    with timed("sum", nfiles=len(fnames), weighted=args.weighted_sum):
+        if args.weighted_sum:
+            summed, _ = do_weighted_sum(fnames, nchan, cpus=args.cpus)
+        else:
+            summed = do_sum(fnames, cpus=args.cpus)
+
+    if args.fold:
+        spec = summed[0, :, 0]
+    else:
+        with timed("deripple_coeffs", nfft=nsamp):
+            coeffs_fname = os.path.join(workdir, f"deripple_nfft{nsamp}.npy")
+            np.save(
+                coeffs_fname,
+                deripple_cache.get_coeffs(
+                    args.filter, nsamp, cache_dir=os.path.join(workdir, "cache")
+                ),
+            )
+        with timed("deripple", nchan=summed.size):
+            spec = deripple(summed, coeffs_fname, nsamp, nchan, args.cpus)
+
+        with timed("dedisperse", nchan=spec.size):
+            spec = dedisperse_blocks(spec, DM, freqs.mean(), nchan, out=spec)
+    del summed
+
+    with timed("ifft", nchan=spec.size):
+        t = do_ifft(spec)
+    del spec
+
+    snr, peak_us = burst_snr(t, nchan, float(info["width_us"]))
+    expected_us = float(info["pulse_time"]) * nfine
+
+    print_summary(records, nant * nchan * nsamp)
+    print(
+        f"Burst S/N {snr:.1f} at {peak_us:.1f} us "
+        f"(injected at {expected_us:.1f} us)"
+    )
+    return records
+
+
+def burst_snr(t, nchan, width_us):
+    """S/N of the brightest burst in a time series
+
+    The power is summed in boxcars of the burst's width, and the S/N is
+    that of the brightest boxcar relative to the mean and standard
+    deviation of the others.
+
+    :param t: Complex time series at 1 / nchan us resolution
+    :type t: :class:`np.ndarray`
+    :param nchan: Bandwidth in MHz
+    :type nchan: int
+    :param width_us: Width of the burst in us
+    :type width_us: float
+    :return: S/N and time of the brightest boxcar in us
+    :rtype: tuple(float, float)
+    """
+    box = max(1, int(2 * width_us * nchan))
+    nbox = t.size // box
+    power = (np.abs(t[:nbox * box]) ** 2).reshape(nbox, box).sum(axis=1)
+    peak = int(np.argmax(power))
+    off = np.ones(nbox, dtype=bool)
+    off[max(0, peak - 3):peak + 4] = False
+    snr = (power[peak] - power[off].mean()) / power[off].std()
+    return snr, (peak + 0.5) * box / nchan
+
+
+def print_summary(records, nvalues):
+    """Print the stage metrics, totalled over antennas
+
+    :param records: Stage metric records
+    :type records: list[dict]
+    :param nvalues: Number of complex voltages beamformed, for the
+        throughput of the read and FFT stages
+    :type nvalues: int
+    """
+    totals = {}
+    for r in records:
+        t = totals.setdefault(
+            r["stage"], {"n": 0, "wall_s": 0.0, "cpu_s": 0.0, "io_mb": 0.0}
+        )
+        t["n"] += 1
+        t["wall_s"] += r["wall_s"]
+        t["cpu_s"] += r["cpu_s"]
+        t["peak_rss_mb"] = r["peak_rss_mb"]
+        t["io_mb"] += ((r["rchar"] or 0) + (r["wchar"] or 0)) / 2**20
+
+    print()
+    print(
+        f"{'stage':<18}{'calls':>6}{'wall s':>10}{'cpu s':>10}"
+        f"{'peak RSS MB':>13}{'I/O MB':>10}{'Msamp/s':>10}"
+    )
+    for name, t in totals.items():
+        rate = ""
+        if name in ("vfile.read", "fft") and t["wall_s"] > 0:
+            rate = f"{nvalues / t['wall_s'] / 1e6:.1f}"
+        print(
+            f"{name:<18}{t['n']:>6}{t['wall_s']:>10.3f}{t['cpu_s']:>10.3f}"
+            f"{t['peak_rss_mb']:>13.0f}{t['io_mb']:>10.1f}{rate:>10}"
+        )
+    # reads in the background overlap the stage they were done in
+    total = sum(r["wall_s"] for r in records if not r.get("background"))
+    print(f"{'total':<18}{'':>6}{total:>10.3f}")
+    print()
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,97 @@
+"""
+Checkpointing of beamformed spectra written into memory-mapped outputs.
+
+As each group of coarse channels is finished, the outputs are flushed to
+disk and the group is appended to a progress file next to the first
+output. If the job is restarted with the same crop, the outputs are
+reopened and the finished channels are skipped.
+
+Markers are only written after the data they cover has been flushed, so
+a marked channel is always complete on disk. The progress file starts
+with a key describing the crop; if the key differs on restart (e.g. a
+different crop or FFT length) the old progress is discarded.
+"""
+import os
+
+import numpy as np
+
+
+def progress_fname(fname):
+    """Progress file kept alongside an output file"""
+    return fname + ".progress"
+
+
+class Checkpoint:
+    """Per-channel progress of a set of memory-mapped outputs.
+
+    :param fname: Progress file
+    :type fname: str
+    :param key: Description of the crop, e.g. its sample offset, length
+        and number of fine channels. Progress made with a different key is
+        discarded.
+    :type key: str
+    :param nchan: Number of coarse channels
+    :type nchan: int
+    """
+
+    def __init__(self, fname, key, nchan):
+        self.fname = fname
+        self.key = key
+        self.done = np.zeros(nchan, dtype=bool)
+
+        if os.path.exists(fname):
+            with open(fname) as f:
+                lines = f.read().splitlines()
+            if lines and lines[0] == key:
+                for line in lines[1:]:
+                    try:
+                        c0, c1 = map(int, line.split())
+                    except ValueError:
+                        # partly written marker from a job that died
+                        continue
+                    self.done[c0:c1] = True
+                print(
+                    f"Resuming from {fname}: {self.done.sum()}/{nchan} "
+                    "coarse channels already done"
+                )
+            else:
+                print(f"Ignoring {fname}: made for a different crop")
+
+        # rewrite the progress file so it ends cleanly before appending
+        with open(fname, "w") as f:
+            f.write(key + "\n")
+            for c in np.flatnonzero(self.done):
+                f.write(f"{c} {c + 1}\n")
+
+    @property
+    def resumed(self):
+        """Whether any channels were done before this run"""
+        return self.done.any()
+
+    @property
+    def complete(self):
+        return self.done.all()
+
+    def is_done(self, c0, c1):
+        """Whether coarse channels c0 to c1 are all done"""
+        return self.done[c0:c1].all()
+
+    def mark(self, c0, c1, outputs):
+        """Flush the outputs, then mark coarse channels c0 to c1 done
+
+        :param outputs: Memory-mapped outputs the channels were written to
+        :type outputs: list of :class:`np.memmap`
+        """
+        for out in outputs:
+            out.flush()
+
+        with open(self.fname, "a") as f:
+            f.write(f"{c0} {c1}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.done[c0:c1] = True
+
+    def finish(self):
+        """Remove the progress file once every channel is done"""
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
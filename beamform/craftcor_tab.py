@@ -3,12 +3,17 @@ Tied-array beamforming vcraft files, based on "craftcor.py".
 
 Copyright (C) CSIRO 2017
 """
+import contextlib
+import copy
+import functools
 import glob
 import logging
 import os
 from re import X
+import shutil
 import signal
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 from timeit import default_timer as timer
 
@@ -17,15 +22,16 @@ import vcraft
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
 
 from calc11 import ResultsFile
-from joblib import Parallel, delayed, parallel_backend
-from scipy.interpolate import interp1d
-from parse_aips import aipscor
-from scipy.fft import next_fast_len
-
-# antenna name to index mapping
-ant_map = {}
-for i in range(36):
-    ant_map[f"ak{i+1:02d}"] = i
+from aips_cache import AipsGainSolutions, ant_map
+from voltage_reader import CardReader, ChannelBlockReader
+from checkpoint import Checkpoint, progress_fname
+from tab_engine import BeamOffset, TabEngine
+from fringe import FringeRotator
+from fftplan import DEFAULT_PRIMES, plan_fftlen
+from ics_engine import ics_dynspec
+from fold_gains import FoldedGains, filter_deripple_gains
+from apply_polcal import load_soln
+from stage_metrics import configure as configure_metrics, stage
 
 __author__ = ["Keith Bannister <keith.bannister@csiro.au>",
               "Danica Scott <danica.r.scott@postgrad.curtin.edu.au>"]
@@ -33,7 +39,7 @@ __author__ = ["Keith Bannister <keith.bannister@csiro.au>",
 
 
 
-def next_biggest_fftlen(nsamp, bw):
+def next_biggest_fftlen(nsamp, bw, primes=DEFAULT_PRIMES, max_pad=0.0):
     """
 
     NOTE: IMPORTANT!!!! - on the unlikely event that this breaks, i.e. the size of outputted data products for
@@ -41,12 +47,15 @@ def next_biggest_fftlen(nsamp, bw):
     truncate the buffer sizes to the smallest antenna buffer size in thw [sum.py] script that adds the antenna 
     together.
 
-    Very brute force approach, find the next largest length of samples within a single channel
-    that makes the full 336MHz buffer a 5-smooth number (optimised for FFT).
+    Find the next largest length of samples within a single channel that makes both the per-channel
+    FFT and the full 336MHz buffer smooth numbers (optimised for FFT). See fftplan.plan_fftlen.
 
     Parameters
     ----------
     nsamp : current number of samples
+    bw : bandwidth in MHz (number of coarse channels)
+    primes : primes the FFT lengths may be factorised over
+    max_pad : fraction the length may grow beyond the smallest valid length to reach a cheaper FFT
 
     Returns
     -------
@@ -55,30 +64,21 @@ def next_biggest_fftlen(nsamp, bw):
     guard_chan : truncated num of samples on 1 side
     """
 
-    while True:
-
-        # check if nsamp multiple of 64
-        if nsamp % 64 == 0:
-
-            # check if nfine x bw is a 5 smooth number
-            nfine = int(nsamp * 27/32)
-            if nfine*bw == next_fast_len(nfine*bw):
-                
-                return nsamp, nfine, int(5*nsamp//64)
-        
-        nsamp += 1
+    return plan_fftlen(nsamp, bw, primes=primes, max_pad=max_pad)
 
 
 
-def next_smallest_fftlen(nsamp, bw):
+def next_smallest_fftlen(nsamp, bw, primes=DEFAULT_PRIMES):
     """
 
-    Very brute force approach, find the next largest length of samples within a single channel
-    that makes the full 336MHz buffer a 5-smooth number (optimised for FFT).
+    Find the next smallest length of samples within a single channel that makes both the per-channel
+    FFT and the full 336MHz buffer smooth numbers (optimised for FFT). See fftplan.plan_fftlen.
 
     Parameters
     ----------
     nsamp : current number of samples
+    bw : bandwidth in MHz (number of coarse channels)
+    primes : primes the FFT lengths may be factorised over
 
     Returns
     -------
@@ -87,18 +87,69 @@ def next_smallest_fftlen(nsamp, bw):
     guard_chan : truncated num of samples on 1 side
     """
 
-    while True:
+    return plan_fftlen(nsamp, bw, primes=primes, larger=False)
 
-        # check if nsamp multiple of 64
-        if nsamp % 64 == 0:
 
-            # check if nfine x bw is a 5 smooth number
-            nfine = int(nsamp * 27/32)
-            if nfine*bw == next_fast_len(nfine*bw):
-                
-                return nsamp, nfine, int(5*nsamp//64)
-        
-        nsamp -= 1
+def npy_fname(fname):
+    """Filename np.save writes to, i.e. with ".npy" appended if missing"""
+    return fname if fname.endswith(".npy") else fname + ".npy"
+
+
+def new_output(shape, fname=None, resume=False):
+    """Make a zeroed complex64 output array.
+
+    If fname is given the array is a memory map of that .npy file (".npy"
+    is appended if missing, like np.save), so spectra are written straight
+    to disk and pages can be flushed while the rest is still being made.
+
+    Parameters
+    ----------
+    shape : shape of the output array
+    fname : output file to memory map, or None to allocate in memory
+    resume : reopen fname, keeping its contents, if it already holds an
+        array of this shape
+
+    Returns
+    -------
+    out : output array
+    """
+    if fname is None:
+        return np.zeros(shape, dtype=np.complex64)
+
+    fname = npy_fname(fname)
+    if resume and os.path.exists(fname):
+        arr = np.lib.format.open_memmap(fname, mode="r+")
+        if arr.shape == tuple(shape) and arr.dtype == np.complex64:
+            return arr
+        del arr
+
+    return np.lib.format.open_memmap(
+        fname, mode="w+", dtype=np.complex64, shape=shape
+    )
+
+
+def pol_outfile(fname, pol):
+    """Output filename for one polarisation when processing both.
+
+    Any "@" in fname is replaced by the polarisation, otherwise it is added
+    before the .npy extension.
+
+    Parameters
+    ----------
+    fname : output filename given on the command line
+    pol : polarisation, X or Y
+
+    Returns
+    -------
+    fname : output filename for this polarisation
+    """
+    if "@" in fname:
+        return fname.replace("@", pol)
+
+    root, ext = os.path.splitext(fname)
+    if ext != ".npy":
+        root, ext = fname, ""
+    return f"{root}_{pol}{ext}"
 
 
 def parse_snoopy(snoopy_file: str) -> "list[str]":
@@ -128,6 +179,7 @@ def parse_snoopy(snoopy_file: str) -> "list[str]":
 
 def _main():
     values = parse_args()
+    configure_metrics(values.metrics)
 
     if values.verbose:
         logging.basicConfig(level=logging.DEBUG)
@@ -137,8 +189,17 @@ def _main():
     # Start by getting the antenna list from the calc file
     calcresults = ResultsFile(values.calcfile)
 
+    # polarisations to process, XY does both in one pass
+    if values.pol in ("X", "Y"):
+        pols = [values.pol]
+    elif values.pol == "XY":
+        pols = ["X", "Y"]
+    else:
+        print(f"{values.pol} is not a valid polarisation! Must be X, Y or XY")
+        sys.exit(1)
+
     # get vcraft files from data directory
-    vcraftfiles = []
+    vcraftfiles = {pol: [] for pol in pols}
     for anname in calcresults.telnames:
         antennadir = values.data + '/' + anname
         if not os.path.exists(antennadir):
@@ -147,44 +208,57 @@ def _main():
 
         beamdirs = sorted(glob.glob(antennadir + "/*"))
         # FIXME: this doesn't take into account busted downloads when only one polarisation is present. More info should be provided upstream
-        if values.pol == "X":
-            vcraftfiles += sorted(glob.glob(beamdirs[0] + "/*[ac]*vcraft"))
-        elif values.pol == "Y":
-            vcraftfiles += sorted(glob.glob(beamdirs[1] + "/*[ac]*vcraft"))
-        else:
-            print(f"{values.pol} is not a valid polarisation! Must be x or y")
-            sys.exit(1)
+        for pol in pols:
+            beamdir = beamdirs["XY".index(pol)]
+            vcraftfiles[pol] += sorted(glob.glob(beamdir + "/*[ac]*vcraft"))
 
     start = timer()
     # FIXME: This should be replaced by robustifying the ResultsFile and getting the data from it, rather than using this separate parsing on the calc file
-    sources = load_sources(values.calcfile)
+    with stage("load_sources"):
+        sources = load_sources(values.calcfile)
     print(f"load_sources: {timer()-start} s")
 
     # hacking delays
     start = timer()
     # FIXME: I'm sure this is not robust against changing the antenna subset, but is only relevant for very old FRBs with hardware delays
-    delaymap = parse_delays(values)
-    antennas = [
-        AntennaSource(mux)
-        for mux in vcraft.mux_by_antenna(vcraftfiles, delaymap)
-    ]
+    with stage("parse_antennas"):
+        delaymap = parse_delays(values)
+        pol_antennas = [
+            [
+                AntennaSource(mux)
+                for mux in vcraft.mux_by_antenna(vcraftfiles[pol], delaymap)
+            ]
+            for pol in pols
+        ]
+        antennas = pol_antennas[0]
     print(f"Parse antennas: {timer()-start} s")
     print(("NUMBER OF ANTENNAS TO BE BEAMFORMED", len(antennas)))
 
     given_offset = values.offset
     start = timer()
     # FIXME: Could replace the antenna list here by the calcresults object, or even better, by the values.an antenna that we actually want to load
-    corr = Correlator(antennas, sources, values, abs_delay=given_offset)
+    with stage("setup_correlator"):
+        corr = Correlator(antennas, sources, values, abs_delay=given_offset)
+        # the other polarisation shares the delay model and crop
+        for ants in pol_antennas[1:]:
+            corr.for_pol(ants)
     print(f"setup Correlator: {timer()-start} s")
 
     try:
         start = timer()
         if values.ics:
             print("PERFORMING INCOHERENT SUM")
-            ant_ics = corr.do_ics(values.an)
-            fn = f"{values.outfile}_{values.pol}_{values.an:02d}"
-            print(f"saving {fn}")
-            np.save(fn, ant_ics)
+            # with no --an given, every antenna is summed in this process
+            for pol, pol_corr in zip(pols, corr.pol_corrs):
+                with stage("ics", ant=values.an, pol=pol):
+                    ant_ics = pol_corr.do_ics(values.an)
+                if values.an is None:
+                    fn = f"{values.outfile}_{pol}_all"
+                else:
+                    fn = f"{values.outfile}_{pol}_{values.an:02d}"
+                print(f"saving {fn}")
+                with stage("save"):
+                    np.save(fn, ant_ics)
         else:
             print("PERFORMING TIED-ARRAY BEAMFORMING")
 
@@ -193,12 +267,53 @@ def _main():
                 cand = parse_snoopy(values.snoopy)
                 mjd = float(cand[7])
 
-            temp = corr.do_tab(values.an, mjd, values.DM, values.polcal_crop_width_s)
+            # output files for each polarisation and beam
+            if len(pols) == 1:
+                outfiles = [values.outfiles]
+            else:
+                outfiles = [
+                    [pol_outfile(fn, pol) for fn in values.outfiles]
+                    for pol in pols
+                ]
+
+            # with a checkpoint directory, outputs are built up in place
+            # there and moved to their final names once done
+            if values.checkpoint_dir is not None:
+                os.makedirs(values.checkpoint_dir, exist_ok=True)
+                out = [
+                    [
+                        os.path.join(
+                            values.checkpoint_dir,
+                            os.path.basename(npy_fname(fn)),
+                        )
+                        for fn in fns
+                    ]
+                    for fns in outfiles
+                ]
+            elif values.mmap_out:
+                out = outfiles
+            else:
+                out = None
+
+            # with no --an given, every antenna is beamformed and summed in
+            # this process
+            pol_beams = corr.do_tab(
+                values.an, mjd, values.DM, values.polcal_crop_width_s, out=out
+            )
             
-            # save file
-            fn = values.outfile
-            print(f"saving output to {fn} with size {temp.shape}")
-            np.save(fn, temp)
+            # save files, one per polarisation and beam
+            for ip, (fns, beams) in enumerate(zip(outfiles, pol_beams)):
+                for ib, (fn, temp) in enumerate(zip(fns, beams)):
+                    with stage("save", shape=list(temp.shape)):
+                        if isinstance(temp, np.memmap):
+                            # already written in place
+                            print(f"flushing output to {fn} with size {temp.shape}")
+                            temp.flush()
+                            if out is not outfiles:
+                                shutil.move(out[ip][ib], npy_fname(fn))
+                        else:
+                            print(f"saving output to {fn} with size {temp.shape}")
+                            np.save(fn, temp)
 
     finally:
         print(f"beamforming: {timer() - start}")
@@ -219,7 +334,10 @@ class AntennaSource:
         self.pol = self.vfile.pol.lower()
         print(f"antenna {self.antname} {self.vfile.freqconfig}")
 
-    def do_f_tab(self, corr, iant, mjd, DM, polcal_width_s):
+    def plan_crop(self, corr, mjd, DM, polcal_width_s, write_info=True):
+        # Work out the samples of this antenna to beamform and their
+        # geometric delays. Also sets corr.nguard_chan and corr.fine_chanbw
+        # for the crop, and writes the crop/MJD info files if write_info.
 
         ##########################
         # calculate buffer offset
@@ -227,8 +345,6 @@ class AntennaSource:
         # delays
         ##########################
 
-        # iant is the number of the antenna in the AIPS AN table, minus 1 (i.e., a zero based index from the 36 antennas)
-        start = timer()
         self.frparams = FringeRotParams(corr, self)
         # calculate sample start
         framediff_samp = corr.refant.trigger_frame - self.trigger_frame
@@ -256,6 +372,17 @@ class AntennaSource:
             - fixed_delay_us
         )
 
+        # geometric delays of every beam, cropped along with geom_delays_us
+        beam_delays_us = [geom_delays_us]
+        for beam in range(1, corr.nbeam):
+            beam_delay_us, beam_delay_rate_us = corr.get_geometric_delay_delayrate_us(
+                self, beam)
+            beam_delays_us.append(
+                beam_delay_us
+                + beam_delay_rate_us * np.linspace(0, 1, nsamp)
+                - fixed_delay_us
+            )
+
 
         # do a bunch of printing
         print(f"corr.refant.trigger_frame: {corr.refant.trigger_frame}")
@@ -312,9 +439,12 @@ class AntennaSource:
             requested_sampoff = (requested_sampoff // 32) * 32
 
 
-            # make requested_nsamp a 5-smooth number such that we can take advantage
-            # of the cooley-Tukey FFT algorithm, look for the next 5-smooth number
-            requested_nsamp, _, _ = next_biggest_fftlen(requested_nsamp, corr.ncoarse_chan)
+            # make requested_nsamp a smooth number such that we can take advantage
+            # of the cooley-Tukey FFT algorithm, look for the cheapest smooth number
+            # at or just above it
+            requested_nsamp, _, _ = next_biggest_fftlen(
+                requested_nsamp, corr.ncoarse_chan, corr.fft_primes, corr.values.fft_max_pad
+            )
 
             # compare the requested crop bounds with the actually buffer bounds 
             # to make sure we are not requesting samples outside of the original 
@@ -352,7 +482,7 @@ class AntennaSource:
 
             # get next smallest buffer length for FFT, if nothing has changed, this will return the same as next_biggest_fftlen,
             # if nsamp changes, next_smallest_fftlen will ensure the optimal width is within the original buffer bounds
-            nsamp, nfine, corr.nguard_chan = next_smallest_fftlen(nsamp, corr.ncoarse_chan)
+            nsamp, nfine, corr.nguard_chan = next_smallest_fftlen(nsamp, corr.ncoarse_chan, corr.fft_primes)
 
             # recalculate fine channel bandwidth since the number of requested samples per coarse channel
             # has changed
@@ -368,12 +498,13 @@ class AntennaSource:
             print(f"geom delays crop end: {sampoff - buffer_start + nsamp}")
 
             # we need to crop the geometric delays since we have changed sampoff and nsamp 
-            geom_delays_us = geom_delays_us[sampoff_skip + sampoff - buffer_start:sampoff_skip + sampoff - buffer_start + nsamp]
+            crop0 = sampoff_skip + sampoff - buffer_start
 
             # save crop MJD to txt file
             crop_MJD = corr.refant.mjdstart + ((sampoff - buffer_start) * 27/32)/8.64e10
-            with open("frb_crop_MJD.txt", "w") as file:
-                file.write(f"{crop_MJD}")
+            if write_info:
+                with open("frb_crop_MJD.txt", "w") as file:
+                    file.write(f"{crop_MJD}")
 
 
         else:
@@ -388,25 +519,29 @@ class AntennaSource:
             # if requested_nsamp >= requested_nsamp:
             #     nsamp = requested_nsamp
 
-            # get next 5-smooting nsamp for optimal FFT algorithm
-            nsamp, nfine, corr.nguard_chan = next_biggest_fftlen(nsamp, corr.ncoarse_chan)
+            # get next smooth nsamp for optimal FFT algorithm
+            nsamp, nfine, corr.nguard_chan = next_biggest_fftlen(
+                nsamp, corr.ncoarse_chan, corr.fft_primes, corr.values.fft_max_pad
+            )
             
             # recalculate fine channel bandwidth
             corr.fine_chanbw = 1.0/float(nfine)
 
             # # crop geom delays
-            geom_delays_us = geom_delays_us[sampoff_skip:sampoff_skip + nsamp]
+            crop0 = sampoff_skip
 
             print(f"Old nsamp: {old_nsamp}, New nsamp: {nsamp}")
             print(f"New nfine: {nfine}")
             print(f"New nguard: {corr.nguard_chan}")
 
 
+        beam_delays_us = [d[crop0:crop0 + nsamp] for d in beam_delays_us]
+        geom_delays_us = beam_delays_us[0]
+
         # save cropping diagnostics to file for later review
-        with open("ant_crop.txt", "w") as file:
+        with open("ant_crop.txt", "w" if write_info else "a") as file:
             file.write(f"old sampoff: {old_sampoff}, sampoff_skip: {sampoff_skip}, sampoff {sampoff}, nsamp: {nsamp}, nguard: {corr.nguard_chan}, chanbw: {corr.fine_chanbw}\n")
 
-        print(("Zero-based, full-array antenna #: ", iant, self.antname))
         frameid = self.vfile.start_frameid + sampoff
         print(
             "FRAMEID: "
@@ -423,20 +558,103 @@ class AntennaSource:
 
         # save corrected MJD to txt file
         corrected_MJD = corr.refant.mjdstart + (geom_delay_us - fixed_delay_us)/(1e6*24*3600)
-        with open("corrected_start_MJD.txt", "w") as file:
-            file.write(f"{corrected_MJD}")
+        if write_info:
+            with open("corrected_start_MJD.txt", "w") as file:
+                file.write(f"{corrected_MJD}")
 
-        # save nfine as txt file for use further in CELEBI beamforming pipeline
-        with open("fftlen", "w") as f:
-            f.write(f"{nsamp}")
+            # save nfine as txt file for use further in CELEBI beamforming pipeline
+            with open("fftlen", "w") as f:
+                f.write(f"{nsamp}")
 
+        return CropPlan(sampoff, nsamp, nfine, corr.nguard_chan, beam_delays_us)
+
+    def do_f_tab(
+        self, corr, iant, mjd, DM, polcal_width_s, write_info=True, out=None,
+        plan=None, workers=None,
+    ):
+        # iant is the number of the antenna in the AIPS AN table, minus 1 (i.e., a zero based index from the 36 antennas)
+        # plan is a CropPlan from plan_crop, made here if not given
+        # workers is the number of FFT threads, by default --cpus
+        if plan is None:
+            plan = self.plan_crop(corr, mjd, DM, polcal_width_s, write_info)
+
+        sampoff, nsamp, nfine = plan.sampoff, plan.nsamp, plan.nfine
+        corr.nguard_chan = plan.nguard
+        corr.fine_chanbw = 1.0/float(nfine)
+        nchan_coarse = len(corr.freqs)              # number of coarse channels 
+        beam_delays_us = plan.beam_delays_us
+        geom_delays_us = beam_delays_us[0]
+
+        print(("Zero-based, full-array antenna #: ", iant, self.antname))
 
         # in the event that the voltage downloads somehow stuffed up and some of the data is missing
         # for one or more antenna, this block of code will check that the antenna data is defined (i.e. it exists)
         # for the requested crop. If not, exit out of craftcor_tab and ignore this antenna.
+        chan_block = corr.values.chan_block
+        read_workers = corr.values.read_workers
+
+        # Gains of the stages after beamforming that are folded into the
+        # calibration phasor
+        gains = corr.folded_gains(nsamp, nfine)
+
+        # With a checkpoint directory, coarse channels finished by an
+        # earlier run of this job are not redone
+        ckpt = None
+        if out is not None and corr.values.checkpoint_dir is not None:
+            key = (
+                f"sampoff={sampoff} nsamp={nsamp} nfine={nfine} "
+                f"nguard={corr.nguard_chan} nchan={nchan_coarse} "
+                f"nint={corr.nint} nbeam={corr.nbeam} {gains.key}"
+            )
+            ckpt = Checkpoint(
+                progress_fname(npy_fname(out[0])), key, nchan_coarse
+            )
+
         try:
-            # load in data
-            rawd = self.vfile.read(sampoff, nsamp)
+            # load in data, either all at once, streamed straight from the
+            # per-card vcraft files (read concurrently, ahead of the FFTs)
+            # or streamed through a channel-major scratch file in groups of
+            # chan_block channels
+            # When resuming, finished channels are skipped before they are
+            # read. Only the per-card files can be read a few channels at a
+            # time, so they are read that way when resuming even without
+            # --read_workers.
+            resuming = ckpt is not None and ckpt.resumed
+            skip = None if ckpt is None else ckpt.is_done
+
+            # Every read from the vcraft files is timed as a "vfile.read"
+            # stage where it happens, which for the streaming readers is
+            # in background threads during the "vfile.spill" or "fft" stage
+            read_timer = functools.partial(
+                stage, "vfile.read", ant=self.antname
+            )
+            if ckpt is not None and ckpt.complete:
+                print("All coarse channels already done")
+                rawd = None
+            elif (
+                (read_workers > 0 or resuming)
+                and CardReader.supported(self.vfile)
+            ):
+                rawd = CardReader(
+                    self.vfile, sampoff, nsamp,
+                    workers=max(read_workers, 1), skip=skip, timer=read_timer,
+                )
+            elif chan_block > 0 or resuming:
+                if resuming:
+                    print(
+                        "WARNING: vcraft files cannot be read by card, "
+                        "reading every channel to resume"
+                    )
+                with stage("vfile.spill", ant=self.antname, nsamp=nsamp):
+                    rawd = ChannelBlockReader(
+                        self.vfile, sampoff, nsamp,
+                        chan_block if chan_block > 0 else corr.values.fft_batch,
+                        time_block=corr.values.time_block, skip=skip,
+                        timer=read_timer,
+                    )
+            else:
+                with read_timer(nsamp=nsamp):
+                    rawd = self.vfile.read(sampoff, nsamp)
         
         except AssertionError as msg:
             # if failed, return 
@@ -451,17 +669,24 @@ class AntennaSource:
             with open(f"{label}_{self.antname}_{self.pol}_failed.txt", "w") as file:
                 file.write(f"Cannot read requested data for antenna no/name [{self.antno}]/[{self.antname}], not enough samples...\n")
                 file.write(f"nsamps in buffer = {self.vfile.nsamps}, Requested nsamps = {nsamp}, Requested starting sample = {sampoff}\n")
-            return np.zeros(0, dtype = np.complex64)
+            return [np.zeros(0, dtype = np.complex64)] * corr.nbeam
             
 
         # make new buffer array, this will be the final beamformed antenna fine channel
         # buffer array that will be coherently summed with all other antenna    
-        data_out = np.zeros(
-            (corr.nint, nfine * nchan_coarse, corr.npol_in), dtype=np.complex64
-        )
+        # (one per beam, memory mapped to the output files if out is given)
+        data_outs = [
+            new_output(
+                (corr.nint, nfine * nchan_coarse, corr.npol_in),
+                None if out is None else out[beam],
+                resume=ckpt is not None and ckpt.resumed,
+            )
+            for beam in range(corr.nbeam)
+        ]
+        data_out = data_outs[0]
 
         # check if loaded data is right shape
-        assert rawd.shape == (
+        assert rawd is None or rawd.shape == (
             nsamp,
             corr.ncoarse_chan,
         ), f"Unexpected shape from vfile: {rawd.shape} expected ({nsamp},{corr.ncoarse_chan})"
@@ -479,66 +704,75 @@ class AntennaSource:
 
         start = timer()
 
-        def process_chan(c):
-            # Channel frequency
-            cfreq = corr.freqs[c]
-
-            # rawd's shape: (nsamp, corr.ncoarse_chan)
-            x1 = rawd[:, c].reshape(-1, nsamp)
-
-            # Conjugate the incoming data if needed to turn it into LSB
-            if corr.sideband == 1: # FIXME this is a change
-                x1 = np.conj(x1)
-
-            # Fringe rotation for Earth's rotation - use opposite LO sign for lower sideband data
-            #turn_fringe = -cfreq * geom_delays_us * corr.sideband #FIXME now everything is LSB this should be unnecessary
-            turn_fringe = cfreq * geom_delays_us
-
-            phasor_fringe = np.exp(
-                np.pi * 2j * turn_fringe, dtype=np.complex64
-            )
-
-            x1 = x1 * phasor_fringe
-
-            # xfguard is xf1 with the ends trimmed off
-            xf1 = np.fft.fft(x1, axis=1)
-            xf1 = np.fft.fftshift(xf1, axes=1)
-            
-            # If it is upper sideband, need to conjugate and reverse the channel order to make it appear lower sideband
-            # FIXME: not needed if data is already turned into LSB in the time domain
-            #if corr.sideband == 1:
-            #    xf1 = np.conj(xf1)
-            #    xf1 = np.flip(xf1, axis=1)
-
-            xfguard_f = xf1[
-                :, corr.nguard_chan: corr.nguard_chan + nfine:
-            ]  # scale because oterhwise it overflows
-
-            # Fractional sample phases
-            turn_frac = freqs * np.mean(geom_delays_us)
-
-            # phasors to rotate the data with constant amplitude = 1
-            phasor = np.exp(np.pi * 2j * turn_frac, dtype=np.complex64)
-
-            # get absolute frequencies in gigahertz
-            freq_ghz = (cfreq + freqs) / 1e3
-
-            # apply calibration solutions to phasor
-            # print(f"Aips SOlution?: {corr.aips.get_solution(iant, 0, freq_ghz)}")
-            phasor /= corr.aips.get_solution(iant, 0, freq_ghz)
-
-            xfguard_f = xfguard_f * phasor
-
-            # select the channels for this coarse channel
-            fcstart = c * nfine
-            fcend = (c + 1) * nfine
-            data_out[:, fcstart:fcend, 0] = xfguard_f
-
-
-        Parallel(n_jobs=corr.values.cpus, require="sharedmem")(
-            delayed(process_chan)(c)
-            for c in range(corr.ncoarse_chan)
+        # Fringe rotation, FFT, guard trimming and calibration are done by
+        # the batched engine on groups of coarse channels at once
+        # geom_delays_us is linear in time, so the fringe rotation phasors are
+        # generated blockwise rather than with an exp for every sample
+        fringe = FringeRotator.from_delays(corr.freqs, geom_delays_us)
+        engine = TabEngine(
+            fringe,
+            corr.nguard_chan,
+            freqs,
+            corr.sideband,
+            lambda freq_ghz: corr.aips.get_solution_vector(iant, freq_ghz),
+            workers=corr.values.cpus if workers is None else workers,
+            batch=corr.values.fft_batch,
+            gain=gains or None,
         )
+        outs = [d[0, :, 0] for d in data_outs]
+
+        # Extra beams only differ from the first by a delay offset. While
+        # that offset is constant enough over the crop, they are made from
+        # the first beam's spectrum with a phase ramp, otherwise they get
+        # their own fringe rotation and FFT.
+        engines = [engine]
+        for beam, delays_us in enumerate(beam_delays_us[1:], 1):
+            beam_fringe = FringeRotator.from_delays(corr.freqs, delays_us)
+            offset = BeamOffset(engine, outs[0], beam_fringe)
+            if offset.drift_turns <= corr.values.beam_drift_tol:
+                engines.append(offset)
+            else:
+                print(
+                    f"WARNING: delay offset of beam {beam} drifts by "
+                    f"{offset.drift_turns:.3g} turns over the crop, "
+                    "fringe rotating and FFTing it separately"
+                )
+                engines.append(engine.copy(beam_fringe))
+
+        # groups of coarse channels as (first channel, (nchan, nsamp) voltages)
+        if rawd is None:
+            groups = []
+            reader = contextlib.nullcontext()
+        elif isinstance(rawd, np.ndarray):
+            group = chan_block if chan_block > 0 else corr.values.fft_batch
+            groups = (
+                (c0, rawd[:, c0:c0 + group].T)
+                for c0 in range(0, rawd.shape[1], group)
+            )
+            reader = contextlib.nullcontext()
+        else:
+            # only a few groups of channels are held in memory at a time
+            groups = reader = rawd
+
+        with stage("fft", ant=self.antname, nsamp=nsamp, nbeam=corr.nbeam):
+            with reader:
+                for c0, block in groups:
+                    c1 = c0 + block.shape[0]
+                    if ckpt is not None and ckpt.is_done(c0, c1):
+                        continue
+                    for e, o in zip(engines, outs):
+                        e.process(c0, block, o)
+                    if ckpt is not None:
+                        ckpt.mark(c0, c1, data_outs)
+                    del block
+        del rawd, groups, reader, engine, engines
+
+        if ckpt is not None:
+            ckpt.finish()
+
+        # every integration holds the same spectrum
+        for d in data_outs:
+            d[1:] = d[0]
 
         print(f"do_f_tab (stage 2): {timer()-start} s")
 
@@ -546,14 +780,13 @@ class AntennaSource:
             print("WARNING: Output contains NaNs. Calibration solutions not available?")
 
         print(f"data out shape: {data_out.shape}")
-        return data_out
+        return data_outs
 
-    def do_ics(self, corr, an):
+    def do_ics(self, corr, an, out=None):
         nfine = corr.nfft - 2 * corr.nguard_chan
 
         # number of 1 ms-time resolution samples
         nsamp = nfine//1000
-        nchan = corr.ncoarse_chan
 
         start_mjd = corr.curr_mjd_start
         dt_mjd = 1/(24*60*60*1000)
@@ -562,50 +795,60 @@ class AntennaSource:
         t_mjd = np.linspace(start_mjd, end_mjd, nsamp)
         np.save(f"t_mjd.npy", t_mjd)
 
-        ics_data = np.zeros((nchan, nsamp))
-
         total_delay_samp = corr.refant.trigger_frame - self.trigger_frame
         whole_delay = int(np.round(total_delay_samp))
-        rawd = self.vfile.read(whole_delay + corr.abs_delay, corr.nfft)
-        # np.save("TEMP_rawd.npy", rawd)
-        # del rawd
-        # rawd = np.load("TEMP_rawd.npy", mmap_mode="r")
-
-        def process_chan(c):
-            print(f"{self.antname}\t{c:03d}/{nchan}")
-            cfreq = corr.freqs[c]
-            x1 = rawd[:, c].reshape(-1, corr.nfft)
-            xf1 = np.fft.fft(x1, axis=1)
-            xf1 = np.fft.fftshift(xf1, axes=1)
-            xfguard_f = xf1[
-                0, corr.nguard_chan: corr.nguard_chan + nfine:
-            ]
+        with stage("vfile.read", ant=self.antname, nsamp=corr.nfft):
+            rawd = self.vfile.read(whole_delay + corr.abs_delay, corr.nfft)
+
+        # 1 ms power in every channel, added to out if given
+        print(f"{self.antname}: making ICS dynamic spectrum")
+        with stage("fft", ant=self.antname, nsamp=corr.nfft):
+            ics_data = ics_dynspec(
+                rawd, corr.nguard_chan, workers=corr.values.cpus,
+                batch=corr.values.fft_batch, out=out,
+            )
 
-            XX_1us = np.abs(np.fft.ifft(xfguard_f))**2
+        return ics_data
 
-            # tscrunch
-            for t in range(nsamp):
-                ics_data[c, t] = np.sum(XX_1us[t*1000:(t+1)*1000])
 
-        Parallel(n_jobs=corr.values.cpus, require="sharedmem")(
-            delayed(process_chan)(c)
-            for c in range(nchan)
-        )
+class CropPlan:
+    """Crop of an antenna's voltages to beamform, from
+    :meth:`AntennaSource.plan_crop`.
+
+    :param sampoff: First sample of the crop
+    :type sampoff: int
+    :param nsamp: Number of samples in the crop
+    :type nsamp: int
+    :param nfine: Number of fine channels per coarse channel
+    :type nfine: int
+    :param nguard: Number of guard channels on each side of a coarse
+        channel
+    :type nguard: int
+    :param beam_delays_us: Geometric delay of every sample in us, for
+        each beam
+    :type beam_delays_us: list of :class:`np.ndarray`
+    """
 
-        return ics_data
+    def __init__(self, sampoff, nsamp, nfine, nguard, beam_delays_us):
+        self.sampoff = sampoff
+        self.nsamp = nsamp
+        self.nfine = nfine
+        self.nguard = nguard
+        self.beam_delays_us = beam_delays_us
 
 
 class FringeRotParams:
     cols = ("U (m)", "V (m)", "W (m)", "DELAY (us)")
 
-    def __init__(self, corr, ant):
-        print("frdata_mid keys:", corr.frdata_mid.keys())
-        mid_data = corr.frdata_mid[ant.antname]
+    def __init__(self, corr, ant, beam=0):
+        frdata_start, frdata_mid, frdata_end = corr.beam_frdata[beam]
+        print("frdata_mid keys:", frdata_mid.keys())
+        mid_data = frdata_mid[ant.antname]
         self.u, self.v, self.w, self.delay = list(
             map(float, [mid_data[c] for c in FringeRotParams.cols])
         )
-        self.delay_start = float(corr.frdata_start[ant.antname]["DELAY (us)"])
-        self.delay_end = float(corr.frdata_end[ant.antname]["DELAY (us)"])
+        self.delay_start = float(frdata_start[ant.antname]["DELAY (us)"])
+        self.delay_end = float(frdata_end[ant.antname]["DELAY (us)"])
         self.delay_rate = (self.delay_end - self.delay_start) / float(
             corr.nint
         )
@@ -626,6 +869,8 @@ class Correlator:
         signal.signal(signal.SIGTERM, self.exit_gracefully)
         self.ants = ants
         self.values = values
+        # this correlator and its copies for other polarisations (for_pol)
+        self.pol_corrs = [self]
 
         self.parse_parset()
 
@@ -674,6 +919,11 @@ class Correlator:
         # self.nguard_chan = 5 * values.fft_size
 
         self.calcresults = ResultsFile(values.calcfile)
+        # any extra tied-array beams are formed from the same voltages
+        self.beam_calcresults = [self.calcresults] + [
+            ResultsFile(f) for f in values.calcfiles[1:]
+        ]
+        self.nbeam = len(self.beam_calcresults)
         self.dutc = 0
         self.mjd0 = self.refant.mjdstart + self.dutc / 86400.0
         self.frame0 = self.refant.trigger_frame
@@ -688,6 +938,7 @@ class Correlator:
         self.fine_chanbw = self.coarse_chanbw / float(self.nfine_per_coarse)
         self.full_bw = self.fine_chanbw * self.nfine_chan
         self.fscrunch = values.fscrunch
+        self.fft_primes = tuple(int(p) for p in values.fft_primes.split(","))
         assert self.fscrunch >= 1
         assert (
             self.nfine_per_coarse % self.fscrunch == 0
@@ -736,13 +987,14 @@ class Correlator:
                 self.parset[name] = value
 
     def parse_aips_calibration(self):
-        self.aips = AipsGainSolutions(
-            self.ants,
-            self.values,
-            self.values.aips_c,
-            self.pol,
-            self.freqs,
-        )
+        with stage("calibration_load"):
+            self.aips = AipsGainSolutions(
+                self.ants,
+                self.values,
+                self.values.aips_c,
+                self.pol,
+                self.freqs,
+            )
 
     def get_ant_location(self, antno):
         key = f"common.antenna.ant{antno}.location.itrf"
@@ -760,9 +1012,9 @@ class Correlator:
 
         return delayus
 
-    def get_geometric_delay_delayrate_us(self, ant):
-        fr1 = FringeRotParams(self, ant)
-        fr2 = FringeRotParams(self, self.refant)
+    def get_geometric_delay_delayrate_us(self, ant, beam=0):
+        fr1 = FringeRotParams(self, ant, beam)
+        fr2 = FringeRotParams(self, self.refant, beam)
 
         # TODO: There is a discrepancy here, below comment says fr1 is ref ant,
         # but above suggests fr2 is?
@@ -774,7 +1026,8 @@ class Correlator:
         delay = fr1.delay_start - fr2.delay_start
         delayrate = fr1.delay_rate - fr2.delay_rate
 
-        with open(f"delays/{ant.antno}_ant_delays.dat", "w") as f:
+        suffix = f"_beam{beam}" if beam > 0 else ""
+        with open(f"delays/{ant.antno}_ant_delays{suffix}.dat", "w") as f:
             f.write(f"#field fr1({ant}) fr2({self.refant})\n")
             f.write(f"delay_start {fr1.delay_start} {fr2.delay_start}\n")
             f.write(f"delay {fr1.delay} {fr2.delay}\n")
@@ -796,196 +1049,231 @@ class Correlator:
             self.mjd0 + self.inttime_days * (i + 1.0) + abs_delay_days
         )
 
-    def get_calc_results(self, mjd):
-        res = self.calcresults.scans[0].eval_src0_poly(mjd)
+    def get_calc_results(self, mjd, beam=0):
+        res = self.beam_calcresults[beam].scans[0].eval_src0_poly(mjd)
 
         return res
 
     def get_fr_data(self):
-        self.frdata_start = self.get_calc_results(self.curr_mjd_start)
-        self.frdata_mid = self.get_calc_results(self.curr_mjd_mid)
-        self.frdata_end = self.get_calc_results(self.curr_mjd_end)
+        # start, middle and end fringe rotation data of every beam
+        self.beam_frdata = [
+            tuple(
+                self.get_calc_results(m, beam) for m in (
+                    self.curr_mjd_start, self.curr_mjd_mid, self.curr_mjd_end
+                )
+            )
+            for beam in range(self.nbeam)
+        ]
+        self.frdata_start, self.frdata_mid, self.frdata_end = self.beam_frdata[0]
+
+    def for_pol(self, ants):
+        # Copy of this correlator for the same antennas in another
+        # polarisation. The parset, delay model and crop sizes are shared,
+        # only the antennas and calibration solutions differ.
+        names = [a.antname for a in self.ants]
+        if [a.antname for a in ants] != names:
+            print("ERROR: X and Y polarisations have different antennas")
+            sys.exit(1)
 
-    def do_tab(self, an=None, mjd = None, DM = None, polcal_width_s = 3):
-        # Tied-array beamforming
+        corr = copy.copy(self)
+        corr.ants = ants
+        for a, a_ref in zip(ants, self.ants):
+            a.ia = a_ref.ia
+            a.antpos = a_ref.antpos
+        corr.refant = ants[names.index(self.refant.antname)]
+        corr.pol = ants[0].pol
+        if not self.values.ics:
+            corr.parse_aips_calibration()
+
+        self.pol_corrs.append(corr)
+        return corr
+
+    def folded_gains(self, nsamp, nfine):
+        # Gains of derippling, dedispersion and the pol cal delay that
+        # --fold_* asked for, as a FoldedGains for crops of nsamp samples.
+        # The pol cal delay only applies to X.
+        v = self.values
+        nchan = len(self.freqs)
+
+        deripple = None
+        if v.fold_deripple is not None:
+            deripple = filter_deripple_gains(v.fold_deripple, nsamp, nfine)
+
+        polcal = None
+        if v.fold_polcal is not None and self.pol == "x":
+            polcal = load_soln(v.fold_polcal)
+
+        f0 = v.fold_f0
+        if f0 is None:
+            f0 = float(np.mean(self.freqs))
+
+        return FoldedGains(
+            nchan, nfine, deripple=deripple, DM=v.fold_DM, polcal=polcal,
+            f0=f0,
+        )
 
-        nsamp = self.nint
-        nchan = self.ncoarse_chan * self.nfine_per_coarse
+    def do_f_tab_pols(
+        self, ia, mjd = None, DM = None, polcal_width_s = 3, write_info=True,
+        out=None,
+    ):
+        # Beamform antenna ia in every polarisation in pol_corrs. The crop
+        # is planned once, on the first polarisation, and the polarisations
+        # are then beamformed concurrently.
+        corrs = self.pol_corrs
+        ants = [c.ants[ia] for c in corrs]
+        iant = ant_map[ants[0].antname]
+        plan = ants[0].plan_crop(self, mjd, DM, polcal_width_s, write_info)
+
+        plans = [plan]
+        for c, a in zip(corrs[1:], ants[1:]):
+            # the crop only depends on the voltages through their frame
+            # ids and lengths
+            if (
+                a.trigger_frame == ants[0].trigger_frame
+                and a.vfile.nsamps == ants[0].vfile.nsamps
+                and c.refant.trigger_frame == self.refant.trigger_frame
+                and c.refant.mjdstart == self.refant.mjdstart
+            ):
+                plans.append(plan)
+            else:
+                print(f"{a.antname} pol {a.pol} has its own crop")
+                plans.append(
+                    a.plan_crop(c, mjd, DM, polcal_width_s, write_info=False)
+                )
+
+        if out is None:
+            out = [None] * len(corrs)
+
+        if len(corrs) == 1:
+            return [
+                ants[0].do_f_tab(
+                    self, iant, mjd, DM, polcal_width_s, out=out[0], plan=plan
+                )
+            ]
+
+        # the polarisations share the --cpus cores between them
+        workers = max(1, self.values.cpus // len(corrs))
+        with ThreadPoolExecutor(len(corrs)) as pool:
+            futures = [
+                pool.submit(
+                    a.do_f_tab, c, iant, mjd, DM, polcal_width_s,
+                    out=o, plan=pl, workers=workers,
+                )
+                for c, a, o, pl in zip(corrs, ants, out, plans)
+            ]
+            return [f.result() for f in futures]
 
-        # print(nsamp, nchan, self.npol_in)
-        # sum_aligned = np.zeros(
-        #     (nsamp, nchan, self.npol_in), dtype=np.complex64
-        # )
+    def do_tab(self, an=None, mjd = None, DM = None, polcal_width_s = 3, out=None):
+        # Tied-array beamforming. Returns, for every polarisation in
+        # pol_corrs, a spectrum for every beam. If out (a filename per
+        # polarisation and beam) is given, they are written straight into
+        # memory maps of those files
+        if an is None:
+            return self.do_tab_sum(mjd, DM, polcal_width_s, out=out)
 
         start = timer()
         print("## Operate on only antenna #: " + str(an))
-        ant = self.ants[an]
-        iant = ant_map[ant.antname]
-        temp = ant.do_f_tab(self, iant, mjd, DM, polcal_width_s)
+        temp = self.do_f_tab_pols(an, mjd, DM, polcal_width_s, out=out)
         print(f"do_f_tab (total): {timer()-start} s")
         return temp
 
-    def do_ics(self, an):
+    def do_tab_sum(self, mjd = None, DM = None, polcal_width_s = 3, out=None):
+        # Tied-array beamforming of every antenna in this process. Each
+        # antenna's fine spectrum is added into a single running sum as soon
+        # as it is made, so no per-antenna spectra are written to disk and
+        # sum.py is not needed.
+        npol = len(self.pol_corrs)
+        sum_arrs = [None] * npol
+        n_antennas = [0] * npol
+
+        for ia, ant in enumerate(self.ants):
+            start = timer()
+            print(f"## Operate on antenna #: {ia} ({ant.antname})")
+
+            # Only the first antenna writes the crop/MJD info files, so they
+            # match what the per-antenna pipeline publishes for antenna 0
+            pol_outs = self.do_f_tab_pols(
+                ia, mjd, DM, polcal_width_s, write_info=(ia == 0)
+            )
+            print(f"do_f_tab (total): {timer()-start} s")
+
+            for ip, data_outs in enumerate(pol_outs):
+                name = f"{ant.antname} pol {self.pol_corrs[ip].pol}"
+                data_out = data_outs[0]
+
+                # Same filtering as filter_antenna.py and sum.py: ignore
+                # antennas that could not be read or that contain NaNs
+                if data_out.size == 0:
+                    print(f"Ignoring antenna {name}: no data")
+                    continue
+                if np.isnan(data_out).any():
+                    print(f"Ignoring antenna {name}: output contains NaNs")
+                    continue
+
+                if sum_arrs[ip] is None:
+                    if out is None:
+                        sum_arrs[ip] = data_outs
+                    else:
+                        # only the sums are memory mapped to the output files
+                        sum_arrs[ip] = []
+                        for fname, d in zip(out[ip], data_outs):
+                            sum_arr = new_output(d.shape, fname)
+                            sum_arr[:] = d
+                            sum_arrs[ip].append(sum_arr)
+                elif data_out.shape != sum_arrs[ip][0].shape:
+                    # fine channels would not line up between antennas
+                    print(
+                        f"Ignoring antenna {name}: shape {data_out.shape} "
+                        f"does not match {sum_arrs[ip][0].shape}"
+                    )
+                    continue
+                else:
+                    for sum_arr, d in zip(sum_arrs[ip], data_outs):
+                        sum_arr += d
+                n_antennas[ip] += 1
+
+            # free this antenna's spectra before reading the next one
+            pol_outs = data_outs = data_out = None
+
+        for c, n in zip(self.pol_corrs, n_antennas):
+            print(f"Number of good antennas (pol {c.pol}): {n}")
+
+        return [
+            [np.zeros(0, dtype=np.complex64)] * self.nbeam if s is None else s
+            for s in sum_arrs
+        ]
+
+    def do_ics(self, an=None):
         # Incoherent sum
+        if an is None:
+            return self.do_ics_sum()
+
         ant = self.ants[an]
         ant_ics = ant.do_ics(self, an)
 
         return ant_ics
 
+    def do_ics_sum(self):
+        # Incoherent sum of every antenna in this process. Each antenna's
+        # power is added into one dynamic spectrum, so sum_ics.py just has
+        # one file per polarisation to add up.
+        ics_sum = None
+        n_antennas = 0
 
-class AipsGainSolutions:
-    # FIXME: Should provide the three file names separately, and selfcal should be optional
-    def __init__(
-        self, ants, values, bp_c_root=None, pol=None, freqs=None
-    ):
-        """Loads AIPS exported bandpass, delay, and gain selfcal solutions.
-        Expects 3 files whose root matches that of the bp file given
-
-        """
-        print("Using AIPS bandpass solutions")
-        nant = None
-        nfreq = None
-        with open(bp_c_root) as fl:
-            for line in fl:
-                if "NAXIS2" in line:
-                    nant = int(line.split()[2])
-                    print(f"nant = {nant}")
-                if "TFDIM11" in line:
-                    nfreq = int(line.split()[2])
-        if nant is None or nfreq is None:
-            print(
-                "WARNING! nant or nfreq not assigned while parsing AIPS bandpass"
-            )
-        print(f"nant = {nant}")
-        fmax = freqs[0] + 0.5  # in MHz
-        bw = len(freqs)  # in MHz
-        self.freqs = (
-            -np.arange(float(nfreq)) / nfreq * bw
-            + fmax
-            - float(bw) / nfreq / 2
-        ) / 1e3  # reassign freqs in GHz
-        self.bp_real = np.full(
-            (nfreq, 36), np.nan, dtype=np.complex64
-        )
-        self.bp_imag = np.full(
-            (nfreq, 36), np.nan, dtype=np.complex64
-        )
-        g_real = np.full((1, 36), np.nan, dtype=np.complex64)
-        g_imag = np.full((1, 36), np.nan, dtype=np.complex64)
-
-        # look for a README and get fring, selfcal filenames
-        drcal = os.path.dirname(bp_c_root)
-
-        readme = glob.glob("README*")
-        if len(readme) == 1:
-            with open(readme[0]) as fl:
-                for line in fl:
-                    if "delays" in line and ".sn.txt" in line:
-                        fring_f = line.split()[0]
-                    if "selfcal" in line and ".sn.txt" in line:
-                        sc_f = line.split()[0]
-                        print(f"FOUND SELFCAL FILE: {sc_f}")
-        else:
-            print("No or multiple readme file exists for AIPS")
-            sys.exit(1)
-
-        aips_cor = aipscor(fring_f, sc_f, bp_c_root)
-        if values.an == None:
-            loadantennas = range(36)
-        else:
-            antname = ants[values.an].antname
-            iant = ant_map[antname]
-            loadantennas = [iant]
-        for iant in loadantennas:
-            print(f"Loading antenna {iant} from {loadantennas}")
-            bp = aips_cor.get_phase_bandpass(iant, pol)
-            print("Phase bandpass loaded")
-            bp = np.fliplr([bp])[0]  # decreasing order
-
-            # fring delay
-            delta_t_fring_ns = (
-                aips_cor.get_delay_fring(iant, pol) * 1e9
-            )
-            print("Delay FRING loaded")
-            phases = delta_t_fring_ns * self.freqs
-            phases -= phases[
-                int(len(phases) / 2)
-            ]  # TODO! READ THE REFERENCE FREQUENCY AND SET TO THAT REFERENCE
-
-            bp *= np.exp(np.pi * 2j * phases, dtype=np.complex64)
-
+        for ia, ant in enumerate(self.ants):
+            start = timer()
+            print(f"## Operate on antenna #: {ia} ({ant.antname})")
             try:
-                g = aips_cor.get_phase_fring(
-                    iant, pol
-                ) * aips_cor.get_phase_selfcal(iant, pol)
-                g = 1 / g  # inverse of gain
-                print("Phases loaded")
-            except Exception as e:
-                print(e)
-                g = 0
-            bp = np.conj(bp)
-            self.bp_real[:, iant] = np.real(bp)
-            self.bp_imag[:, iant] = np.imag(bp)
-            g_real[0, iant] = np.real(g)
-            g_imag[0, iant] = np.imag(g)
-        print("Finished loading bandpasses")
-
-        self.bp_real_interp = [
-            interp1d(
-                self.freqs,
-                self.bp_real[:, iant],
-                fill_value=(
-                    self.bp_real[0, iant],
-                    self.bp_real[-1, iant],
-                ),
-                bounds_error=False,
-            )
-            for iant in range(36)
-        ]
-        self.bp_imag_interp = [
-            interp1d(
-                self.freqs,
-                self.bp_imag[:, iant],
-                fill_value=(
-                    self.bp_imag[0, iant],
-                    self.bp_imag[-1, iant],
-                ),
-                bounds_error=False,
-            )
-            for iant in range(36)
-        ]
-        self.bp_coeff = None
-
-        self.g_real = g_real
-        self.g_imag = g_imag
-        print("Finished AIPS solutions init")
-
-    def get_solution(self, iant, time, freq_ghz):
-        """
-        Get solution including time and bandpass
-        iant - antenna index (zero-based from the full array of 36 antennas, not the subset for this observation)
-        time - some version of time. Ignored for now
-        freq_ghz - frequency float in Ghz
-        """
-        if self.bp_real is None:
-            # no bandpass/gain solution was passed
-            bp_value = np.array([1])
-        elif self.bp_coeff is not None:  # Use AIPS polyfit coefficient
-            bp_fit = np.poly1d(self.bp_coeff[iant, 0, :]) + 1j * np.poly1d(
-                self.bp_coeff[iant, 1, :]
-            )
-            bp_value = bp_fit(freq_ghz * 1e3)
-        else:
-            # AIPS polyfit coefficient doesn't exist. Use Miriad/AIPS
-            # bandpass interpolation
-            f_real = self.bp_real_interp[iant](freq_ghz)
-            f_imag = self.bp_imag_interp[iant](freq_ghz)
-            bp_value = f_real + 1j * f_imag
+                ics_sum = ant.do_ics(self, ia, out=ics_sum)
+            except AssertionError:
+                print(f"Ignoring antenna {ant.antname}: cannot read data")
+                continue
+            n_antennas += 1
+            print(f"do_ics (total): {timer()-start} s")
 
-        g_value = self.g_real[0, iant] + 1j * self.g_imag[0, iant]
-        total_value = bp_value * g_value
+        print(f"Number of good antennas: {n_antennas}")
 
-        return total_value
+        return ics_sum
 
 
 def parse_args():
@@ -1017,7 +1305,12 @@ def parse_args():
         default=False,
     )
     parser.add_argument(
-        "-o", "--outfile", help="Output fits/.npy file", default="corr.fits"
+        "-o",
+        "--outfile",
+        nargs="+",
+        help="Output fits/.npy file. Give one per --calcfile to form "
+             "several beams",
+        default=["corr.fits"],
     )
     parser.add_argument(
         "-n",
@@ -1026,7 +1319,22 @@ def parse_args():
         help="Multiple of 64 channels to make channels- default=1",
         default=1,
     )
-    parser.add_argument("--calcfile", help="Calc file for fringe rotation")
+    parser.add_argument(
+        "--calcfile",
+        nargs="+",
+        help="Calc file for fringe rotation. Give several to form a "
+             "tied-array beam towards each of their positions from one read "
+             "of the voltages",
+    )
+    parser.add_argument(
+        "--beam_drift_tol",
+        type=float,
+        default=0.01,
+        help="Largest phase error, in turns, allowed when forming extra "
+             "beams from the first beam's spectrum. Beams whose delay "
+             "offset drifts more than this over the crop are fringe "
+             "rotated and FFT'd separately"
+    )
     parser.add_argument("-w", "--hwfile", help="Hw delay file")
     parser.add_argument("-p", "--parset", help="Parset for delays")
     parser.add_argument(
@@ -1047,13 +1355,27 @@ def parse_args():
         "--aips_c", help="AIPS banpass polynomial fit coeffs", default=None
     )
     parser.add_argument(
-        "--an", type=int, help="Specific antenna", default=None
+        "--aips_cache",
+        help="Compiled AIPS solutions (.npy) from aips_cache.py. Created "
+             "from the AIPS tables if it does not exist",
+        default=None,
+    )
+    parser.add_argument(
+        "--an",
+        type=int,
+        help="Specific antenna. If not given, all antennas are beamformed "
+             "(or, with --ics, incoherently summed) into a single output",
+        default=None,
     )
     parser.add_argument(
         "--offset", type=int, help="FFT offset to add", default=0
     )
     parser.add_argument(
-        "--pol", type=str, help="Polarisation to process (x or y)"
+        "--pol",
+        type=str,
+        help="Polarisation to process (X or Y), or XY to process both in "
+             "one pass. With XY, an @ in the output filenames is replaced "
+             "by the polarisation",
     )
     parser.add_argument(
         "--cpus",
@@ -1061,6 +1383,98 @@ def parse_args():
         default=1,
         help="Number of CPUs to parallelise across (Default = 1)"
     )
+    parser.add_argument(
+        "--fft_primes",
+        type=str,
+        default=",".join(str(p) for p in DEFAULT_PRIMES),
+        help="Comma-separated primes that crop FFT lengths may be "
+             "factorised over"
+    )
+    parser.add_argument(
+        "--fft_max_pad",
+        type=float,
+        default=0.0,
+        help="Fraction a crop may be lengthened beyond the shortest valid "
+             "FFT length to reach a faster one, e.g. 0.02 (Default = 0, "
+             "the shortest valid length)"
+    )
+    parser.add_argument(
+        "--fft_batch",
+        type=int,
+        default=8,
+        help="Number of coarse channels fine channelised together as one "
+             "2-D FFT"
+    )
+    parser.add_argument(
+        "--chan_block",
+        type=int,
+        default=0,
+        help="Stream voltages in groups of this many coarse channels to "
+             "bound memory use. 0 reads the whole crop at once"
+    )
+    parser.add_argument(
+        "--read_workers",
+        type=int,
+        default=0,
+        help="Read each antenna's per-card vcraft files this many at a time, "
+             "ahead of the FFTs, instead of through the mux. 0 reads through "
+             "the mux"
+    )
+    parser.add_argument(
+        "--time_block",
+        type=int,
+        default=2**20,
+        help="Number of samples read from the vcraft files at a time when "
+             "streaming with --chan_block"
+    )
+    parser.add_argument(
+        "--mmap_out",
+        action="store_true",
+        default=False,
+        help="Write the beamformed spectrum straight into a memory-mapped "
+             "output file instead of saving it from memory at the end"
+    )
+    parser.add_argument(
+        "--metrics",
+        default=None,
+        help="JSON lines file to append per-stage timing and memory metrics "
+             "to. Defaults to $CELEBI_METRICS if set"
+    )
+    parser.add_argument(
+        "--checkpoint_dir",
+        default=None,
+        help="Directory to build the memory-mapped outputs up in, with "
+             "progress markers, so a restarted single-antenna job skips "
+             "coarse channels that are already done. Outputs are moved to "
+             "their final names when complete"
+    )
+    parser.add_argument(
+        "--fold_deripple",
+        default=None,
+        help="PFB filter (ADE_R6_OSFIR.mat) to deripple the spectrum with "
+             "during beamforming, instead of with deripple.py afterwards"
+    )
+    parser.add_argument(
+        "--fold_DM",
+        type=float,
+        default=None,
+        help="DM to coherently dedisperse to during beamforming, instead "
+             "of with dedisperse.py afterwards"
+    )
+    parser.add_argument(
+        "--fold_polcal",
+        default=None,
+        help="Pol cal solutions whose X delay and phase are applied during "
+             "beamforming. apply_polcal.py must then be run with --no_delay"
+    )
+    parser.add_argument(
+        "--fold_f0",
+        type=float,
+        default=None,
+        help="Central frequency in MHz given to dedisperse.py and "
+             "apply_polcal.py, for --fold_DM and --fold_polcal. Defaults to "
+             "the centre of the coarse channels"
+    )
     parser.add_argument(
         "--ics",
         action="store_true",
@@ -1076,7 +1490,18 @@ def parse_args():
              "frequency axis is not reversed."
     )
 
-    return parser.parse_args()
+    values = parser.parse_args()
+
+    # the first calcfile and outfile are the primary beam's, the rest are
+    # extra beams
+    values.calcfiles = values.calcfile or [None]
+    values.outfiles = values.outfile
+    values.calcfile = values.calcfiles[0]
+    values.outfile = values.outfiles[0]
+    if not values.ics and len(values.outfiles) != len(values.calcfiles):
+        parser.error("Give one --outfile per --calcfile")
+
+    return values
 
 
 def load_sources(calcfile):
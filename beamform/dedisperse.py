@@ -2,12 +2,31 @@ from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
 
 import numpy as np
 
+# This value of k_DM is not the most precise available. It is used
+# because to alter the commonly-used value would make pulsar timing
+# very difficult. Also, to quote Hobbs, Edwards, and Manchester 2006:
+#     ...ions and magnetic fields introduce a rather uncertain
+#     correction of the order of a part in 10^5 (Spitzer 1962),
+#     comparable to the uncertainty in some measured DM values...
+K_DM = 2.41e-4
+
+# Number of channels dedispersed at a time by dedisperse_blocks
+DEFAULT_BLOCK = 2**22
+
 
 def _main():
     args = get_args()
-    spec = np.load(args.f)
-    dedispersed_spec = dedisperse(spec, args.DM, args.f0, args.bw)
-    np.save(args.o, dedispersed_spec)
+    spec = np.load(args.f, mmap_mode="r")
+    # summed beamformer output still has its (nint, nchan, npol) shape
+    if spec.ndim == 3:
+        spec = spec[0, :, 0]
+
+    fname = args.o if args.o.endswith(".npy") else args.o + ".npy"
+    out = np.lib.format.open_memmap(
+        fname, mode="w+", dtype=np.complex64, shape=spec.shape
+    )
+    dedisperse_blocks(spec, args.DM, args.f0, args.bw, out=out, block=args.block)
+    out.flush()
 
 
 def get_args() -> ArgumentParser:
@@ -35,14 +54,23 @@ def get_args() -> ArgumentParser:
     parser.add_argument(
         "-o", help="Output file to save dedispersed spectrum to"
     )
+    parser.add_argument(
+        "--block",
+        type=int,
+        help="Number of channels dedispersed at a time",
+        default=DEFAULT_BLOCK,
+    )
     return parser.parse_args()
 
 
-def get_freqs(f0: float, bw: float, nchan: int) -> np.ndarray:
+def get_freqs(
+    f0: float, bw: float, nchan: int, i0: int = 0, i1: int = None
+) -> np.ndarray:
     """Create array of frequencies.
 
     The returned array is the central frequency of `nchan` channels
-    centred on `f0` with a bandwidth of `bw`.
+    centred on `f0` with a bandwidth of `bw`, or of channels `i0` to `i1`
+    of them if given.
 
     :param f0: Central frequency (arb. units, must be same as `bw`)
     :type f0: float
@@ -50,20 +78,83 @@ def get_freqs(f0: float, bw: float, nchan: int) -> np.ndarray:
     :type bw: float
     :param nchan: Number of channels
     :type nchan: int
+    :param i0: First channel to return
+    :type i0: int, optional
+    :param i1: Channel to stop at, defaults to `nchan`
+    :type i1: int, optional
     :return: Central frequencies of `nchan` channels centred on `f0`
         over a bandwidth `bw`
     :rtype: :class:`np.ndarray`
     """
-    fmin = f0 - bw / 2
+    if i1 is None:
+        i1 = nchan
+
     fmax = f0 + bw / 2
 
     chan_width = bw / nchan
 
-    freqs = np.linspace(fmax, fmin, nchan, endpoint=False) + chan_width / 2
+    freqs = fmax + chan_width / 2 - np.arange(i0, i1) * chan_width
 
     return freqs
 
 
+def dedisp_phases(
+    DM: float, f0: float, bw: float, nchan: int, i0: int = 0, i1: int = None
+) -> np.ndarray:
+    """Coherent dedispersion phasors of channels `i0` to `i1` of a spectrum.
+
+    These are what :func:`dedisperse` multiplies the spectrum by, so a
+    spectrum can be dedispersed a block of channels at a time, or the
+    phasors folded into an earlier stage.
+
+    :param DM: Dispersion measure to dedisperse to (pc/cm3)
+    :type DM: float
+    :param f0: Central frequency of the spectrum (MHz)
+    :type f0: float
+    :param bw: Bandwidth of the spectrum (MHz)
+    :type bw: float
+    :param nchan: Number of channels in the whole spectrum
+    :type nchan: int
+    :param i0: First channel
+    :type i0: int, optional
+    :param i1: Channel to stop at, defaults to `nchan`
+    :type i1: int, optional
+    :return: Complex128 phasors of channels `i0` to `i1`
+    :rtype: :class:`np.ndarray`
+    """
+    return np.exp(2j * np.pi * DM * dedisp_turns(f0, bw, nchan, i0, i1))
+
+
+def dedisp_turns(
+    f0: float, bw: float, nchan: int, i0: int = 0, i1: int = None
+) -> np.ndarray:
+    """Coherent dedispersion phase of channels `i0` to `i1` per unit DM.
+
+    The dedispersion phase is linear in DM, so trials at many DMs can
+    share this and each only needs to multiply it by their DM.
+
+    :param f0: Central frequency of the spectrum (MHz)
+    :type f0: float
+    :param bw: Bandwidth of the spectrum (MHz)
+    :type bw: float
+    :param nchan: Number of channels in the whole spectrum
+    :type nchan: int
+    :param i0: First channel
+    :type i0: int, optional
+    :param i1: Channel to stop at, defaults to `nchan`
+    :type i1: int, optional
+    :return: Float64 phases in turns per pc/cm3
+    :rtype: :class:`np.ndarray`
+    """
+    freqs = get_freqs(f0, bw, nchan, i0, i1)
+
+    # reference to the lowest frequency of the whole spectrum, not just of
+    # these channels
+    f_ref = get_freqs(f0, bw, nchan, nchan - 1)[0]
+
+    return (freqs - f_ref) ** 2 / f_ref ** 2 / freqs * 1e6 / K_DM
+
+
 def dedisperse(
     spec: np.ndarray, DM: float, f0: float, bw: float
 ) -> np.ndarray:
@@ -91,27 +182,56 @@ def dedisperse(
     """
     nchan = spec.shape[0]
 
+    spec *= dedisp_phases(DM, f0, bw, nchan)
+
+    return spec
+
+
+def dedisperse_blocks(
+    spec: np.ndarray,
+    DM: float,
+    f0: float,
+    bw: float,
+    out: np.ndarray = None,
+    block: int = DEFAULT_BLOCK,
+) -> np.ndarray:
     """
-    This value of k_DM is not the most precise available. It is used 
-    because to alter the commonly-used value would make pulsar timing 
-    very difficult. Also, to quote Hobbs, Edwards, and Manchester 2006:
-        ...ions and magnetic fields introduce a rather uncertain 
-        correction of the order of a part in 10^5 (Spitzer 1962), 
-        comparable to the uncertainty in some measured DM values...
-    """
-    k_DM = 2.41e-4
+    Coherently dedisperse a spectrum a block of channels at a time.
 
-    freqs = get_freqs(f0, bw, nchan)
+    The result is the same as :func:`dedisperse`, but rather than making
+    the chirp for the whole spectrum at once, it is made `block` channels
+    at a time. Each block's phases are computed in float64, for accuracy
+    at high DMs, and applied in complex64. Memory use beyond `spec` and
+    `out` is then a few times `block`, so both can be memory maps of
+    spectra larger than memory.
 
-    f_ref = np.min(freqs)
+    :param spec: Complex 1D-spectrum in a single polarisation
+    :type spec: :class:`np.ndarray`
+    :param DM: Dispersion measure to dedisperse to (pc/cm3)
+    :type DM: float
+    :param f0: Central frequency of the spectrum (MHz)
+    :type f0: float
+    :param bw: Bandwidth of the spectrum (MHz)
+    :type bw: float
+    :param out: Complex64 array to write the dedispersed spectrum to,
+        which may be `spec` itself. A new array is made if not given.
+    :type out: :class:`np.ndarray`, optional
+    :param block: Number of channels dedispersed at a time
+    :type block: int, optional
+    :return: Coherently dedispersed complex spectrum (`out` if given)
+    :rtype: :class:`np.ndarray`
+    """
+    nchan = spec.shape[0]
 
-    dedisp_phases = np.exp(
-        2j * np.pi * DM / k_DM * ((freqs - f_ref) ** 2 / f_ref ** 2 / freqs * 1e6)
-    )
+    if out is None:
+        out = np.empty(nchan, dtype=np.complex64)
 
-    spec *= dedisp_phases
+    for i0 in range(0, nchan, block):
+        i1 = min(i0 + block, nchan)
+        phases = dedisp_phases(DM, f0, bw, nchan, i0, i1).astype(np.complex64)
+        np.multiply(spec[i0:i1], phases, out=out[i0:i1], casting="unsafe")
 
-    return spec
+    return out
 
 
 if __name__ == "__main__":
@@ -4,6 +4,8 @@ from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser, Namespace
 import numpy as np
 from joblib import Parallel, delayed
 
+from stage_metrics import configure as configure_metrics, stage
+
 
 ########################################################################
 ########################################################################
@@ -26,9 +28,15 @@ from joblib import Parallel, delayed
 def _main():
     start = time.time()
     args = get_args()
-    sum_f = np.load(args.f)
-    sum_f_deripple = deripple(sum_f, args.coeffs, args.l, args.bw, args.cpus)
-    np.save(args.o, sum_f_deripple)
+    configure_metrics(args.metrics)
+    with stage("load"):
+        sum_f = np.load(args.f)
+    with stage("deripple", nchan=sum_f.size):
+        sum_f_deripple = deripple(
+            sum_f, args.coeffs, args.l, args.bw, args.cpus
+        )
+    with stage("save"):
+        np.save(args.o, sum_f_deripple)
     end = time.time()
     print(f"deripple.py finished in {end-start} s")
 
@@ -55,6 +63,9 @@ def get_args() -> Namespace:
     parser.add_argument(
         "--cpus", type=int, help="Number of cpus to parallelise across", default=1
     )
+    parser.add_argument(
+        "--metrics", help="JSON lines file to append stage metrics to"
+    )
     return parser.parse_args()
 
 
@@ -90,35 +101,15 @@ def deripple(
     # buffer in samples / bw in MHz
     nfine = FFFF.size // bw
 
-    # passbandLength is nfine/2 samples, however, whether nfine is odd or even, will change how
-    # we create the deripple coeff array.
-    isdiv2 = False
-    if nfine % 2 == 0:
-        passbandLength = nfine // 2
-        isdiv2 = True
-
-    else:   # if not divisible by two, extend passbandlength by one and truncat mid point when concatenating
-        passbandLength = (nfine // 2) + 1
-    
-    print("Interpolating...")
-    interp_x = np.interp(np.arange(passbandLength),6*np.arange(coeffs.size),coeffs)
-
-
-    print("Calculating deripple...")
-    deripple = np.ones(passbandLength) / np.abs(interp_x)
-
     #PRINT SOME INFOMATION
     print("FFT LENGTH (oversamp): {:d}".format(fftLength))
-    print("PASS BAND LENGTH: {:d}".format(passbandLength))
+    print("PASS BAND LENGTH: {:d}".format(passband_length(nfine)))
     print("BAND WIDTH (MHz): {:d}".format(bw))
 
-    print("derippling....")
-    
-    if isdiv2: # can simply mirror [deripple] to make coeffs array
-        deripple = np.concatenate((deripple[::-1],deripple), axis = 0)
-    else:   # truncate end sample 
-        deripple = np.concatenate((deripple[:0:-1], deripple), axis = 0)
+    print("Calculating deripple...")
+    deripple = deripple_gains(coeffs, nfine)
 
+    print("derippling....")
     print(f"number of samples per coarse channel: {nfine}")
     print(f"interpolated deripple coeff sample number: {deripple.size}")
 
@@ -132,5 +123,45 @@ def deripple(
     #redo reshapping, make single fine spectrum
     return FFFF.flatten()
 
+
+def passband_length(nfine: int) -> int:
+    """Number of deripple coefficients needed for one half of a coarse
+    channel of `nfine` fine channels
+
+    :param nfine: Number of fine channels in a coarse channel
+    :type nfine: int
+    :rtype: int
+    """
+    # passbandLength is nfine/2 samples, however, whether nfine is odd or even, will change how
+    # we create the deripple coeff array.
+    if nfine % 2 == 0:
+        return nfine // 2
+    # if not divisible by two, extend passbandlength by one and truncat mid point when concatenating
+    return (nfine // 2) + 1
+
+
+def deripple_gains(coeffs: np.ndarray, nfine: int) -> np.ndarray:
+    """Derippling gain of every fine channel in a coarse channel.
+
+    :param coeffs: Derippling coefficients, i.e. the magnitude of the PFB
+        filter response, with 6 fine channels between coefficients
+    :type coeffs: :class:`np.ndarray`
+    :param nfine: Number of fine channels in a coarse channel
+    :type nfine: int
+    :return: Gains to multiply each coarse channel's fine channels by
+    :rtype: :class:`np.ndarray`
+    """
+    passbandLength = passband_length(nfine)
+
+    interp_x = np.interp(np.arange(passbandLength),6*np.arange(coeffs.size),coeffs)
+
+    deripple = np.ones(passbandLength) / np.abs(interp_x)
+
+    if nfine % 2 == 0: # can simply mirror [deripple] to make coeffs array
+        return np.concatenate((deripple[::-1],deripple), axis = 0)
+    else:   # truncate end sample 
+        return np.concatenate((deripple[:0:-1], deripple), axis = 0)
+
+
 if __name__ == "__main__":
     _main()
@@ -0,0 +1,193 @@
+"""
+Content-addressed cache of deripple coefficients.
+
+The deripple coefficients for a crop only depend on the PFB filter and
+the FFT length, but ``generate_deripple.py`` used to zero-pad the filter
+to ~256 times the FFT length and FFT the lot for every FRB, through
+scratch files. deripple.py then only interpolates the first
+passbandLength / 6 or so of them.
+
+:func:`get_coeffs` evaluates the filter response at just those
+frequencies (:func:`deripple_coeffs`) and keeps the
+result in a cache directory, keyed by a hash of the filter file's
+contents and the FFT length, so an FFT length that has been seen before
+costs a file read. The cache directory is ``$CELEBI_DERIPPLE_CACHE`` if
+set, otherwise ``.deripple_cache`` in the working directory. The filter
+usually sits in a read-only container, so the cache is never kept next to
+it, and if the cache directory cannot be written the coefficients are
+just evaluated without caching them.
+"""
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+from scipy import io
+from scipy.signal import czt
+
+# bump if the contents of the cache change
+CACHE_VERSION = 1
+CACHE_ENV = "CELEBI_DERIPPLE_CACHE"
+
+# Number of taps in the PFB prototype filter
+N = 1536
+# Number of fine channels between deripple coefficients
+RES = 6
+# Oversampling ratio of the PFB
+OS_DE = 27.0
+OS_NU = 32.0
+
+
+def load_filter(fname):
+    """Load the PFB prototype filter taps from a .mat file
+
+    :param fname: Filter file (ADE_R6_OSFIR.mat)
+    :type fname: str
+    :rtype: :class:`np.ndarray`
+    """
+    return io.loadmat(fname)["c"][0]
+
+
+def response_length(nfft):
+    """Length of the filter's FFT that the coefficients are bins of
+
+    i.e. the response is evaluated at multiples of 1 / response_length
+    cycles per sample, as when ``generate_deripple.py`` zero-padded the
+    filter to this length.
+
+    :param nfft: FFT length (number of samples in the crop)
+    :type nfft: int
+    :rtype: int
+    """
+    passbandLength = int(((nfft / 2) * OS_DE) / OS_NU)
+    multiple = int(N / RES)
+    return multiple * passbandLength * 2
+
+
+def deripple_coeffs(h, nfft, ncoeffs):
+    """The first ncoeffs deripple coefficients for an FFT length.
+
+    These are the magnitudes of the first ncoeffs bins of the FFT of the
+    filter zero-padded to :func:`response_length`, evaluated with a
+    chirp-z transform of the filter taps, i.e. O(taps + ncoeffs) work and
+    memory rather than O(response_length).
+
+    :param h: Filter taps
+    :type h: :class:`np.ndarray`
+    :param nfft: FFT length (number of samples in the crop)
+    :type nfft: int
+    :param ncoeffs: Number of coefficients, see :func:`num_coeffs`
+    :type ncoeffs: int
+    :rtype: :class:`np.ndarray`
+    """
+    n = response_length(nfft)
+    return np.abs(czt(h, m=ncoeffs, w=np.exp(-2j * np.pi / n)))
+
+
+def filter_hash(filter_fname):
+    """Hash the contents of a filter file
+
+    :return: Hex digest of the file's contents
+    :rtype: str
+    """
+    h = hashlib.sha256(f"deripple_cache v{CACHE_VERSION}".encode())
+    with open(filter_fname, "rb") as fl:
+        h.update(fl.read())
+    return h.hexdigest()
+
+
+def num_coeffs(nfft):
+    """Number of coefficients deripple.py uses for an FFT length
+
+    :rtype: int
+    """
+    passbandLength = int(((nfft / 2) * OS_DE) / OS_NU)
+    # deripple.py interpolates up to fine channel passbandLength (+ 1 for
+    # an odd number of fine channels) with RES fine channels between
+    # coefficients
+    return passbandLength // RES + 2
+
+
+def default_cache_dir():
+    """$CELEBI_DERIPPLE_CACHE, or .deripple_cache in the working directory
+
+    :rtype: str
+    """
+    return os.environ.get(CACHE_ENV, ".deripple_cache")
+
+
+def cache_fname(filter_fname, nfft, cache_dir=None):
+    """Cached coefficients file for an FFT length
+
+    :param filter_fname: PFB filter (ADE_R6_OSFIR.mat)
+    :type filter_fname: str
+    :param nfft: FFT length (number of samples in the crop)
+    :type nfft: int
+    :param cache_dir: Cache directory, see :func:`default_cache_dir`
+    :type cache_dir: str, optional
+    :return: ``.npy`` file, which may not exist yet, or None if it doesn't
+        exist and the cache directory cannot be written
+    :rtype: str or None
+    """
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+
+    fname = os.path.join(
+        cache_dir, f"deripple_{filter_hash(filter_fname)[:16]}_nfft{nfft}.npy"
+    )
+    if os.path.exists(fname):
+        return fname
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError:
+        pass
+    if not os.access(cache_dir, os.W_OK | os.X_OK):
+        print(f"WARNING: cannot write to {cache_dir}, not caching coefficients")
+        return None
+    return fname
+
+
+def save_coeffs(coeffs, fname):
+    """Save coefficients to the cache
+
+    They are written to a temporary file and renamed, so concurrent jobs
+    never see a partial file.
+
+    :return: Whether they were saved
+    :rtype: bool
+    """
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fname), suffix=".npy")
+        with os.fdopen(fd, "wb") as fl:
+            np.save(fl, coeffs)
+        os.replace(tmp, fname)
+    except OSError as e:
+        print(f"WARNING: could not cache deripple coefficients: {e}")
+        return False
+    print(f"Saved deripple coefficients to {fname}")
+    return True
+
+
+def get_coeffs(filter_fname, nfft, cache_dir=None):
+    """Deripple coefficients for an FFT length, from the cache if possible
+
+    :param filter_fname: PFB filter (ADE_R6_OSFIR.mat)
+    :type filter_fname: str
+    :param nfft: FFT length (number of samples in the crop)
+    :type nfft: int
+    :param cache_dir: Cache directory, see :func:`default_cache_dir`
+    :type cache_dir: str, optional
+    :return: The first :func:`num_coeffs` deripple coefficients
+    :rtype: :class:`np.ndarray`
+    """
+    fname = cache_fname(filter_fname, nfft, cache_dir=cache_dir)
+    if fname is not None and os.path.exists(fname):
+        print(f"Using cached deripple coefficients {fname}")
+        return np.load(fname)
+
+    print(f"Evaluating deripple coefficients for nfft = {nfft}")
+    coeffs = deripple_coeffs(load_filter(filter_fname), nfft, num_coeffs(nfft))
+    if fname is not None:
+        save_coeffs(coeffs, fname)
+    return coeffs
@@ -0,0 +1,126 @@
+"""
+Plan FFT lengths for the beamformer's fine channelisation.
+
+A crop of ``nsamp`` samples per coarse channel is fine channelised with
+an ``nsamp`` point FFT per coarse channel, and the stitched spectrum of
+``nfine * bw`` channels is later inverse FFT'd in one go. ``nsamp`` must
+be a multiple of 64 so that ``nfine = 27/32 * nsamp`` and the guard band
+``5/64 * nsamp`` are whole numbers, i.e. ``nsamp = 64 m`` and
+``nfine * bw = 54 m bw``. Both transforms are fast when ``m`` and ``bw``
+are smooth over a small set of primes, so valid lengths are enumerated
+directly from the smooth-number lattice instead of stepping ``nsamp``
+one sample at a time.
+"""
+import numpy as np
+
+# Primes scipy.fft.next_fast_len allows, which the crop length has always
+# been smooth over. (2, 3, 5, 7) avoids the slower radix-11 passes.
+DEFAULT_PRIMES = (2, 3, 5, 7, 11)
+
+# Relative cost per element of one radix-p pass, scaled by log2(p) so a
+# radix-4 pass costs the same as two radix-2 passes. These are ballpark
+# figures for pocketfft; larger radices do more work per element.
+RADIX_COST = {2: 1.0, 3: 1.05, 5: 1.1, 7: 1.25, 11: 1.5, 13: 1.6}
+
+
+def factorise(n, primes):
+    """Factorise n over the given primes
+
+    :return: Exponent of each prime, and the part of n left over
+    :rtype: tuple(dict, int)
+    """
+    exps = {}
+    for p in primes:
+        exps[p] = 0
+        while n % p == 0:
+            n //= p
+            exps[p] += 1
+    return exps, n
+
+
+def smooth_numbers(hi, primes=DEFAULT_PRIMES):
+    """All numbers up to hi whose prime factors are all in primes
+
+    :return: Sorted smooth numbers from 1 to hi
+    :rtype: list[int]
+    """
+    nums = [1]
+    for p in primes:
+        new = []
+        for n in nums:
+            n *= p
+            while n <= hi:
+                new.append(n)
+                n *= p
+        nums += new
+    return sorted(nums)
+
+
+def fft_cost(n, primes=DEFAULT_PRIMES):
+    """Predicted relative cost of an n point FFT, n being smooth
+
+    :return: Predicted cost in arbitrary units
+    :rtype: float
+    """
+    exps, rem = factorise(n, primes)
+    if rem != 1:
+        # falls back to Bluestein's algorithm, several times slower
+        return 6 * n * np.log2(2 * n)
+    return n * sum(
+        k * np.log2(p) * RADIX_COST.get(p, p / 4) for p, k in exps.items()
+    )
+
+
+def crop_cost(m, bw, primes=DEFAULT_PRIMES):
+    """Predicted cost of fine channelising and inverting a crop of 64 m
+    samples in each of bw coarse channels
+    """
+    return bw * fft_cost(64 * m, primes) + fft_cost(54 * m * bw, primes)
+
+
+def plan_fftlen(nsamp, bw, primes=DEFAULT_PRIMES, max_pad=0.0, larger=True):
+    """Find a crop length that makes the FFTs fast.
+
+    With ``larger=True`` the returned length is at least ``nsamp``, and is
+    the length with the lowest predicted cost (see :func:`crop_cost`) out
+    of those no more than ``max_pad`` (fractionally) longer than the
+    shortest valid length. With ``larger=False`` it is the longest valid
+    length no longer than ``nsamp``.
+
+    :param nsamp: Number of samples per coarse channel required
+    :type nsamp: int
+    :param bw: Bandwidth in MHz, i.e. number of coarse channels
+    :type bw: int
+    :param primes: Primes the FFT lengths may be factorised over. Must
+        include 2 and 3.
+    :type primes: tuple(int), optional
+    :param max_pad: Fraction the crop may be lengthened beyond the
+        shortest valid length to reach a cheaper FFT length
+    :type max_pad: float, optional
+    :param larger: Whether to search above or below nsamp
+    :type larger: bool, optional
+    :return: Number of samples, number of fine channels and number of
+        guard channels on each side, per coarse channel
+    :rtype: tuple(int, int, int)
+    """
+    assert 2 in primes and 3 in primes, "primes must include 2 and 3"
+    _, rem = factorise(int(bw), primes)
+    if rem != 1:
+        raise ValueError(
+            f"Bandwidth {bw} MHz is not smooth over primes {primes}"
+        )
+
+    if larger:
+        m0 = max(1, -(-nsamp // 64))
+        hi = max(2 * m0, int(m0 * (1 + max_pad)))
+        cands = [m for m in smooth_numbers(hi, primes) if m >= m0]
+        mmax = max(cands[0], int(m0 * (1 + max_pad)))
+        cands = [m for m in cands if m <= mmax]
+        m = min(cands, key=lambda m: crop_cost(m, bw, primes))
+    else:
+        m0 = nsamp // 64
+        if m0 < 1:
+            raise ValueError(f"No valid FFT length below {nsamp} samples")
+        m = smooth_numbers(m0, primes)[-1]
+
+    return 64 * m, 54 * m, 5 * m
@@ -0,0 +1,120 @@
+"""
+Per fine channel gains of the stages after beamforming, folded into it.
+
+Derippling, coherent dedispersion and the pol cal X delay/phase all
+multiply each channel of the summed fine spectrum by a fixed complex
+gain. Because the sum over antennas is linear, multiplying every
+antenna's spectrum by the same gains in the beamformer gives the same
+result. :class:`FoldedGains` makes them for a group of coarse channels
+at a time, for :class:`tab_engine.TabEngine` to multiply into its
+calibration phasor, so the summed spectrum comes out ready to inverse
+FFT without ``deripple.py`` and ``dedisperse.py`` passes over the whole
+array.
+
+The gains are evaluated on the stitched fine spectrum exactly as those
+scripts index it, i.e. channel ``c * nfine + j`` for fine channel ``j``
+of coarse channel ``c``.
+"""
+from functools import lru_cache
+
+import numpy as np
+
+from apply_polcal import delay_phases
+from dedisperse import dedisp_phases
+from deripple import deripple_gains
+from deripple_cache import get_coeffs
+
+
+@lru_cache(maxsize=8)
+def filter_deripple_gains(filter_fname, nfft, nfine):
+    """Derippling gains of the fine channels of a coarse channel
+
+    :param filter_fname: PFB filter (ADE_R6_OSFIR.mat)
+    :type filter_fname: str
+    :param nfft: Number of samples in the crop
+    :type nfft: int
+    :param nfine: Number of fine channels in a coarse channel
+    :type nfine: int
+    :return: Gain of each fine channel
+    :rtype: :class:`np.ndarray`
+    """
+    return deripple_gains(get_coeffs(filter_fname, nfft), nfine)
+
+
+class FoldedGains:
+    """Complex gains of the post-beamforming stages.
+
+    :param nchan: Number of coarse channels
+    :type nchan: int
+    :param nfine: Number of fine channels in a coarse channel
+    :type nfine: int
+    :param deripple: Derippling gain of each fine channel in a coarse
+        channel, e.g. from :func:`filter_deripple_gains`. Not derippled if
+        not given.
+    :type deripple: :class:`np.ndarray`, optional
+    :param DM: Dispersion measure to coherently dedisperse to (pc/cm3).
+        Not dedispersed if not given.
+    :type DM: float, optional
+    :param polcal: Pol cal solutions from :func:`apply_polcal.load_soln`
+        whose delay and phase are applied. Only give these for X.
+    :type polcal: object, optional
+    :param f0: Central frequency of the spectrum (MHz), as given to
+        ``dedisperse.py`` and ``apply_polcal.py``
+    :type f0: float, optional
+    :param bw: Bandwidth of the spectrum (MHz), defaults to nchan
+    :type bw: float, optional
+    """
+
+    def __init__(
+        self, nchan, nfine, deripple=None, DM=None, polcal=None, f0=None,
+        bw=None,
+    ):
+        if (DM is not None or polcal is not None) and f0 is None:
+            raise ValueError("f0 is needed to fold dedispersion or pol cal")
+
+        self.nchan = nchan
+        self.nfine = nfine
+        self.deripple = deripple
+        self.DM = DM
+        self.polcal = polcal
+        self.f0 = f0
+        self.bw = float(nchan if bw is None else bw)
+
+    def __bool__(self):
+        return (
+            self.deripple is not None
+            or self.DM is not None
+            or self.polcal is not None
+        )
+
+    @property
+    def key(self):
+        """Description of the gains, for checkpoint keys"""
+        s = f"deripple={self.deripple is not None} DM={self.DM} f0={self.f0}"
+        if self.polcal is not None:
+            s += f" tau={self.polcal.tau} phi={self.polcal.phi}"
+        return s
+
+    def __call__(self, c0, c1):
+        """Gains of coarse channels c0 to c1
+
+        :return: Gains with shape ``(c1 - c0, nfine)``
+        :rtype: :class:`np.ndarray`
+        """
+        ntotal = self.nchan * self.nfine
+        i0, i1 = c0 * self.nfine, c1 * self.nfine
+
+        gain = np.ones(i1 - i0, dtype=np.complex128)
+        if self.DM is not None:
+            gain *= dedisp_phases(self.DM, self.f0, self.bw, ntotal, i0, i1)
+        if self.polcal is not None:
+            gain *= delay_phases(
+                self.polcal, self.f0 - self.bw / 2, self.f0 + self.bw / 2,
+                ntotal, i0, i1,
+            )
+
+        gain = gain.reshape(c1 - c0, self.nfine)
+        if self.deripple is not None:
+            gain *= self.deripple
+
+        return gain
@@ -0,0 +1,122 @@
+"""
+Fringe rotation phasors for a geometric delay that is linear in time.
+
+Over a crop the geometric delay of sample ``k`` is ``d0 + step * k``, so
+the fringe rotation of a coarse channel at ``f`` MHz is the pure chirp
+
+    exp(2 pi i f (d0 + step * k))
+
+Rather than evaluating ``exp`` for every sample of every channel,
+:class:`FringeRotator` splits the samples into blocks of ``L``. Each
+phasor is the product of an exact phasor at the start of its block and
+an exact phasor for its offset into the block, i.e. a complex recurrence
+that is resynchronised exactly at every block boundary. That needs
+``nsamp / L + L`` complex exponentials per channel instead of ``nsamp``.
+
+Phase error: both factors are evaluated in float64 with the number of
+turns reduced modulo 1 before multiplying by 2 pi, then rounded to
+complex64, so each has a phase error of at most ~2**-24 rad. Their
+product therefore has a phase error below 3 * 2**-24 ~ 1.8e-7 rad (and
+an amplitude error of the same order), independent of the crop length
+and of the size of the delay. Evaluating ``exp`` directly in complex64,
+as was done previously, has a phase error proportional to the number of
+turns, which reaches ~1e-2 rad for the ~10 us delays of long baselines.
+"""
+import numpy as np
+
+
+class FringeRotator:
+    """Fringe rotation phasors for a set of coarse channels.
+
+    :param cfreqs: Coarse channel centre frequencies in MHz
+    :type cfreqs: :class:`np.ndarray`
+    :param delay0_us: Delay of the first sample in us
+    :type delay0_us: float
+    :param delay_step_us: Change in delay between consecutive samples in
+        us
+    :type delay_step_us: float
+    :param nsamp: Number of samples
+    :type nsamp: int
+    :param block: Number of samples between exact resynchronisations.
+        Defaults to ~sqrt(nsamp), which minimises the number of complex
+        exponentials evaluated.
+    :type block: int, optional
+    """
+
+    def __init__(self, cfreqs, delay0_us, delay_step_us, nsamp, block=None):
+        self.cfreqs = np.asarray(cfreqs, dtype=float)
+        self.delay0_us = float(delay0_us)
+        self.delay_step_us = float(delay_step_us)
+        self.nsamp = nsamp
+        if block is None:
+            block = max(64, int(np.ceil(np.sqrt(nsamp))))
+        self.block = min(block, nsamp)
+
+    @classmethod
+    def from_delays(cls, cfreqs, geom_delays_us, block=None):
+        """Create a rotator from an array of delays that is linear in time
+
+        :param cfreqs: Coarse channel centre frequencies in MHz
+        :type cfreqs: :class:`np.ndarray`
+        :param geom_delays_us: Delay of every sample in us
+        :type geom_delays_us: :class:`np.ndarray`
+        :return: Fringe rotator reproducing ``geom_delays_us``
+        :rtype: :class:`FringeRotator`
+        """
+        nsamp = len(geom_delays_us)
+        step = (geom_delays_us[-1] - geom_delays_us[0]) / max(nsamp - 1, 1)
+        return cls(cfreqs, geom_delays_us[0], step, nsamp, block=block)
+
+    @property
+    def mean_delay_us(self):
+        return self.delay0_us + self.delay_step_us * (self.nsamp - 1) / 2
+
+    @staticmethod
+    def _phasor(turns):
+        return np.exp(2j * np.pi * np.mod(turns, 1.0)).astype(np.complex64)
+
+    def _blocks(self, c0, c1):
+        """Yield sample slices and their phasors for channels c0 to c1"""
+        cfreqs = self.cfreqs[c0:c1]
+        block = self.block
+
+        # phasor for the offset of each sample into its block
+        offset = self._phasor(
+            np.multiply.outer(cfreqs, self.delay_step_us * np.arange(block))
+        )
+
+        # exact phasor at the start of every block
+        starts = np.arange(0, self.nsamp, block)
+        start = self._phasor(
+            np.multiply.outer(
+                cfreqs, self.delay0_us + self.delay_step_us * starts
+            )
+        )
+
+        for j, s0 in enumerate(starts):
+            s1 = min(s0 + block, self.nsamp)
+            yield slice(s0, s1), start[:, j, None] * offset[:, :s1 - s0]
+
+    def phasors(self, c0, c1):
+        """Fringe rotation phasors for coarse channels c0 to c1
+
+        :return: Phasors with shape ``(c1 - c0, nsamp)``
+        :rtype: :class:`np.ndarray`
+        """
+        out = np.empty((c1 - c0, self.nsamp), dtype=np.complex64)
+        for s, phasor in self._blocks(c0, c1):
+            out[:, s] = phasor
+        return out
+
+    def rotate(self, c0, x):
+        """Multiply voltages by their fringe rotation phasors in place.
+
+        Only one block of phasors is held in memory at a time.
+
+        :param c0: Index of the coarse channel in the first row of ``x``
+        :type c0: int
+        :param x: Voltages with shape ``(nchan_group, nsamp)``
+        :type x: :class:`np.ndarray`
+        """
+        for s, phasor in self._blocks(c0, c0 + x.shape[0]):
+            x[:, s] *= phasor
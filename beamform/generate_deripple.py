@@ -1,47 +1,32 @@
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+
 import numpy as np
-from scipy import fft, io
-import sys
 
-def _main():
-    nfft = int(sys.argv[1])
-    dr = sys.argv[2]    # path to ADE_R6_OSFIR.mat
-    N = 1536
-    res = 6
-    OS_De = 27.0
-    OS_Nu = 32.0
-    h = io.loadmat(dr)["c"][0]
-    print("Loaded data")
-    passbandLength = int(((nfft / 2) * OS_De) / OS_Nu)
-    multiple = int(N / res)
-
-    h_0 = np.zeros(multiple * passbandLength * 2)
-    h_0[: h.shape[0]] = h
-    np.save("h_0.npy", h_0)
-    del h_0
-    h_0 = np.load("h_0.npy", mmap_mode="r")
-
-    # Save memory by computing rfft, then casting it into shape of fft
-    # output
-    temp = rfftout_to_fftout(fft.rfft(h_0, overwrite_x=True))
-    print("rfftd")
-    np.save("temp", temp)
-    del temp
-    temp = np.load("temp.npy", mmap_mode="r")
-    abstemp = np.abs(temp)
-    np.save(f"deripple_res{res}_nfft{nfft}.npy", abstemp)
-
-
-def rfftout_to_fftout(x):
-    """
-    Cast the output of an rfft into the shape it would be if you had done an fft
-    """
-    n = x.shape[0]
-    fftout = np.zeros(2*n-2, dtype=np.complex64)
-    fftout[:n] = x
-    fftout[n:] = np.conjugate(x[1:-1][::-1])
-    return fftout
+from deripple_cache import RES, get_coeffs
 
 
+def _main():
+    args = get_args()
+    coeffs = get_coeffs(args.filter, args.nfft, cache_dir=args.cache_dir)
+    np.save(f"deripple_res{RES}_nfft{args.nfft}.npy", coeffs)
+
+
+def get_args():
+    parser = ArgumentParser(
+        description="Make the deripple coefficients for an FFT length",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("nfft", type=int, help="FFT length")
+    parser.add_argument("filter", help="Path to ADE_R6_OSFIR.mat")
+    parser.add_argument(
+        "--cache_dir",
+        default=None,
+        help="Directory of cached coefficients. Defaults to "
+        "$CELEBI_DERIPPLE_CACHE, or .deripple_cache in the working "
+        "directory",
+    )
+    return parser.parse_args()
+
 
 if __name__ == "__main__":
     _main()
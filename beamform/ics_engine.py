@@ -0,0 +1,65 @@
+"""
+Vectorised incoherent sum (ICS) dynamic spectra.
+
+Each coarse channel is fine channelised with one FFT over the whole
+buffer, the guard channels are trimmed, and an inverse FFT of the
+remaining fine channels gives ~1 us time resolution voltages. Their
+power is then averaged down to 1 ms. Rather than doing this one channel
+at a time and tscrunching with a Python loop, :func:`ics_dynspec` does it
+for groups of channels as 2-D arrays and tscrunches with a reshape and a
+sum over the last axis.
+"""
+import numpy as np
+from scipy import fft
+
+
+def ics_dynspec(rawd, nguard, tav=1000, workers=1, batch=8, out=None):
+    """Make (or add to) a 1 ms ICS dynamic spectrum from coarse voltages.
+
+    :param rawd: Coarse channel voltages with shape ``(nsamp, nchan)``, as
+        read from a vcraft mux
+    :type rawd: :class:`np.ndarray`
+    :param nguard: Number of guard channels trimmed from each side of a
+        coarse channel
+    :type nguard: int
+    :param tav: Number of fine time samples summed into one output
+        sample
+    :type tav: int, optional
+    :param workers: Number of threads used by the FFTs
+    :type workers: int, optional
+    :param batch: Number of coarse channels transformed at once
+    :type batch: int, optional
+    :param out: Dynamic spectrum with shape ``(nchan, nfine // tav)`` to
+        add this antenna's power to. A new one is made if not given.
+    :type out: :class:`np.ndarray`, optional
+    :return: Dynamic spectrum with shape ``(nchan, nfine // tav)``
+    :rtype: :class:`np.ndarray`
+    """
+    nfft, nchan = rawd.shape
+    nfine = nfft - 2 * nguard
+    nsamp = nfine // tav
+
+    if out is None:
+        out = np.zeros((nchan, nsamp))
+
+    # fine channels kept after fftshift and guard trimming, as indices
+    # into the unshifted FFT output
+    keep = (np.arange(nguard, nguard + nfine) - nfft // 2) % nfft
+
+    work = np.empty((batch, nfft), dtype=np.complex64)
+    for c0 in range(0, nchan, batch):
+        c1 = min(c0 + batch, nchan)
+        x = work[:c1 - c0]
+        x[:] = rawd[:, c0:c1].T
+
+        xf = fft.fft(x, axis=1, workers=workers, overwrite_x=True)
+        xt = fft.ifft(xf[:, keep], axis=1, workers=workers, overwrite_x=True)
+
+        power = xt.real**2 + xt.imag**2
+        out[c0:c1] += (
+            power[:, :nsamp * tav].reshape(c1 - c0, nsamp, tav).sum(
+                axis=-1, dtype=np.float64
+            )
+        )
+
+    return out
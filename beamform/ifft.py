@@ -3,13 +3,31 @@ import time
 import numpy as np
 from scipy.fft import ifft
 
+from stage_metrics import configure as configure_metrics, stage
+
+# Number of spectrum samples transformed at a time by window_ifft
+DEFAULT_BLOCK = 2**22
+
 
 def _main():
     start = time.time()
     args = get_args()
-    f = load(args.f)
-    t = do_ifft(f)
-    save(t, args.o)
+    configure_metrics(args.metrics)
+    with stage("load"):
+        f = load(args.f, mmap=args.cand_mjd is not None or args.snoopy)
+    window = get_window(args, f.size)
+    if window is None:
+        with stage("ifft", nchan=f.size):
+            t = do_ifft(f)
+        s0 = 0
+    else:
+        s0, s1 = window
+        with stage("ifft", nchan=f.size, nsamp=s1 - s0):
+            t = window_ifft(f, s0, s1 - s0, block=args.block)
+    if args.start_mjd is not None:
+        save_start_mjd(args, s0)
+    with stage("save"):
+        save(t, args.o)
     end = time.time()
     print(f"ifft.py finished in {end-start} s")
 
@@ -18,16 +36,131 @@ def get_args():
     from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
 
     parser = ArgumentParser(
-        description="Performs ifft on given spectrum to obtain time series"
+        description="Performs ifft on given spectrum to obtain time series",
+        formatter_class=ArgumentDefaultsHelpFormatter,
     )
     parser.add_argument("-f", help="Spectrum file to ifft")
     parser.add_argument("-o", help="Output file to save time series to")
+    parser.add_argument(
+        "--metrics", help="JSON lines file to append stage metrics to"
+    )
+    parser.add_argument(
+        "--cand_mjd",
+        type=float,
+        help="MJD of the burst. If this or --snoopy is given, only the "
+        "samples within --margin_ms of it are produced. This shrinks the "
+        "output and the memory needed, but is not much faster than the "
+        "full IFFT, since the whole spectrum is still transformed",
+    )
+    parser.add_argument(
+        "--snoopy", help="Snoopy candidate file to take the burst MJD from"
+    )
+    parser.add_argument(
+        "--start_mjd",
+        help="MJD of the first sample of the time series, or a file "
+        "containing it (e.g. bform_start_MJD.txt). Needed for a window. "
+        "The MJD of the first sample produced is written to "
+        "<output>_start_MJD.txt",
+    )
+    parser.add_argument(
+        "--margin_ms",
+        type=float,
+        default=50.0,
+        help="Half-width of the window around the burst in ms",
+    )
+    parser.add_argument(
+        "--bw", type=float, default=336, help="Bandwidth of observation in MHz"
+    )
+    parser.add_argument(
+        "--block",
+        type=int,
+        default=DEFAULT_BLOCK,
+        help="Number of spectrum samples transformed at a time when "
+        "windowing",
+    )
     return parser.parse_args()
 
 
-def load(fname):
+def load(fname, mmap=False):
     print(f"Loading {fname}")
-    return np.load(fname)
+    f = np.load(fname, mmap_mode="r" if mmap else None)
+    # summed beamformer output (craftcor_tab.py --fold_*) still has its
+    # (nint, nchan, npol) shape, with the same spectrum in every integration
+    if f.ndim == 3:
+        f = f[0, :, 0]
+    return f
+
+
+def snoopy_mjd(snoopy_file):
+    """Burst MJD of the candidate in a snoopy file
+
+    :param snoopy_file: Path to snoopy candidate file
+    :type snoopy_file: str
+    :rtype: float
+    """
+    with open(snoopy_file) as fl:
+        cands = [l.split() for l in fl if len(l) > 1 and l[0] != "#"]
+    if len(cands) != 1:
+        raise ValueError(f"Expected one candidate in {snoopy_file}")
+    return float(cands[0][7])
+
+
+def read_mjd(mjd):
+    """An MJD given either directly or as a file containing it"""
+    try:
+        return float(mjd)
+    except ValueError:
+        with open(mjd) as fl:
+            return float(fl.read().split()[0])
+
+
+def get_window(args, nsamp):
+    """Samples s0 to s1 of the time series to produce, or None for all
+
+    The window is centred on the burst and extends --margin_ms either
+    side, clipped to the time series. Samples are 1 / bw us apart.
+
+    :param nsamp: Number of samples in the time series
+    :type nsamp: int
+    :rtype: tuple(int, int) or None
+    """
+    if args.cand_mjd is None and args.snoopy is None:
+        return None
+    if args.start_mjd is None:
+        raise ValueError("--start_mjd is needed to window the time series")
+
+    cand_mjd = args.cand_mjd if args.cand_mjd is not None else snoopy_mjd(
+        args.snoopy
+    )
+    start_mjd = read_mjd(args.start_mjd)
+
+    # us since the start of the time series, times samples per us
+    centre = (cand_mjd - start_mjd) * 8.64e10 * args.bw
+    margin = args.margin_ms * 1e3 * args.bw
+    s0 = max(int(np.floor(centre - margin)), 0)
+    s1 = min(int(np.ceil(centre + margin)), nsamp)
+    if s1 <= s0:
+        raise ValueError(
+            f"Burst at sample {centre:.0f} is outside the time series "
+            f"(0 to {nsamp})"
+        )
+
+    print(f"Windowing time series to samples {s0} to {s1} of {nsamp}")
+    if s1 - s0 == nsamp:
+        return None
+    return s0, s1
+
+
+def save_start_mjd(args, s0):
+    """Write the MJD of the first sample produced next to the output
+
+    Later stages (make_dynspec.py, plot.py) take this as the start of the
+    time series, which is only the start of the crop without a window.
+    """
+    start_mjd = read_mjd(args.start_mjd) + s0 / args.bw / 8.64e10
+    stem = args.o[:-4] if args.o.endswith(".npy") else args.o
+    with open(f"{stem}_start_MJD.txt", "w") as fl:
+        fl.write(f"{start_mjd:.15f}\n")
 
 
 def do_ifft(f):
@@ -35,6 +168,71 @@ def do_ifft(f):
     return ifft(f)
 
 
+def segment_length(n, nout):
+    """Smallest divisor of n that is at least nout"""
+    for p in range(n // nout, 0, -1):
+        if n % p == 0:
+            return n // p
+    return n
+
+
+def window_ifft(f, s0, nout, block=DEFAULT_BLOCK):
+    """Samples s0 to s0 + nout of ifft(f), without the rest.
+
+    With the spectrum length N = M * P for the smallest M >= nout, the
+    spectrum is split into its P decimated subsequences f[r::P]. Each is
+    inverse transformed with an M point FFT, giving the time series
+    aliased to period M, and the twiddles exp(2 pi i r t / N) of the
+    samples t in the window recombine them, as in the first half of a
+    four-step FFT.
+
+    Only the window and ``block`` samples of the spectrum are held in
+    memory, so f can be memory-mapped, and the output is only as long as
+    the window. It is not much faster than the full IFFT though: every
+    output sample depends on every frequency, so the whole spectrum is
+    still read and transformed, with O(N log M) rather than O(N log N)
+    work.
+
+    :param f: Spectrum
+    :type f: :class:`np.ndarray`
+    :param s0: First sample of the window
+    :type s0: int
+    :param nout: Number of samples in the window
+    :type nout: int
+    :param block: Number of spectrum samples transformed at a time
+    :type block: int, optional
+    :return: Time series in the window
+    :rtype: :class:`np.ndarray`
+    """
+    n = f.size
+    m = segment_length(n, nout)
+    p = n // m
+    print(f"IFFTing samples {s0} to {s0 + nout} ({p} segments of {m})")
+
+    # rows[j, r] = f[j * p + r]
+    rows = f.reshape(m, p)
+    ncols = max(block // m, 1)
+    t = (s0 + np.arange(m, dtype=np.int64)) % n
+    step = np.exp(2j * np.pi * t / n)
+
+    # same dtype as scipy.fft.ifft(f) would give
+    out = np.zeros(m, dtype=np.result_type(f.dtype, np.complex64))
+    for r0 in range(0, p, ncols):
+        r1 = min(r0 + ncols, p)
+        # time series of each subsequence, aliased to period m
+        alias = ifft(np.ascontiguousarray(rows[:, r0:r1].T), axis=1)
+        alias = np.roll(alias, -(s0 % m), axis=1)
+
+        # twiddles exp(2 pi i r t / n), exact at the start of each block
+        twiddle = np.exp(2j * np.pi * ((r0 * t) % n) / n)
+        for sub in alias:
+            out += sub * twiddle
+            twiddle *= step
+
+    out *= m / n
+    return out[:nout]
+
+
 def save(t, fname):
     print(f"Saving {fname}")
     np.save(fname, t)
@@ -17,6 +17,8 @@ from scipy.fft import fft
 from math import ceil
 import matplotlib.pyplot as plt
 
+from stage_metrics import configure as configure_metrics, stage
+
 ## import basic libraries
 import argparse#, sys
 # from os import path, mkdir
@@ -155,6 +157,8 @@ def get_args():
 
     ## output arguments
     parser.add_argument("--ofile", help = "Name of new dynamic spectra", type = str)
+    parser.add_argument("--metrics", help = "JSON lines file to append stage metrics to",
+                        type = str, default = None)
 
     args = parser.parse_args()
 
@@ -522,7 +526,8 @@ def _proc(args, pol):
     for S in "IQUV":
 
         # make dynamic spectra
-        ds = make_ds(pol['X'], pol['Y'], S, args.nFFT)
+        with stage("make_ds", stokes = S, nFFT = args.nFFT):
+            ds = make_ds(pol['X'], pol['Y'], S, args.nFFT)
 
         # remove first channel (zero it)
         ds[0] *= 1e-12
@@ -548,7 +553,8 @@ def _proc(args, pol):
         ## save data
         print(f"Saving stokes {S} dynamic spectra...")
         # np.save(f"{args.ofile}_{S}.npy", ds)
-        np.save(args.ofile.replace("@", S), ds)
+        with stage("save", stokes = S):
+            np.save(args.ofile.replace("@", S), ds)
 
 
 
@@ -558,10 +564,12 @@ if __name__ == "__main__":
 
     ## get args
     args = get_args()
+    configure_metrics(args.metrics)
 
 
     ## load data
-    pol = load_data(args.x ,args.y)
+    with stage("load"):
+        pol = load_data(args.x ,args.y)
 
 
     ## make dynamic spectra
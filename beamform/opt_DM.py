@@ -1,7 +1,12 @@
+import threading
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
-from dedisperse import dedisperse
+from concurrent.futures import ThreadPoolExecutor
+
+from dedisperse import K_DM, dedisp_turns, get_freqs
 import numpy as np
 import matplotlib.pyplot as plt
+from scipy import fft
+from scipy.optimize import minimize_scalar
 
 def _main():
     args = get_args()
@@ -9,18 +14,37 @@ def _main():
     X = np.load(args.x)
     Y = np.load(args.y)
 
-    DMs = np.arange(args.minDM, args.maxDM+args.DMstep, args.DMstep)
+    trials = DMTrials(X, Y, args.f0, args.bw, args.dt, METRICS[args.metric])
 
-    peaks = []
-    for DM in DMs:
-        peaks.append(do_DM(X, Y, DM, args.dt, args.f0, args.bw))
+    if args.search == "grid":
+        DMs = np.arange(args.minDM, args.maxDM+args.DMstep, args.DMstep)
+        peaks = trials.curve(DMs, cpus=args.cpus)
+        best = DMs[np.argmax(peaks)]
+    else:
+        coarse = IncoherentTrials(trials, args.coarse_dt, nsub=args.nsub)
+        best, coarse_DMs, coarse_peaks, DMs, peaks = coarse_to_fine(
+            trials, coarse, args.minDM, args.maxDM, args.DMstep,
+            cpus=args.cpus,
+        )
+        np.savetxt(
+            "opt_DM_coarse_curve.txt",
+            np.column_stack((coarse_DMs+args.DM0, coarse_peaks)),
+            header=f"DM (pc/cm3), {args.metric} at {args.coarse_dt} us",
+        )
+        plt.plot(coarse_DMs+args.DM0, coarse_peaks, alpha=0.5, label="coarse")
     
-    print(DMs[np.argmax(peaks)]+args.DM0)
+    print(best+args.DM0)
+
+    np.savetxt(
+        "opt_DM_curve.txt",
+        np.column_stack((DMs+args.DM0, peaks)),
+        header=f"DM (pc/cm3), {args.metric}",
+    )
 
-    plt.plot(DMs+args.DM0, peaks)
-    plt.axvline(DMs[np.argmax(peaks)]+args.DM0)
+    plt.plot(DMs+args.DM0, peaks, ".-" if args.search != "grid" else "-")
+    plt.axvline(best+args.DM0)
     plt.xlabel("DM (pc/cm3)")
-    plt.ylabel("max(I)")
+    plt.ylabel(METRIC_LABELS[args.metric])
     plt.tight_layout()
     plt.savefig("opt_DM.png")
 
@@ -60,31 +84,307 @@ def get_args():
         default=336,
         help="Bandwidth in MHz"
     )
+    parser.add_argument(
+        "--metric",
+        choices=sorted(METRICS),
+        default="peak",
+        help="What to maximise: the peak of the intensity averaged to dt, "
+             "its S/N, or its structure (sum of squared time derivatives)"
+    )
+    parser.add_argument(
+        "--search",
+        choices=["grid", "coarse_to_fine"],
+        default="grid",
+        help="grid evaluates every DMstep at full resolution. "
+             "coarse_to_fine scans a downsampled dynamic spectrum with "
+             "incoherent dedispersion, then refines the best DM with "
+             "Brent's method at full resolution to within DMstep"
+    )
+    parser.add_argument(
+        "--coarse_dt",
+        type=float,
+        default=10,
+        help="Time resolution of the coarse_to_fine scan in us"
+    )
+    parser.add_argument(
+        "--nsub",
+        type=int,
+        default=1344,
+        help="Number of sub-bands in the coarse_to_fine scan's dynamic "
+             "spectrum"
+    )
+    parser.add_argument(
+        "--cpus",
+        type=int,
+        default=1,
+        help="Number of DM trials to run at once"
+    )
 
     return parser.parse_args()
 
 
 def running_mean(x, N):
     # https://stackoverflow.com/a/27681394
-    cumsum = np.cumsum(np.insert(x, 0, 0)) 
+    cumsum = np.cumsum(np.insert(x, 0, 0), dtype=np.float64)
     return (cumsum[N:] - cumsum[:-N]) / float(N)
 
 
-def do_DM(X, Y, DM, dt, f0, bw):
-    # do fft here because dedispersion operates in-place
-    X_f = np.fft.fft(X)
-    Y_f = np.fft.fft(Y)
+def peak_metric(I, N):
+    """Peak of the intensity averaged over N samples"""
+    return np.max(running_mean(I, N))
+
+
+def snr_metric(I, N):
+    """S/N of the peak of the intensity averaged over N samples, against
+    the median and MAD of the whole averaged time series"""
+    I_red = running_mean(I, N)
+    med = np.median(I_red)
+    std = 1.4826 * np.median(np.abs(I_red - med))
+    return (np.max(I_red) - med) / std
+
+
+def structure_metric(I, N):
+    """Sum of the squared time derivatives of the intensity averaged to
+    blocks of N samples, which is largest when the burst's structure is
+    sharpest"""
+    nblock = I.size // N
+    I_red = I[:nblock * N].reshape(nblock, N).mean(axis=1, dtype=np.float64)
+    return np.sum(np.diff(I_red) ** 2)
+
+
+METRICS = {"peak": peak_metric, "snr": snr_metric, "structure": structure_metric}
+METRIC_LABELS = {"peak": "max(I)", "snr": "S/N", "structure": "sum((dI/dt)^2)"}
+
+
+class DMTrials:
+    """Coherent dedispersion trials of a pair of polarisations.
+
+    The spectra of X and Y and the dedispersion phase per unit DM are
+    computed once. Each trial then scales the phase by its DM, makes the
+    chirp and applies it to the spectra in work buffers that are reused by
+    the thread running it, and inverse FFTs them to evaluate the metric.
+    This takes two inverse FFTs per trial instead of two forward and two
+    inverse FFTs, and trials can run concurrently in a thread pool as the
+    FFTs and ufuncs release the GIL.
+
+    :param X: X complex time series
+    :type X: :class:`np.ndarray`
+    :param Y: Y complex time series
+    :type Y: :class:`np.ndarray`
+    :param f0: Central frequency in MHz
+    :type f0: float
+    :param bw: Bandwidth in MHz
+    :type bw: float
+    :param dt: Time resolution the metric averages to in us
+    :type dt: float
+    :param metric: Function of the intensity and the number of samples to
+        average it over, e.g. :func:`peak_metric`
+    :type metric: callable, optional
+    """
+
+    def __init__(self, X, Y, f0, bw, dt, metric=peak_metric):
+        self.X_f = fft.fft(X)
+        self.Y_f = fft.fft(Y)
+        self.f0 = f0
+        self.bw = bw
+        self.turns = dedisp_turns(f0, bw, X.size)
+        self.navg = int(bw * dt)
+        self.metric = metric
+        self._local = threading.local()
+
+    def _buffers(self):
+        # work buffers of the calling thread
+        buf = getattr(self._local, "buf", None)
+        if buf is None:
+            n = self.turns.size
+            # phases in float64, everything else in the spectra's precision
+            dtype = self.X_f.dtype
+            buf = self._local.buf = (
+                np.empty(n),
+                np.empty(n, dtype=dtype),
+                np.empty(n, dtype=dtype),
+                np.empty(n, dtype=dtype),
+            )
+        return buf
+
+    def dedisperse(self, DM):
+        """X and Y time series dedispersed by DM
+
+        The returned arrays are work buffers, only valid until the calling
+        thread's next trial.
+
+        :rtype: tuple(:class:`np.ndarray`, :class:`np.ndarray`)
+        """
+        phase, chirp, X_dd, Y_dd = self._buffers()
+
+        np.multiply(self.turns, 2 * np.pi * DM, out=phase)
+        np.cos(phase, out=chirp.real)
+        np.sin(phase, out=chirp.imag)
 
-    X_f_dd = dedisperse(X_f, DM, f0, bw)
-    Y_f_dd = dedisperse(Y_f, DM, f0, bw)
+        np.multiply(self.X_f, chirp, out=X_dd)
+        np.multiply(self.Y_f, chirp, out=Y_dd)
 
-    X_dd = np.fft.ifft(X_f_dd)
-    Y_dd = np.fft.ifft(Y_f_dd)
+        X_dd = fft.ifft(X_dd, overwrite_x=True)
+        Y_dd = fft.ifft(Y_dd, overwrite_x=True)
 
-    I = np.abs(X_dd)**2 + np.abs(Y_dd)**2
-    I_red = running_mean(I, 336*dt)
+        return X_dd, Y_dd
 
-    return np.max(I_red)
+    def trial(self, DM):
+        """Metric of the intensity dedispersed by DM
+
+        :rtype: float
+        """
+        X_dd, Y_dd = self.dedisperse(DM)
+        I = X_dd.real**2 + X_dd.imag**2 + Y_dd.real**2 + Y_dd.imag**2
+        return self.metric(I, self.navg)
+
+    def curve(self, DMs, cpus=1):
+        """Metric at every DM
+
+        :param DMs: Trial DMs
+        :type DMs: iterable of float
+        :param cpus: Number of trials run at once
+        :type cpus: int, optional
+        :return: Metric of each trial
+        :rtype: :class:`np.ndarray`
+        """
+        with ThreadPoolExecutor(cpus) as pool:
+            return np.array(list(pool.map(self.trial, DMs)))
+
+
+class IncoherentTrials:
+    """Cheap, approximate DM trials on a downsampled dynamic spectrum.
+
+    The spectra of a :class:`DMTrials` are split into nsub sub-bands and
+    inverse FFT'd into a dynamic spectrum of intensity, which is averaged
+    down to about coarse_dt us. Each trial then just shifts the sub-bands
+    by their dispersion delays (relative to the bottom of the band, as in
+    coherent dedispersion) and sums them, so a trial costs a pass over
+    the small dynamic spectrum rather than two full-length FFTs. Smearing
+    within the sub-bands and rounding of the shifts to whole samples make
+    these approximate, so they are for locating the optimum only.
+
+    :param trials: Coherent trials whose spectra and metric are used
+    :type trials: :class:`DMTrials`
+    :param coarse_dt: Time resolution to average to in us
+    :type coarse_dt: float
+    :param nsub: Number of sub-bands
+    :type nsub: int, optional
+    """
+
+    def __init__(self, trials, coarse_dt, nsub=1344):
+        nchan = trials.X_f.size
+        nfine = nchan // nsub
+        n = nsub * nfine
+        bw = trials.bw
+
+        # lowest channels that don't fill a sub-band are dropped
+        I = np.zeros((nsub, nfine))
+        for spec in (trials.X_f, trials.Y_f):
+            x = fft.ifft(spec[:n].reshape(nsub, nfine), axis=1)
+            I += x.real**2 + x.imag**2
+            del x
+
+        # sub-band time series span the whole crop
+        tsamp = nchan / bw / nfine
+        tav = max(1, int(round(coarse_dt / tsamp)))
+        nsamp = nfine // tav
+        self.I = I[:, :nsamp * tav].reshape(nsub, nsamp, tav).mean(axis=2)
+        self.tsamp = tsamp * tav
+        self.navg = max(1, int(round(trials.navg / bw / self.tsamp)))
+        self.metric = trials.metric
+
+        # dispersion delay of each sub-band relative to the bottom of the
+        # band, per unit DM, in us
+        freqs = get_freqs(trials.f0, bw, nchan)
+        f_ref = freqs[-1]
+        f_sub = freqs[:n].reshape(nsub, nfine).mean(axis=1)
+        self.delay_per_DM = 1e6 / K_DM * (f_ref ** -2 - f_sub ** -2)
+
+    def step(self):
+        """DM step that moves the top of the band by the metric's averaging
+        time
+
+        :rtype: float
+        """
+        return self.navg * self.tsamp / np.max(np.abs(self.delay_per_DM))
+
+    def trial(self, DM):
+        """Metric of the intensity incoherently dedispersed by DM
+
+        :rtype: float
+        """
+        nsamp = self.I.shape[1]
+        shifts = np.round(DM * self.delay_per_DM / self.tsamp).astype(int)
+        I = np.zeros(nsamp)
+        # circular shifts, as in coherent dedispersion
+        for Ik, shift in zip(self.I, shifts % nsamp):
+            I[shift:] += Ik[:nsamp - shift]
+            I[:shift] += Ik[nsamp - shift:]
+        return self.metric(I, self.navg)
+
+    def curve(self, DMs, cpus=1):
+        """Metric at every DM
+
+        :rtype: :class:`np.ndarray`
+        """
+        with ThreadPoolExecutor(cpus) as pool:
+            return np.array(list(pool.map(self.trial, DMs)))
+
+
+def coarse_to_fine(trials, coarse, minDM, maxDM, DMstep, cpus=1):
+    """Find the DM that maximises the metric, coarse to fine.
+
+    The whole DM range is scanned with the incoherent trials, at the DM
+    step that moves the top of the band by the metric's averaging time,
+    i.e. the smallest step the metric can resolve. The metric
+    is then maximised with Brent's method using the full resolution
+    coherent trials, within a coarse step either side of the best coarse
+    DM, to within DMstep.
+
+    :param trials: Full resolution coherent trials
+    :type trials: :class:`DMTrials`
+    :param coarse: Coarse incoherent trials
+    :type coarse: :class:`IncoherentTrials`
+    :param minDM: DM range start
+    :type minDM: float
+    :param maxDM: DM range end
+    :type maxDM: float
+    :param DMstep: Precision to find the DM to
+    :type DMstep: float
+    :param cpus: Number of coarse trials run at once
+    :type cpus: int, optional
+    :return: Best DM, the coarse DMs and their metrics, and the DMs and
+        metrics of every full resolution trial evaluated, in order of DM
+    :rtype: tuple(float, :class:`np.ndarray`, :class:`np.ndarray`,
+        :class:`np.ndarray`, :class:`np.ndarray`)
+    """
+    step = max(coarse.step(), DMstep)
+    coarse_DMs = np.arange(minDM, maxDM + step, step)
+    coarse_curve = coarse.curve(coarse_DMs, cpus=cpus)
+    best = coarse_DMs[np.argmax(coarse_curve)]
+
+    evaluated = {}
+
+    def cost(DM):
+        evaluated[DM] = trials.trial(DM)
+        return -evaluated[DM]
+
+    lo = max(minDM, best - step)
+    hi = min(maxDM, best + step)
+    res = minimize_scalar(
+        cost, bounds=(lo, hi), method="bounded", options={"xatol": DMstep}
+    )
+
+    DMs = np.array(sorted(evaluated))
+    return (
+        res.x, coarse_DMs, coarse_curve,
+        DMs, np.array([evaluated[DM] for DM in DMs]),
+    )
+
+
+def do_DM(X, Y, DM, dt, f0, bw):
+    return DMTrials(X, Y, f0, bw, dt).trial(DM)
 
 
 if __name__ == "__main__":
@@ -26,6 +26,7 @@ class aipscor(object):
         self.scfile = scfile #selfcal.sn.txt'
         self.bpfile = bpfile #bandpass.bp.txt'
         self.specific_frb = specific_frb
+        self._tables = {}
         if fits is not None:
             self.fits = fits
             self.an_dict = self.map_anname_nosta()
@@ -285,6 +286,23 @@ class aipscor(object):
         
         return delay_clock
     
+    def _table(self, fname, antennacolumn):
+        # Each table is read and indexed once, then reused by every getter
+        key = (fname, antennacolumn)
+        if key not in self._tables:
+            self._tables[key] = AipsTable(fname, antennacolumn)
+        return self._tables[key]
+
+    def _find_row(self, table, start, an_ind, by_label=False):
+        # Line number of the first row of the antenna in the column page
+        # headed by start. by_label reproduces the hard-coded row numbers
+        # used for FRB 190608 instead of the row -> antenna mapping.
+        page = table.page(start)
+        if by_label and self.specific_frb == '190608':
+            label = str(an_ind+1) if an_ind < 18 else str(an_ind+3)
+            return page.by_label.get(label)
+        return page.by_antenna.get(str(an_ind+1))
+
     def get_delay_fring(self, an_ind, pol):
         #%% DELAY 3: FRING FINE TIME DELAY
         # delays_fring : fine time delay measured by FRING
@@ -297,31 +315,12 @@ class aipscor(object):
             start = "DELAY 2        RATE 2" # Delay 2
             delay_ind = -2 # delay2 location within a line
         antennacolumn = 4
-        delays_fring = np.nan
 
-        with open(self.fringfile, 'r') as fl:
-            fl.seek(0)
-            rowmap = self.mapRowToAntenna(fl, antennacolumn)
-            fl.seek(0)
-            fl.seek(fl.read().find(start),0)
-
-            bool_record = False
-            data=fl.readline()
-            while (not bool_record) and (len(data.split()) > 0):
-                if self.specific_frb != '190608':
-                    if data.split()[0] in rowmap.keys() and rowmap[data.split()[0]] == str(an_ind+1):
-                        bool_record = True
-                        delays_fring = float(data.split()[delay_ind]) # FRING fine time delay
-                else:
-                    temp = data.split()[0]
-                    if an_ind < 18 and temp == str(an_ind+1):
-                        bool_record = True
-                        delays_fring = float(data.split()[delay_ind]) # FRING fine time delay
-                    elif an_ind >=18 and temp == str(an_ind+3):
-                        bool_record = True
-                        delays_fring = float(data.split()[delay_ind]) # FRING fine time delay
-                data=fl.readline()
-        return delays_fring
+        table = self._table(self.fringfile, antennacolumn)
+        line = self._find_row(table, start, an_ind, by_label=True)
+        if line is None:
+            return np.nan
+        return float(table.tokens(line)[delay_ind]) # FRING fine time delay
     
     def get_delay_polfring(self, an_ind, pol):
         if pol == 'x':
@@ -331,28 +330,13 @@ class aipscor(object):
             start = "DELAY 2        RATE 2" # Delay 2
             delay_ind = -2 # delay2 location within a line
         antennacolumn = 4
-        delays_polfring = np.nan
 
-        with open(self.polfringfile, 'r') as fl:
-            fl.seek(0)
-            rowmap = self.mapRowToAntenna(fl, antennacolumn)
-            fl.seek(0)
-            fl.seek(fl.read().find(start),0)
-
-            bool_record = False
-            data=fl.readline()
-            while not bool_record and len(data.split()) > 0:
-                if data.split()[0] in rowmap.keys() and rowmap[data.split()[0]] == str(an_ind+1):
-                    bool_record = True
-                    if 1:
-                        delays_polfring = float(data.split()[delay_ind]) # Polarization FRING fine time delay
-                        print(("pol delay read from file ",delays_polfring))
-                    else:
-                        if pol == 'y':
-                            delays_polfring = -1.1999699e-09 #-1.122035e-9
-                            print(("pol delay given to ",delays_polfring))
-                    #delays_polfring *= -1
-                data=fl.readline()
+        table = self._table(self.polfringfile, antennacolumn)
+        line = self._find_row(table, start, an_ind)
+        if line is None:
+            return np.nan
+        delays_polfring = float(table.tokens(line)[delay_ind]) # Polarization FRING fine time delay
+        print(("pol delay read from file ",delays_polfring))
         return delays_polfring
     
 
@@ -367,26 +351,17 @@ class aipscor(object):
             start = "REAL2          IMAG2" # Phase 2
             delay_ind = 5 # real2 location within a line
         antennacolumn = 4
-        phase_fring = np.nan + 1j*np.nan
 
-        with open(self.fringfile, 'r') as fl:
-            fl.seek(0)
-            rowmap = self.mapRowToAntenna(fl, antennacolumn)
-            fl.seek(0)
-            fl.seek(fl.read().find(start),0)
-
-            bool_record = False
-            data=fl.readline()
-            while not bool_record and len(data.split()) > 0:
-                if data.split()[0] in rowmap.keys() and rowmap[data.split()[0]] == str(an_ind+1):
-                    bool_record = True
-                    phase_fring_real = float(data.split()[delay_ind]) # FRING real phase
-                    phase_fring_imag = float(data.split()[delay_ind+1]) # FRING imag phase
-
-                data=fl.readline()
-            phase_fring = phase_fring_real + 1j*phase_fring_imag
-            if (abs(phase_fring)-1)>1e-3:
-                print(("WARNING: amplitude of FRING phase is not 1 but "+str(abs(phase_fring))))
+        table = self._table(self.fringfile, antennacolumn)
+        line = self._find_row(table, start, an_ind)
+        if line is None:
+            raise ValueError(f"Antenna {an_ind+1} not found in {self.fringfile}")
+        data = table.tokens(line)
+        phase_fring_real = float(data[delay_ind]) # FRING real phase
+        phase_fring_imag = float(data[delay_ind+1]) # FRING imag phase
+        phase_fring = phase_fring_real + 1j*phase_fring_imag
+        if (abs(phase_fring)-1)>1e-3:
+            print(("WARNING: amplitude of FRING phase is not 1 but "+str(abs(phase_fring))))
         return phase_fring
     
     def get_phase_selfcal(self, an_ind, pol):
@@ -401,40 +376,21 @@ class aipscor(object):
             start = "REAL2          IMAG2" # Phase 2
             delay_ind = 5 # real2 location within a line
         antennacolumn = 4
-        phase_fring = np.nan + 1j*np.nan
 
-        with open(self.scfile, 'r') as fl:
-            fl.seek(0)
-            rowmap = self.mapRowToAntenna(fl, antennacolumn)
-            fl.seek(0)
-            fl.seek(fl.read().find(start),0)
-            
-            bool_record = False
-            data=fl.readline()
-            while not bool_record and len(data.split()) > 0:
-                if self.specific_frb !='190608':
-                    if data.split()[0] in rowmap.keys() and rowmap[data.split()[0]] == str(an_ind+1):
-                        bool_record = True
-                        phase_sc_real = float(data.split()[delay_ind]) # selfcal real phase
-                        phase_sc_imag = float(data.split()[delay_ind+1]) # selfcal imag phase
-                else:
-                    temp = data.split()[0]
-                    if an_ind < 18 and temp == str(an_ind+1):
-                        bool_record = True
-                        phase_sc_real = float(data.split()[delay_ind]) # selfcal real phase
-                        phase_sc_imag = float(data.split()[delay_ind+1]) # selfcal imag phase
-                    elif an_ind >=18 and temp == str(an_ind+3):
-                        bool_record = True
-                        phase_sc_real = float(data.split()[delay_ind]) # selfcal real phase
-                        phase_sc_imag = float(data.split()[delay_ind+1]) # selfcal imag phase
-                data=fl.readline()
-            phase_selfcal = phase_sc_real + 1j*phase_sc_imag
+        table = self._table(self.scfile, antennacolumn)
+        line = self._find_row(table, start, an_ind, by_label=True)
+        if line is None:
+            raise ValueError(f"Antenna {an_ind+1} not found in {self.scfile}")
+        data = table.tokens(line)
+        phase_sc_real = float(data[delay_ind]) # selfcal real phase
+        phase_sc_imag = float(data[delay_ind+1]) # selfcal imag phase
+        phase_selfcal = phase_sc_real + 1j*phase_sc_imag
         return phase_selfcal
-    
-    def get_phase_bandpass(self, an_ind, pol):
-        #%% PHASE 3: BANDPASS PHASE
-        # phase_bandpass : frequency dependent phase
-        # abs_bandpass : frequency dependent amplitude
+
+    def get_bandpass_table(self, pol):
+        #%% PHASE 3: BANDPASS PHASE, ALL ANTENNAS
+        # bandpass : (antenna, channel) array of complex bandpass
+        # solutions. Antennas not in the table are NaN.
 
         if pol == 'x':
             start = "REAL 1         IMAG 1" # x pol
@@ -443,49 +399,98 @@ class aipscor(object):
             start = "REAL 2         IMAG 2" # y pol
             delay_ind = 7 # real2 location within a line
         antennacolumn = 5
-        phase_bandpass = np.nan + 1j*np.nan
-        
-        with open(self.bpfile,'r') as fl:
-            for line in fl:
-                if 'TFDIM11' in line:
-                    nfreq = int(line.split()[2])
-
-        with open(self.bpfile, 'r') as fl:
-            fl.seek(0)
-            rowmap = self.mapRowToAntenna(fl, antennacolumn)
-            fl.seek(0)
-            fl.seek(fl.read().find(start),0)
-
-            bool_record = False
-            phase_bp_real = np.full(nfreq,np.nan)
-            phase_bp_imag = np.full(nfreq,np.nan)
-            data=fl.readline()
-            while (not bool_record) and (len(data.split()) > 0):
-                if self.specific_frb != '190608':  
-                    if data.split()[0] in rowmap.keys() and rowmap[data.split()[0]] == str(an_ind+1):
-                        bool_record = True
-                        for chan in range(nfreq):
-                            phase_bp_real[chan] = float(data.split()[delay_ind]) # bandpass real phase
-                            phase_bp_imag[chan] = float(data.split()[delay_ind+1]) # bandpass imag phase
-                            data = fl.readline()
-                else:
-                    temp = data.split()[0]
-                    if an_ind < 18 and temp == str(an_ind+1):
-                        bool_record = True
-                        for chan in range(nfreq):
-                            phase_bp_real[chan] = float(data.split()[delay_ind]) # bandpass real phase
-                            phase_bp_imag[chan] = float(data.split()[delay_ind+1]) # bandpass imag phase
-                            data = fl.readline()
-                    elif an_ind >=18 and temp == str(an_ind+3):
-                        bool_record = True
-                        for chan in range(nfreq):
-                            phase_bp_real[chan] = float(data.split()[delay_ind]) # bandpass real phase
-                            phase_bp_imag[chan] = float(data.split()[delay_ind+1]) # bandpass imag phase
-                            data = fl.readline()
-                data=fl.readline()
-
-            phase_bandpass = phase_bp_real + 1j*phase_bp_imag
-        return phase_bandpass
 
+        table = self._table(self.bpfile, antennacolumn)
+        key = (start, self.specific_frb)
+        if key not in table.arrays:
+            nfreq = table.nfreq
+            bandpass = np.full((36, nfreq), np.nan + 1j*np.nan)
+            for an_ind in range(36):
+                line = self._find_row(table, start, an_ind, by_label=True)
+                if line is None:
+                    continue
+                # each channel is on its own line, starting at the
+                # antenna's first row
+                values = np.array(
+                    [table.tokens(line+chan)[delay_ind:delay_ind+2] for chan in range(nfreq)],
+                    dtype=float,
+                )
+                bandpass[an_ind] = values[:, 0] + 1j*values[:, 1]
+            table.arrays[key] = bandpass
+        return table.arrays[key]
+    
+    def get_phase_bandpass(self, an_ind, pol):
+        #%% PHASE 3: BANDPASS PHASE
+        # phase_bandpass : frequency dependent phase
+        # abs_bandpass : frequency dependent amplitude
 
+        return self.get_bandpass_table(pol)[an_ind].copy()
+
+
+class AipsTable(object):
+    """
+    An AIPS table exported as text, read once and indexed.
+
+    The file is read and split into lines once. The row -> antenna mapping
+    and the rows in each column page (the block of rows following a
+    column header such as "REAL1          IMAG1") are indexed the first
+    time they are needed, so every lookup after that is a dictionary
+    access rather than a rescan of the file.
+    """
+    def __init__(self, fname, antennacolumn):
+        self.fname = fname
+        with open(fname, 'r') as fl:
+            self.text = fl.read()
+        self.lines = self.text.split('\n')
+        self._tokens = {}
+        self._pages = {}
+        self.arrays = {}
+        self.rowmap = self._map_rows(antennacolumn)
+
+        # number of channels, for bandpass tables
+        self.nfreq = None
+        for line in self.lines:
+            if 'TFDIM11' in line:
+                self.nfreq = int(line.split()[2])
+
+    def tokens(self, i):
+        if i not in self._tokens:
+            self._tokens[i] = self.lines[i].split()
+        return self._tokens[i]
+
+    def _line_of(self, s):
+        pos = self.text.find(s)
+        if pos < 0:
+            raise ValueError(f"{s} not found in {self.fname}")
+        return self.text.count('\n', 0, pos)
+
+    def _map_rows(self, antennacolumn):
+        # rows between the ***BEGIN*PASS*** line and the ***END line
+        mapping = {}
+        i = self._line_of("***BEGIN*PASS***") + 1
+        while not "***END" in self.lines[i]:
+            row = self.tokens(i)
+            mapping[row[0]] = row[antennacolumn]
+            i += 1
+        return mapping
 
+    def page(self, start):
+        # rows following the column header start, up to the first blank
+        # line. Only the first row of each label/antenna is indexed.
+        if start not in self._pages:
+            page = AipsPage()
+            i = self._line_of(start) + 1
+            while i < len(self.lines) and len(self.tokens(i)) > 0:
+                label = self.tokens(i)[0]
+                page.by_label.setdefault(label, i)
+                if label in self.rowmap:
+                    page.by_antenna.setdefault(self.rowmap[label], i)
+                i += 1
+            self._pages[start] = page
+        return self._pages[start]
+
+
+class AipsPage(object):
+    def __init__(self):
+        self.by_label = {}      # row label -> line number
+        self.by_antenna = {}    # antenna number -> line number
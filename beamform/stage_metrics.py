@@ -0,0 +1,127 @@
+"""
+Per-stage timing and memory metrics for the beamform scripts.
+
+Stages are timed with :func:`stage`, which records the wall time, CPU
+time (of all threads), peak RSS and bytes read and written while the
+stage ran, and appends them as one JSON object per line to the job's
+metrics file. The metrics file is set with :func:`configure` (each script
+exposes it as ``--metrics``) or the ``CELEBI_METRICS`` environment
+variable. If neither is set, stages are still timed but nothing is
+written.
+
+Example::
+
+    from stage_metrics import stage
+
+    with stage("fft", nchan=336):
+        xf = fft(x)
+
+Each record holds the fields ``job``, ``host``, ``pid``, ``stage``,
+``start`` (UNIX time), ``wall_s``, ``cpu_s``, ``peak_rss_mb``,
+``read_bytes``, ``write_bytes`` (bytes that went to or from storage),
+``rchar``, ``wchar`` (bytes passed through read/write calls, including
+the page cache) and any keyword arguments given to :func:`stage`. The
+I/O fields are None where ``/proc/self/io`` is not available. Peak RSS is
+the process's high water mark at the end of the stage, not the stage's
+own peak.
+
+Stages may be timed in several threads at once, e.g. reads done ahead of
+the FFTs, which are marked ``background``. Their wall times are their
+own, but the CPU and I/O fields count the whole process, so they include
+the work of any stage they overlap.
+"""
+import json
+import os
+import resource
+import socket
+import sys
+import time
+from contextlib import contextmanager
+
+METRICS_ENV = "CELEBI_METRICS"
+
+_fname = None
+_job = None
+
+
+def configure(fname=None, job=None):
+    """Set the metrics file and job name for this process
+
+    :param fname: JSON lines file to append records to. Defaults to the
+        value of ``CELEBI_METRICS``, if set.
+    :type fname: str, optional
+    :param job: Name of the job. Defaults to the script's name.
+    :type job: str, optional
+    """
+    global _fname, _job
+    _fname = fname
+    _job = job
+
+
+def _io_counters():
+    """Cumulative I/O counters of this process from /proc/self/io
+
+    :return: Counters by name, or None if they are not available
+    :rtype: dict or None
+    """
+    try:
+        with open("/proc/self/io") as f:
+            return {
+                k: int(v)
+                for k, v in (line.split(":") for line in f if ":" in line)
+            }
+    except (OSError, ValueError):
+        return None
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    if sys.platform == "darwin":
+        peak /= 1024
+    return peak / 1024
+
+
+def _write(record):
+    fname = _fname or os.environ.get(METRICS_ENV)
+    if not fname:
+        return
+    with open(fname, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+@contextmanager
+def stage(name, **info):
+    """Time a named stage and record its metrics.
+
+    :param name: Name of the stage, e.g. "vfile.read"
+    :type name: str
+    :param info: Extra fields to add to the record, e.g. the antenna
+    :return: The record, which fields can be added to inside the stage
+    :rtype: dict
+    """
+    record = {
+        "job": _job or os.path.basename(sys.argv[0]),
+        "host": socket.gethostname(),
+        "pid": os.getpid(),
+        "stage": name,
+        "start": time.time(),
+    }
+    record.update(info)
+
+    io0 = _io_counters()
+    wall0 = time.perf_counter()
+    cpu0 = time.process_time()
+    try:
+        yield record
+    finally:
+        record["wall_s"] = time.perf_counter() - wall0
+        record["cpu_s"] = time.process_time() - cpu0
+        record["peak_rss_mb"] = _peak_rss_mb()
+        io1 = _io_counters()
+        for k in ("read_bytes", "write_bytes", "rchar", "wchar"):
+            if io0 is not None and io1 is not None and k in io0:
+                record[k] = io1[k] - io0[k]
+            else:
+                record[k] = None
+        _write(record)
@@ -8,18 +8,34 @@ SUM THEM IN craftcor_tab.py
 import glob
 import time
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
+from stage_metrics import configure as configure_metrics, stage
+
+# Number of fine channels summed at once by each thread
+DEFAULT_CHUNK = 2**18
+
 
 def _main():
     start = time.time()
     args = get_args()
+    configure_metrics(args.metrics)
 
     fnames = find_files(args.f_dir, args.f, args.p)
 
-    sum = do_sum(fnames)
-    save(sum, args.o)
+    with stage("sum", nfiles=len(fnames), weighted=args.weighted):
+        if args.weighted:
+            sum, weights = do_weighted_sum(
+                fnames, args.bw, cpus=args.cpus, chunk=args.chunk
+            )
+            if args.weights_file is not None:
+                np.save(args.weights_file, weights)
+        else:
+            sum = do_sum(fnames, cpus=args.cpus, chunk=args.chunk)
+    with stage("save"):
+        save(sum, args.o)
     end = time.time()
     print(f"sum.py completed in {end-start} s")
 
@@ -38,6 +54,43 @@ def get_args():
     parser.add_argument("-f", type=str, help="FRB name")
     parser.add_argument("-p", type=str, help="Polarisation to sum")
     parser.add_argument("-o", type=str, help="Output filename")
+    parser.add_argument(
+        "--cpus",
+        type=int,
+        default=1,
+        help="Number of chunks of the spectra summed at once",
+    )
+    parser.add_argument(
+        "--chunk",
+        type=int,
+        default=DEFAULT_CHUNK,
+        help="Number of fine channels in each chunk",
+    )
+    parser.add_argument(
+        "--weighted",
+        action="store_true",
+        help="Weight each coarse channel of each antenna by its inverse "
+        "noise variance, leaving out only channels containing NaNs",
+    )
+    parser.add_argument(
+        "--bw",
+        type=int,
+        default=336,
+        help="Spectrum bandwidth in MHz, for --weighted",
+    )
+    parser.add_argument(
+        "--weights_file",
+        type=str,
+        default=None,
+        help="File to save the --weighted weights to, with shape "
+        "(nantenna, bw)",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        default=None,
+        help="JSON lines file to append stage metrics to",
+    )
 
     return parser.parse_args()
 
@@ -48,35 +101,237 @@ def find_files(f_dir, FRB, p):
 
 
 
-def do_sum(fnames):
-    # Sum one file at a time, since they're very large
-    # Numpy's mmap_mode helps by allowing us to do this without moving them into memory
+def load_spectra(fnames):
+    """Memory map antennas' fine spectra for summing.
 
+    Empty spectra (antennas that could not be beamformed) are skipped.
+
+    :param fnames: .npy files of fine spectra with shape
+        ``(nint, nchan, npol)``
+    :type fnames: list[str]
+    :return: Files and memory-mapped spectra that are not empty, and the
+        length of the shortest
+    :rtype: tuple(list[str], list[:class:`np.ndarray`], int)
+    """
     print(fnames)
 
-    # Initialise summation array with the shape of the first file
-    print("Initialising sum array...")
-    f = np.load(fnames[0])
-    print(f"f shape: {f.shape}")
-    sum_arr = np.zeros(f.shape, dtype=f.dtype)
+    # mmap_mode='r' keeps the arrays on disk, instead of loading them into
+    # memory
+    names = []
+    arrs = []
+    for fname in fnames:
+        arr = np.load(fname, mmap_mode="r")
+        print(f"{fname}: {arr.shape}")
+        if arr.size == 0:
+            print(f"Ignoring {fname}: no data")
+            continue
+        names.append(fname)
+        arrs.append(arr)
 
-    n_antennas = 0
+    assert arrs, "No spectra to sum"
+    nchan = min(a.shape[1] for a in arrs)
+    if any(a.shape[1] != nchan for a in arrs):
+        print(
+            f"WARNING: spectra have different lengths, truncating to {nchan}"
+            " channels"
+        )
+    return names, arrs, nchan
 
-    # Go over the rest of the files, summing their contents into sum_arr
-    for fname in fnames:
-        print(fname)
-        # mmap_mode='r' keeps the loaded array on disk, instead of loading it into memory
-        new_arr = np.load(fname, mmap_mode="r")
-        print(f"Array Size: {new_arr.shape}")
-        if not np.isnan(new_arr).any():
-            sum_arr += new_arr
-            n_antennas += 1
 
+def do_sum(fnames, cpus=1, chunk=DEFAULT_CHUNK):
+    """Sum the fine spectra of several antennas.
+
+    The spectra are memory mapped and walked in chunks of fine channels,
+    several chunks at once in a thread pool. Each chunk of every antenna is
+    read once: it is checked for NaNs and added to the chunk's sum in the
+    same pass, pairwise (see :func:`tree_sum`) rather than one antenna
+    after another.
+
+    As before, an antenna with a NaN anywhere is left out of the sum
+    entirely. Chunks that included such an antenna (because its NaNs are
+    in other chunks) are summed again without it, so every chunk is the
+    sum of exactly the same antennas, in the same order.
+    Empty spectra (antennas that could not be beamformed) are skipped, and
+    spectra of different lengths are truncated to the shortest.
+
+    :param fnames: .npy files of fine spectra with shape
+        ``(nint, nchan, npol)``
+    :type fnames: list[str]
+    :param cpus: Number of chunks summed at once
+    :type cpus: int, optional
+    :param chunk: Number of fine channels in each chunk
+    :type chunk: int, optional
+    :return: Summed spectrum
+    :rtype: :class:`np.ndarray`
+    """
+    names, arrs, nchan = load_spectra(fnames)
+
+    shape = (arrs[0].shape[0], nchan) + arrs[0].shape[2:]
+    print(f"Initialising sum array with shape {shape}...")
+    sum_arr = np.zeros(shape, dtype=arrs[0].dtype)
+
+    chunks = [slice(c, min(c + chunk, nchan)) for c in range(0, nchan, chunk)]
+
+    def add_chunk(s, exclude=()):
+        # Sum chunk s of the antennas without NaNs in it, apart from those
+        # in exclude, returning which antennas had NaNs
+        nan = np.zeros(len(arrs), dtype=bool)
+
+        def good():
+            for i, arr in enumerate(arrs):
+                if i in exclude:
+                    continue
+                x = np.array(arr[:, s])
+                if np.isnan(x).any():
+                    nan[i] = True
+                else:
+                    yield x
+
+        total = tree_sum(good())
+        sum_arr[:, s] = 0 if total is None else total
+        return nan
+
+    with ThreadPoolExecutor(max_workers=cpus) as pool:
+        nan = np.array(list(pool.map(add_chunk, chunks)))
+
+        # Sum the chunks that included antennas with NaNs in other chunks
+        # again without them
+        bad = nan.any(axis=0)
+        for i in np.flatnonzero(bad):
+            print(f"Ignoring {names[i]}: contains NaNs")
+        exclude = set(np.flatnonzero(bad))
+        redo = [s for s, n in zip(chunks, nan) if (bad & ~n).any()]
+        list(pool.map(lambda s: add_chunk(s, exclude), redo))
+
+    n_antennas = len(arrs) - bad.sum()
     print(f"Number of good antennas: {n_antennas}")
 
     return sum_arr
 
 
+def do_weighted_sum(fnames, bw, cpus=1, chunk=DEFAULT_CHUNK):
+    """Sum the fine spectra of several antennas, weighting each coarse
+    channel of each antenna by its inverse noise variance.
+
+    Rather than dropping an antenna with NaNs, only its coarse channels
+    containing NaNs are left out. The weight of each antenna's coarse
+    channel is the inverse of its mean power, which is dominated by the
+    noise since the burst is a tiny fraction of the crop. The spectra are
+    walked in chunks of whole coarse channels as in :func:`do_sum`, and
+    the weights are worked out in the same pass as the sum.
+
+    Each coarse channel of the output is the weighted mean of the antennas
+    times the number of antennas in it, so it has the same scale as the
+    unweighted sum and the burst (which is the same in every calibrated
+    antenna) comes out the same in both polarisations, whatever their
+    weights.
+
+    :param fnames: .npy files of fine spectra with shape
+        ``(nint, nchan, npol)``
+    :type fnames: list[str]
+    :param bw: Bandwidth in MHz, i.e. number of coarse channels
+    :type bw: int
+    :param cpus: Number of chunks summed at once
+    :type cpus: int, optional
+    :param chunk: Number of fine channels in each chunk, rounded down to
+        a whole number of coarse channels
+    :type chunk: int, optional
+    :return: Summed spectrum, and the weights with shape
+        ``(nantenna, bw)`` (0 where a channel was left out)
+    :rtype: tuple(:class:`np.ndarray`, :class:`np.ndarray`)
+    """
+    names, arrs, nchan = load_spectra(fnames)
+    nfine = nchan // bw
+    if nfine * bw != nchan:
+        print(
+            f"WARNING: {nchan} fine channels is not a multiple of {bw} "
+            f"coarse channels, ignoring the last {nchan - nfine * bw}"
+        )
+
+    shape = (arrs[0].shape[0], nchan) + arrs[0].shape[2:]
+    print(f"Initialising sum array with shape {shape}...")
+    sum_arr = np.zeros(shape, dtype=arrs[0].dtype)
+    weights = np.zeros((len(arrs), bw))
+
+    step = max(1, chunk // nfine)
+    coarse = [(c, min(c + step, bw)) for c in range(0, bw, step)]
+
+    def add_chunk(c0, c1):
+        s = slice(c0 * nfine, c1 * nfine)
+
+        def weighted():
+            for i, arr in enumerate(arrs):
+                x = np.array(arr[:, s])
+                xc = x.reshape(x.shape[0], c1 - c0, nfine, -1)
+                power = np.mean(
+                    xc.real**2 + xc.imag**2, axis=(0, 2, 3), dtype=np.float64
+                )
+                ok = np.isfinite(power) & (power > 0)
+                w = np.zeros(c1 - c0)
+                w[ok] = 1 / power[ok]
+                weights[i, c0:c1] = w
+                # NaN * 0 is still NaN, so zero masked channels explicitly
+                xc[:, ~ok] = 0
+                xc *= w[None, :, None, None].astype(np.float32)
+                yield x
+
+        total = tree_sum(weighted())
+        wsum = weights[:, c0:c1].sum(axis=0)
+        nant = (weights[:, c0:c1] > 0).sum(axis=0)
+        norm = np.zeros(c1 - c0)
+        norm[wsum > 0] = nant[wsum > 0] / wsum[wsum > 0]
+        total.reshape(total.shape[0], c1 - c0, nfine, -1)[:] *= norm[
+            None, :, None, None
+        ].astype(np.float32)
+        sum_arr[:, s] = total
+
+    with ThreadPoolExecutor(max_workers=cpus) as pool:
+        list(pool.map(lambda c: add_chunk(*c), coarse))
+
+    nant = (weights > 0).sum(axis=0)
+    print(
+        f"Antennas per coarse channel: min {nant.min()}, median "
+        f"{np.median(nant):g}, max {nant.max()} of {len(arrs)}"
+    )
+    for name, w in zip(names, weights):
+        nmasked = (w == 0).sum()
+        if nmasked:
+            print(f"{name}: {nmasked} coarse channels left out")
+
+    return sum_arr, weights
+
+
+def tree_sum(arrs):
+    """Sum arrays pairwise, as a binary tree.
+
+    This has less rounding error than adding the arrays one after
+    another, and only holds about log2(len(arrs)) partial sums at a time.
+    The arrays are added to in place.
+
+    :param arrs: Arrays of the same shape
+    :type arrs: iterable of :class:`np.ndarray`
+    :return: Sum of the arrays, or None if there are none
+    :rtype: :class:`np.ndarray`
+    """
+    # partial sums of 2**level arrays, at most one per level
+    stack = []
+    for part in arrs:
+        level = 0
+        while stack and stack[-1][0] == level:
+            prev = stack.pop()[1]
+            prev += part
+            part = prev
+            level += 1
+        stack.append((level, part))
+
+    if not stack:
+        return None
+    total = stack.pop()[1]
+    while stack:
+        total += stack.pop()[1]
+    return total
+
+
 def save(arr, outfile):
     print("Saving...")
     np.save(outfile, arr)
@@ -0,0 +1,635 @@
+"""
+Synthetic VCRAFT-like voltages and metadata for benchmarking.
+
+Writes a small, self-consistent data set that the beamforming stages can
+run on without real ASKAP dumps:
+
+- one file per antenna, polarisation and card, laid out as
+  ``<outdir>/akNN/beamPP/akNN_c<card>_f0.vcraft``, each holding an ASCII
+  header padded to :data:`HDR_SIZE` bytes followed by samples packed by
+  :func:`pack`
+- AIPS FRING, selfcal and bandpass text tables with unit solutions, and
+  the README naming them
+
+The voltages are independent Gaussian noise in every antenna plus a
+common, coherently dispersed burst. The burst is made in the stitched
+fine spectrum the beamformer outputs (descending frequency, as expected
+by :func:`dedisperse.dedisperse`), dispersed with the conjugate of the
+chirp :func:`dedisperse.dedisperse` applies, then split into coarse
+channels and inverse FFT'd to 32/27 MHz voltages. Beamforming,
+dedispersing and inverse FFTing the data therefore gives back the burst
+exactly, apart from noise and quantisation, which makes the S/N of the
+result a check on the whole chain. The PFB ripple is not simulated.
+
+:class:`SyntheticMux` reads the files back with the same interface the
+beamformer uses on a :class:`vcraft.VcraftMux`.
+"""
+import glob
+import os
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+
+import numpy as np
+from scipy import fft
+
+from dedisperse import dedisp_phases
+
+# Bytes of ASCII header at the start of every file
+HDR_SIZE = 4096
+
+# Coarse channel sample rate in MHz
+SAMP_RATE_MHZ = 32 / 27
+
+# Dispersion constant used when cropping, in MHz^2 s / (pc cm^-3)
+KDM = 4149.377593
+
+# RMS of the complex noise in quantisation levels, chosen to use the
+# range of each sample width well
+LEVELS = {1: 1.0, 4: 3.0, 8: 30.0, 16: 3000.0}
+
+POL_BEAMS = {"x": 0, "y": 1}
+
+# Number of complex values in each payload byte
+VALUES_PER_BYTE = {1: 4, 4: 1, 8: 0.5, 16: 0.25}
+
+
+def _main():
+    args = get_args()
+    write_dataset(
+        args.outdir,
+        nant=args.nant,
+        nchan=args.nchan,
+        chan_per_card=args.chan_per_card,
+        nsamp=args.nsamp,
+        nbits=args.nbits,
+        fmax=args.fmax,
+        DM=args.DM,
+        pulse_time=args.pulse_time,
+        width_us=args.width_us,
+        amp=args.amp,
+        pols=args.pols,
+        seed=args.seed,
+    )
+
+
+def get_args():
+    parser = ArgumentParser(
+        description="Write synthetic vcraft voltages and AIPS tables for "
+        "benchmarking the beamformer",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    add_dataset_args(parser)
+    parser.add_argument("outdir", help="Directory to write the data set to")
+    return parser.parse_args()
+
+
+def add_dataset_args(parser):
+    """Add the data set options to an argument parser
+
+    :param parser: Parser to add the options to
+    :type parser: :class:`argparse.ArgumentParser`
+    """
+    parser.add_argument(
+        "--nant", type=int, default=6, help="Number of antennas"
+    )
+    parser.add_argument(
+        "--nchan", type=int, default=48, help="Number of 1 MHz coarse channels"
+    )
+    parser.add_argument(
+        "--chan_per_card",
+        type=int,
+        default=8,
+        help="Number of coarse channels in each vcraft file",
+    )
+    parser.add_argument(
+        "--nsamp",
+        type=int,
+        default=2**17,
+        help="Number of samples per coarse channel. Must be a multiple of 64.",
+    )
+    parser.add_argument(
+        "--nbits",
+        type=int,
+        default=4,
+        choices=sorted(LEVELS),
+        help="Bits per real or imaginary part of each sample",
+    )
+    parser.add_argument(
+        "--fmax",
+        type=float,
+        default=1319.5,
+        help="Centre frequency of the highest coarse channel in MHz",
+    )
+    parser.add_argument(
+        "--DM", type=float, default=100.0, help="DM of the burst in pc/cm3"
+    )
+    parser.add_argument(
+        "--pulse_time",
+        type=float,
+        default=0.75,
+        help="Arrival time of the burst at the bottom of the band, as a "
+        "fraction of the crop",
+    )
+    parser.add_argument(
+        "--width_us",
+        type=float,
+        default=20.0,
+        help="Gaussian width (sigma) of the burst in us",
+    )
+    parser.add_argument(
+        "--amp",
+        type=float,
+        default=0.5,
+        help="Peak amplitude of the burst relative to the noise of one "
+        "antenna in the final time series",
+    )
+    parser.add_argument(
+        "--pols", default="x", help="Polarisations to write, e.g. xy"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=1234, help="Random number seed"
+    )
+
+
+def ant_name(iant):
+    """Name of the zero-based antenna iant, e.g. ak01"""
+    return f"ak{iant + 1:02d}"
+
+
+def coarse_freqs(nchan, fmax):
+    """Coarse channel centre frequencies in MHz, highest first"""
+    return fmax - np.arange(nchan, dtype=float)
+
+
+def dm_sweep_us(DM, freqs):
+    """Dispersion delay across the band in us"""
+    freqs = np.asarray(freqs)
+    return KDM * DM * 1e6 * (freqs.min() ** -2 - freqs.max() ** -2)
+
+
+def pack(x, nbits):
+    """Quantise complex voltages and pack them into payload bytes.
+
+    The inverse of :func:`unpack`: values are rounded and clipped to the
+    range of ``nbits`` bit two's complement numbers (or their sign, for 1
+    bit). The payload is time major with the channels of each sample
+    adjacent and each value real part first:
+
+    - 16 and 8 bit: a little-endian int per part
+    - 4 bit: one byte per value, real part in the low nibble
+    - 1 bit: four values per byte from the least significant bit up, with
+      a 0 bit for a negative part
+
+    This is the synthetic files' own layout, which need not match vcraft's.
+
+    :param x: Voltages, scaled to quantisation levels
+    :type x: :class:`np.ndarray`
+    :param nbits: Number of bits per real or imaginary part
+    :type nbits: int
+    :return: Packed payload
+    :rtype: :class:`np.ndarray` of uint8
+    """
+    x = np.ascontiguousarray(x, dtype=np.complex64).reshape(-1)
+    parts = x.view(np.float32)
+    if nbits == 1:
+        bits = (parts >= 0).reshape(-1, 8)
+        return np.packbits(bits, axis=1, bitorder="little").reshape(-1)
+
+    lo, hi = -(2 ** (nbits - 1)), 2 ** (nbits - 1) - 1
+    q = np.clip(np.rint(parts), lo, hi)
+    if nbits == 16:
+        return q.astype("<i2").view(np.uint8)
+    if nbits == 8:
+        return q.astype(np.int8).view(np.uint8)
+
+    # 4 bit: real part in the low nibble, imaginary part in the high one
+    q = q.astype(np.int8).view(np.uint8).reshape(-1, 2)
+    return (q[:, 0] & 0x0F) | (q[:, 1] << 4)
+
+
+def unpack(payload, nbits, out):
+    """Unpack a payload written by :func:`pack`.
+
+    :param payload: Packed payload
+    :type payload: :class:`np.ndarray` of uint8
+    :param nbits: Number of bits per real or imaginary part
+    :type nbits: int
+    :param out: C-contiguous complex64 buffer for the values
+    :type out: :class:`np.ndarray`
+    :return: out
+    :rtype: :class:`np.ndarray`
+    """
+    parts = out.reshape(-1).view(np.float32)
+    payload = np.asarray(payload)
+    if nbits == 16:
+        parts[:] = payload.view("<i2")
+    elif nbits == 8:
+        parts[:] = payload.view(np.int8)
+    elif nbits == 4:
+        # sign extend each nibble
+        b = payload.view(np.int8)
+        parts[0::2] = (b << 4) >> 4
+        parts[1::2] = b >> 4
+    else:
+        bits = np.unpackbits(payload, bitorder="little")
+        parts[:] = 2 * bits.astype(np.float32) - 1
+    return out
+
+
+def burst_voltages(
+    freqs, nsamp, DM, pulse_time=0.75, width_us=20.0, amp=0.5, seed=0,
+):
+    """Coarse channel voltages of a dispersed burst, without noise.
+
+    :param freqs: Coarse channel centre frequencies in MHz, highest first
+    :type freqs: :class:`np.ndarray`
+    :param nsamp: Number of samples per coarse channel, a multiple of 64
+    :type nsamp: int
+    :param DM: Dispersion measure in pc/cm3
+    :type DM: float
+    :param pulse_time: Arrival time at the bottom of the band as a
+        fraction of the crop
+    :type pulse_time: float, optional
+    :param width_us: Gaussian width of the burst in us
+    :type width_us: float, optional
+    :param amp: Peak amplitude relative to the noise of one antenna in
+        the final time series, if each antenna's voltages have unit
+        variance
+    :type amp: float, optional
+    :param seed: Random number seed
+    :type seed: int, optional
+    :return: Voltages with shape ``(nchan, nsamp)``, in upper sideband
+    :rtype: :class:`np.ndarray`
+    """
+    assert nsamp % 64 == 0, "nsamp must be a multiple of 64"
+    nchan = len(freqs)
+    nfine = 27 * nsamp // 32
+    nguard = 5 * nsamp // 64
+    ntotal = nchan * nfine
+    dt_us = 1 / nchan
+
+    sweep_us = dm_sweep_us(DM, freqs)
+    t0_us = pulse_time * ntotal * dt_us
+    assert sweep_us + 5 * width_us < t0_us, (
+        f"DM sweep of {sweep_us:.0f} us does not fit before the burst at "
+        f"{t0_us:.0f} us, use a longer crop or a later pulse_time"
+    )
+
+    # Burst in the final time series, as band-limited noise with a
+    # Gaussian envelope
+    rng = np.random.default_rng(seed)
+    t_us = np.arange(ntotal) * dt_us
+    envelope = np.exp(-0.5 * ((t_us - t0_us) / width_us) ** 2)
+    on = envelope > 1e-6
+    burst = np.zeros(ntotal, dtype=np.complex128)
+    burst[on] = envelope[on] * (
+        rng.standard_normal(on.sum()) + 1j * rng.standard_normal(on.sum())
+    ) / np.sqrt(2)
+
+    # With unit variance voltages, the final time series of one antenna
+    # has a variance of nsamp / ntotal
+    burst *= amp * np.sqrt(nsamp / ntotal)
+
+    # Disperse it with the conjugate of dedisperse's chirp
+    f0 = freqs.mean()
+    bw = float(nchan)
+    spec = fft.fft(burst)
+    spec *= np.conj(dedisp_phases(DM, f0, bw, ntotal))
+    del burst
+
+    # The beamformer conjugates upper sideband voltages, FFTs them and
+    # keeps fine channels nguard to nguard + nfine of the fftshifted
+    # spectrum. Fine channel j of a coarse channel therefore comes from
+    # the conjugate of FFT bin nsamp/2 - nguard - j.
+    bins = (nsamp // 2 - nguard - np.arange(nfine)) % nsamp
+    volts = np.zeros((nchan, nsamp), dtype=np.complex128)
+    volts[:, bins] = np.conj(spec.reshape(nchan, nfine))
+    volts = fft.ifft(volts, axis=1, overwrite_x=True)
+
+    return volts.astype(np.complex64)
+
+
+def vcraft_header(fields):
+    """Format a vcraft header, padded to :data:`HDR_SIZE` bytes
+
+    :param fields: Header values by keyword
+    :type fields: dict
+    :rtype: bytes
+    """
+    text = "".join(f"{k} {v}\n" for k, v in fields.items()).encode("ascii")
+    assert len(text) < HDR_SIZE, "vcraft header too long"
+    return text.ljust(HDR_SIZE, b"\0")
+
+
+def write_vcraft(fname, fields, volts, nbits):
+    """Write a synthetic vcraft file.
+
+    :param fname: File to write
+    :type fname: str
+    :param fields: Header values by keyword
+    :type fields: dict
+    :param volts: Voltages with shape ``(nsamp, nchan)``, scaled to
+        quantisation levels
+    :type volts: :class:`np.ndarray`
+    :param nbits: Number of bits per real or imaginary part
+    :type nbits: int
+    """
+    with open(fname, "wb") as f:
+        f.write(vcraft_header(fields))
+        f.write(pack(volts, nbits).tobytes())
+
+
+def write_dataset(
+    outdir,
+    nant=6,
+    nchan=48,
+    chan_per_card=8,
+    nsamp=2**17,
+    nbits=4,
+    fmax=1319.5,
+    DM=100.0,
+    pulse_time=0.75,
+    width_us=20.0,
+    amp=0.5,
+    pols="x",
+    seed=1234,
+    start_mjd=60000.5,
+):
+    """Write a synthetic data set.
+
+    :param outdir: Directory to write to
+    :type outdir: str
+    :param nant: Number of antennas
+    :type nant: int, optional
+    :param nchan: Number of coarse channels
+    :type nchan: int, optional
+    :param chan_per_card: Number of coarse channels per vcraft file
+    :type chan_per_card: int, optional
+    :param nsamp: Number of samples per coarse channel
+    :type nsamp: int, optional
+    :param nbits: Number of bits per real or imaginary part
+    :type nbits: int, optional
+    :param fmax: Centre frequency of the highest coarse channel in MHz
+    :type fmax: float, optional
+    :param DM: Dispersion measure of the burst in pc/cm3
+    :type DM: float, optional
+    :param pulse_time: Arrival time of the burst at the bottom of the band
+        as a fraction of the crop
+    :type pulse_time: float, optional
+    :param width_us: Gaussian width of the burst in us
+    :type width_us: float, optional
+    :param amp: Peak amplitude of the burst relative to the noise of one
+        antenna in the final time series
+    :type amp: float, optional
+    :param pols: Polarisations to write
+    :type pols: str, optional
+    :param seed: Random number seed
+    :type seed: int, optional
+    :param start_mjd: MJD of the first sample
+    :type start_mjd: float, optional
+    :return: Description of the data set, also saved as ``synth.npz``
+    :rtype: dict
+    """
+    assert nchan % chan_per_card == 0, "nchan must be a multiple of chan_per_card"
+    os.makedirs(outdir, exist_ok=True)
+    freqs = coarse_freqs(nchan, fmax)
+    ants = [ant_name(i) for i in range(nant)]
+
+    print(f"Making burst at DM {DM} over {nchan} channels of {nsamp} samples")
+    burst = burst_voltages(
+        freqs, nsamp, DM, pulse_time, width_us, amp, seed=seed
+    )
+
+    scale = LEVELS[nbits]
+    for ipol, pol in enumerate(pols):
+        beam = POL_BEAMS[pol]
+        for iant, ant in enumerate(ants):
+            print(f"Writing {ant} pol {pol}")
+            rng = np.random.default_rng([seed, ipol, iant])
+            ant_dir = os.path.join(outdir, ant, f"beam{beam:02d}")
+            os.makedirs(ant_dir, exist_ok=True)
+            for card, c0 in enumerate(range(0, nchan, chan_per_card)):
+                c1 = c0 + chan_per_card
+                # unit variance complex noise
+                noise = rng.standard_normal(
+                    (nsamp, c1 - c0, 2), dtype=np.float32
+                )
+                volts = noise.view(np.complex64)[..., 0]
+                volts *= np.float32(np.sqrt(0.5))
+                volts += burst[c0:c1].T
+                volts *= np.float32(scale)
+                fields = {
+                    "HDR_SIZE": HDR_SIZE,
+                    "ANT": ant,
+                    "ANTENNA_NO": iant + 1,
+                    "CARD_NO": card + 1,
+                    "FPGA_ID": 0,
+                    "BEAM": beam,
+                    "POL": pol.upper(),
+                    "NBITS": nbits,
+                    "NCHANS": c1 - c0,
+                    "NSAMPS_REQUEST": nsamp,
+                    "SAMP_RATE": SAMP_RATE_MHZ * 1e6,
+                    "FREQS": ",".join(f"{f:.6f}" for f in freqs[c0:c1]),
+                    "TRIGGER_FRAMEID": 0,
+                    "START_MJD": f"{start_mjd:.12f}",
+                }
+                fname = os.path.join(ant_dir, f"{ant}_c{card + 1}_f0.vcraft")
+                write_vcraft(fname, fields, volts, nbits)
+
+    write_aips_tables(os.path.join(outdir, "aips"), nant, nchan)
+
+    info = {
+        "nant": nant,
+        "nchan": nchan,
+        "nsamp": nsamp,
+        "nbits": nbits,
+        "freqs": freqs,
+        "DM": DM,
+        "pulse_time": pulse_time,
+        "width_us": width_us,
+        "amp": amp,
+        "pols": pols,
+        "start_mjd": start_mjd,
+    }
+    np.savez(os.path.join(outdir, "synth.npz"), **info)
+    return info
+
+
+def load_info(outdir):
+    """Load the description of a data set written by :func:`write_dataset`
+
+    :rtype: dict
+    """
+    with np.load(os.path.join(outdir, "synth.npz")) as f:
+        return {k: f[k][()] if f[k].ndim == 0 else f[k] for k in f.files}
+
+
+def _sn_table(fname, nant, phase_cols):
+    rows = range(1, nant + 1)
+    lines = [
+        "XTENSION= 'A3DTABLE'",
+        f"NAXIS2  =  {nant}",
+        "",
+        "***BEGIN*PASS***",
+    ]
+    lines += [f"  {r}  0.5  1  1  {r}  1  1" for r in rows]
+    lines += ["***END*PASS***", ""]
+    lines.append(
+        "     ROW  TIME  A  B  C  DELAY 1        RATE 1         DELAY 2        RATE 2"
+    )
+    lines += [
+        f"  {r}  0.5  1  1  0.000000E+00  0.0000E+00  0.000000E+00  0.0000E+00"
+        for r in rows
+    ]
+    lines.append("")
+    lines.append(f"\x0c     ROW  TIME  A  B  {phase_cols}")
+    lines += [
+        f"  {r}  0.5  1  1  1.000000  0.000000  1.000000  0.000000"
+        for r in rows
+    ]
+    lines.append("")
+    with open(fname, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def write_aips_tables(aips_dir, nant, nfreq):
+    """Write AIPS FRING, selfcal and bandpass tables with unit solutions
+
+    :return: FRING, selfcal and bandpass table filenames
+    :rtype: tuple(str, str, str)
+    """
+    os.makedirs(aips_dir, exist_ok=True)
+    fring_f = os.path.join(aips_dir, "synth.delays.sn.txt")
+    sc_f = os.path.join(aips_dir, "synth.selfcal.sn.txt")
+    bp_f = os.path.join(aips_dir, "synth.bandpass.bp.txt")
+
+    phase_cols = "REAL1          IMAG1          REAL2          IMAG2"
+    _sn_table(fring_f, nant, phase_cols)
+    _sn_table(sc_f, nant, phase_cols)
+
+    lines = [
+        f"NAXIS2  =  {nant}",
+        f"TFDIM11 =  {nfreq} / number of channels",
+        "",
+        "***BEGIN*PASS***",
+    ]
+    lines += [f"  {r}  0.5  1  1  1  {r}" for r in range(1, nant + 1)]
+    lines += ["***END*PASS***", ""]
+    lines.append(
+        "     ROW  TIME  C  REAL 1         IMAG 1   X  Y  Z  REAL 2         IMAG 2"
+    )
+    for r in range(1, nant + 1):
+        lines += [
+            f"  {r}  0.5  1  1.00000  0.00000  0  0  1.00000  0.00000"
+            for _ in range(nfreq)
+        ]
+    lines.append("")
+    with open(bp_f, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+    with open(os.path.join(aips_dir, "README.txt"), "w") as f:
+        f.write(f"{os.path.basename(fring_f)}  delays\n")
+        f.write(f"{os.path.basename(sc_f)}  selfcal\n")
+        f.write(f"{os.path.basename(bp_f)}  bandpass\n")
+
+    return fring_f, sc_f, bp_f
+
+
+class SyntheticVcraftFile:
+    """One synthetic vcraft file.
+
+    Has the attributes of :class:`vcraft.VcraftFile` the beamformer uses.
+
+    :param fname: File written by :func:`write_vcraft`
+    :type fname: str
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, "rb") as f:
+            text = f.read(HDR_SIZE).rstrip(b"\0").decode("ascii")
+        self.hdr = {}
+        for line in text.splitlines():
+            bits = line.split()
+            if bits:
+                self.hdr[bits[0]] = bits[1:]
+
+        self.nbits = int(self.hdr["NBITS"][0])
+        self.freqs = np.array(self.hdr["FREQS"][0].split(","), dtype=float)
+        self.nsamps = int(self.hdr["NSAMPS_REQUEST"][0])
+        self.start_mjd = float(self.hdr["START_MJD"][0])
+        self.start_frameid = int(self.hdr["TRIGGER_FRAMEID"][0])
+        self.pol = self.hdr["POL"][0]
+
+        nchan = len(self.freqs)
+        self.bytes_per_samp = int(nchan / VALUES_PER_BYTE[self.nbits])
+        self.payload = np.memmap(
+            fname, dtype=np.uint8, mode="r", offset=HDR_SIZE,
+            shape=(self.nsamps * self.bytes_per_samp,),
+        )
+
+    def read(self, sampoff, nsamp):
+        """Read samples sampoff to sampoff + nsamp
+
+        :return: Voltages with shape ``(nsamp, nchan)``
+        :rtype: :class:`np.ndarray`
+        """
+        assert 0 <= sampoff and sampoff + nsamp <= self.nsamps, (
+            f"Cannot read {nsamp} samples from {sampoff} of {self.fname}"
+        )
+        b0 = sampoff * self.bytes_per_samp
+        b1 = (sampoff + nsamp) * self.bytes_per_samp
+        out = np.empty((nsamp, len(self.freqs)), dtype=np.complex64)
+        return unpack(self.payload[b0:b1], self.nbits, out)
+
+
+class SyntheticMux:
+    """All the synthetic vcraft files of an antenna and polarisation.
+
+    Has the attributes of :class:`vcraft.VcraftMux` the beamformer uses,
+    including its files in ``_files`` for :class:`voltage_reader.CardReader`.
+
+    :param fnames: Files of the antenna and polarisation
+    :type fnames: list[str]
+    """
+
+    def __init__(self, fnames):
+        files = [SyntheticVcraftFile(f) for f in fnames]
+        # highest frequency first, as the files were written
+        files.sort(key=lambda f: -f.freqs[0])
+        self._files = files
+        self.hdr = files[0].hdr
+        self.freqs = np.concatenate([f.freqs for f in files])
+        self.nsamps = min(f.nsamps for f in files)
+        self.sample_offsets = [0] * len(files)
+        self.start_mjd = files[0].start_mjd
+        self.start_frameid = files[0].start_frameid
+        self.pol = files[0].pol
+        self.freqconfig = (
+            f"{len(self.freqs)} channels {self.freqs.max():.1f} to "
+            f"{self.freqs.min():.1f} MHz"
+        )
+
+    @classmethod
+    def open(cls, outdir, ant, pol):
+        """Open the files of an antenna and polarisation in a data set"""
+        beam = POL_BEAMS[pol]
+        fnames = glob.glob(
+            os.path.join(outdir, ant, f"beam{beam:02d}", "*.vcraft")
+        )
+        assert fnames, f"No vcraft files for {ant} pol {pol} in {outdir}"
+        return cls(fnames)
+
+    def read(self, sampoff, nsamp):
+        """Read samples sampoff to sampoff + nsamp of every channel
+
+        :return: Voltages with shape ``(nsamp, nchan)``
+        :rtype: :class:`np.ndarray`
+        """
+        return np.concatenate(
+            [f.read(sampoff, nsamp) for f in self._files], axis=1
+        )
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,304 @@
+"""
+Bounded-memory readers for vcraft voltages.
+
+A vcraft mux only reads every coarse channel for a range of samples, so
+holding a whole FRB crop in memory costs ``nsamp x nchan`` complex64
+samples. The readers here read the crop in bounded blocks and hand it back
+one group of coarse channels at a time, so peak memory is set by the block
+sizes rather than the crop length.
+
+Reads are overlapped with the caller's work: :class:`ChannelBlockReader`
+reads the next time block in the background while the current one is
+transposed, and :class:`CardReader` reads the per-card vcraft files of a
+mux concurrently, a few cards ahead of the channels being processed.
+"""
+import contextlib
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def _timed(timer, **info):
+    """timer(**info) if a timer was given, otherwise a null context"""
+    return contextlib.nullcontext() if timer is None else timer(**info)
+
+
+def read_ahead(read, starts, nahead=1, workers=None):
+    """Call read on each start in turn, keeping nahead calls in flight.
+
+    :param read: Function reading one block, given its start
+    :type read: callable
+    :param starts: Starts of the blocks to read, in order
+    :type starts: iterable
+    :param nahead: Number of blocks read ahead of the one being returned
+    :type nahead: int
+    :param workers: Number of blocks read at once. Defaults to nahead.
+    :type workers: int, optional
+    :return: Generator of (start, block) in the order of starts
+    :rtype: generator
+    """
+    with ThreadPoolExecutor(max(1, workers or nahead)) as pool:
+        pending = deque()
+        for start in starts:
+            pending.append((start, pool.submit(read, start)))
+            if len(pending) > nahead:
+                start, fut = pending.popleft()
+                yield start, fut.result()
+        while pending:
+            start, fut = pending.popleft()
+            yield start, fut.result()
+
+
+class ChannelBlockReader:
+    """Read a crop of voltages one group of coarse channels at a time.
+
+    The crop is read once from the vcraft mux in blocks of ``time_block``
+    samples and each block is transposed into a channel-major scratch
+    file next to the outputs. Channel groups are then read back from the
+    scratch file as contiguous ``(nchan_group, nsamp)`` arrays.
+
+    The scratch file is deleted by :meth:`close`, or on leaving the
+    context when used in a ``with`` statement.
+
+    :param vfile: vcraft mux to read from
+    :type vfile: :class:`vcraft.VcraftMux`
+    :param sampoff: First sample of the crop
+    :type sampoff: int
+    :param nsamp: Number of samples in the crop
+    :type nsamp: int
+    :param chan_block: Number of coarse channels in each group
+    :type chan_block: int
+    :param time_block: Number of samples read from the mux at a time.
+        Rounded down to a multiple of 64 to keep reads aligned to whole
+        iPFB frames.
+    :type time_block: int
+    :param scratch_dir: Directory to write the scratch file to. Defaults
+        to the current directory.
+    :type scratch_dir: str, optional
+    :param skip: Given the first and last + 1 channel of a group, whether to
+        skip it. Skipped groups are neither written to the scratch file nor
+        returned, although the mux still reads all channels.
+    :type skip: callable, optional
+    :param timer: Context manager factory wrapped around every read from
+        the mux, given the read's ``t0`` and ``nsamp``, e.g. a
+        :func:`stage_metrics.stage` for "vfile.read"
+    :type timer: callable, optional
+    """
+
+    def __init__(
+        self, vfile, sampoff, nsamp, chan_block, time_block=2**20,
+        scratch_dir=None, skip=None, timer=None,
+    ):
+        self.vfile = vfile
+        self.timer = timer
+        self.sampoff = sampoff
+        self.nsamp = nsamp
+        self.chan_block = chan_block
+        self.time_block = max(64, (time_block // 64) * 64)
+
+        nchan = len(vfile.freqs)
+        self.groups = [
+            (c0, min(c0 + chan_block, nchan))
+            for c0 in range(0, nchan, chan_block)
+        ]
+        if skip is not None:
+            self.groups = [g for g in self.groups if not skip(*g)]
+        self._nchan = nchan
+
+        fd, self.fname = tempfile.mkstemp(
+            prefix="vcraft_spill_", suffix=".npy", dir=scratch_dir or "."
+        )
+        os.close(fd)
+        self._spill = None
+
+        try:
+            self._read()
+        except BaseException:
+            self.close()
+            raise
+
+    def _read(self):
+        """Read the crop from the mux into the channel-major scratch file"""
+
+        def read(t0):
+            n = min(self.time_block, self.nsamp - t0)
+            with _timed(self.timer, t0=t0, nsamp=n, background=True):
+                return self.vfile.read(self.sampoff + t0, n)
+
+        self._spill = np.lib.format.open_memmap(
+            self.fname,
+            mode="w+",
+            dtype=np.complex64,
+            shape=(self._nchan, self.nsamp),
+        )
+        if not self.groups:
+            return
+
+        # the next block is read while this one is written to the scratch
+        # file
+        for t0, d in read_ahead(read, range(0, self.nsamp, self.time_block)):
+            n = d.shape[0]
+            for c0, c1 in self.groups:
+                self._spill[c0:c1, t0:t0 + n] = d[:, c0:c1].T
+            del d
+
+        self._spill.flush()
+
+    @property
+    def shape(self):
+        """Shape of the crop, in the same order as ``vfile.read``"""
+        return (self.nsamp, self._nchan)
+
+    @property
+    def nchan(self):
+        return self._nchan
+
+    def __iter__(self):
+        """Iterate over channel groups.
+
+        :return: Index of the first channel in the group and the group's
+            voltages with shape ``(nchan_group, nsamp)``
+        :rtype: tuple(int, :class:`np.ndarray`)
+        """
+        for c0, c1 in self.groups:
+            yield c0, np.array(self._spill[c0:c1])
+
+    def close(self):
+        self._spill = None
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def mux_files(vfile):
+    """The per-card vcraft files of a mux, or None if it doesn't say
+
+    :class:`vcraft.VcraftMux` keeps the files it was made from in
+    ``_files``, with ``sample_offsets`` and ``freqs`` built from them in
+    the same order.
+
+    :param vfile: vcraft mux
+    :type vfile: :class:`vcraft.VcraftMux`
+    :rtype: list or None
+    """
+    return getattr(vfile, "_files", None)
+
+
+class CardReader:
+    """Read a crop of voltages one vcraft file (card) at a time.
+
+    Each antenna's mux stitches together one vcraft file per card and
+    FPGA, each holding a few coarse channels. This reads the crop
+    straight from those files, several at once in a thread pool and up to
+    ``nahead`` files ahead of the one being processed, so file system
+    latency overlaps with the caller's FFTs. Only the files in flight are
+    held in memory and no scratch file is needed.
+
+    This relies on the mux keeping its open files in ``_files``, as
+    :class:`vcraft.VcraftMux` does, in the same order as its channels, and
+    one entry of ``sample_offsets`` per file. :meth:`supported` checks
+    this.
+
+    :param vfile: vcraft mux to read from
+    :type vfile: :class:`vcraft.VcraftMux`
+    :param sampoff: First sample of the crop
+    :type sampoff: int
+    :param nsamp: Number of samples in the crop
+    :type nsamp: int
+    :param workers: Number of files read at once
+    :type workers: int
+    :param nahead: Number of files read ahead of the one being processed.
+        At least workers.
+    :type nahead: int, optional
+    :param skip: Given the first and last + 1 channel of a file, whether to
+        skip reading it
+    :type skip: callable, optional
+    :param timer: Context manager factory wrapped around every file read,
+        given the file's index as ``file``, e.g. a
+        :func:`stage_metrics.stage` for "vfile.read"
+    :type timer: callable, optional
+    """
+
+    def __init__(
+        self, vfile, sampoff, nsamp, workers=4, nahead=None, skip=None,
+        timer=None,
+    ):
+        self.files = list(mux_files(vfile))
+        self.offsets = list(vfile.sample_offsets)
+        self.sampoff = sampoff
+        self.nsamp = nsamp
+        self.workers = workers
+        self.nahead = max(workers, nahead or 0)
+        self.skip = skip
+        self.timer = timer
+
+        self.chans = np.cumsum([0] + [len(f.freqs) for f in self.files])
+
+        # check the crop is in every file up front, as vfile.read would,
+        # rather than part way through iterating
+        for f, off in zip(self.files, self.offsets):
+            assert sampoff + off + nsamp <= f.nsamps, (
+                f"Crop {sampoff}+{nsamp} past end of file with "
+                f"{f.nsamps} samples and offset {off}"
+            )
+
+    @staticmethod
+    def supported(vfile):
+        """Whether vfile can be read one card at a time
+
+        :rtype: bool
+        """
+        files = mux_files(vfile)
+        if not files or len(vfile.sample_offsets) != len(files):
+            return False
+        freqs = np.concatenate([f.freqs for f in files])
+        return np.array_equal(freqs, vfile.freqs)
+
+    @property
+    def shape(self):
+        """Shape of the crop, in the same order as ``vfile.read``"""
+        return (self.nsamp, int(self.chans[-1]))
+
+    @property
+    def nchan(self):
+        return int(self.chans[-1])
+
+    def _read_file(self, i):
+        with _timed(self.timer, file=i, nsamp=self.nsamp, background=True):
+            d = self.files[i].read(
+                self.sampoff + self.offsets[i], self.nsamp
+            )
+        return np.ascontiguousarray(d.T)
+
+    def __iter__(self):
+        """Iterate over the files' channels.
+
+        :return: Index of the file's first channel and its voltages with
+            shape ``(nchan_file, nsamp)``
+        :rtype: tuple(int, :class:`np.ndarray`)
+        """
+        todo = [
+            i for i in range(len(self.files))
+            if self.skip is None
+            or not self.skip(self.chans[i], self.chans[i + 1])
+        ]
+        files = read_ahead(self._read_file, todo, self.nahead, self.workers)
+        for i, d in files:
+            yield int(self.chans[i]), d
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -21,6 +21,14 @@ params.uppersideband = false
 params.out_dir = "${params.publish_dir}/${params.label}"
 
 params.bw = 336 /*Default value*/
+params.beamform_all_ants = false    // beamform and sum all antennas in one process per pol
+params.bform_checkpoint_dir = ""    // persistent dir for per-antenna beamforming checkpoints
+params.weighted_sum = false         // weight antennas by inverse noise per coarse channel when summing
+params.fold_post_beamform = false   // deripple, dedisperse and apply the polcal delay while beamforming
+params.deripple_cache_dir = "${params.out_dir}/deripple_cache"  // persistent dir for cached deripple coefficients ("": each process's work dir)
+params.ifft_window_ms = 0           // only produce the FRB time series within this many ms of the candidate (0: all of it).
+                                    // Smaller outputs and memory, but not a faster IFFT
+                                    // Must leave room for frb_dynspec_guard + 1.2 * frb_baseline either side of the burst
 
 
 process create_calcfiles {
@@ -99,6 +107,41 @@ process create_calcfiles {
         """
 }
 
+process compile_aips_solns {
+    /*
+        Parse the AIPS calibration tables once into a binary cache that 
+        every beamforming job can load instead of re-parsing the tables
+
+        Input
+            flux_cal_solns: path
+                Flux calibration solutions. These should be the same solutions 
+                used to image the data and produce a position
+
+        Output
+            aips_solns: path
+                Compiled AIPS solutions
+    */
+    input:
+        path flux_cal_solns
+
+    output:
+        path "aips_solns.npy"
+
+    script:
+        """
+        tar xvf $flux_cal_solns
+        ml apptainer
+        set -a
+        set -o allexport
+        apptainer exec -B /fred/oz313/:/fred/oz313/ $params.container bash -c 'source /opt/setup_proc_container && python3 $beamform_dir/aips_cache.py -b bandpass*txt -o aips_solns.npy'
+        """
+
+    stub:
+        """
+        touch aips_solns.npy
+        """
+}
+
 process do_beamform {
     /*
         Produce a calibrated, beamformed fine spectrum for a particular
@@ -121,6 +164,8 @@ process do_beamform {
             flux_cal_solns: path
                 Flux calibration solutions. These should be the same solutions 
                 used to image the data and produce a position
+            aips_solns: path
+                The flux calibration solutions compiled by compile_aips_solns
             fcm: path
                 fcm to use
             cand: val
@@ -128,6 +173,11 @@ process do_beamform {
                 exists before run, so don't need to wait for it
             dm: val
                 DM of FRB
+            centre_freq: val
+                Central frequency of fine spectrum (MHz)
+            pol_cal_solns: path
+                Polarisation calibration solutions. If this is an empty file,
+                the polcal delay is not folded into beamforming.
 
         Output
             pol, fine spectrum: tuple(val, path)
@@ -143,9 +193,12 @@ process do_beamform {
         each pol
         each ant_idx
         path flux_cal_solns
+        path aips_solns
         path fcm
         val cand
         val dm
+        val centre_freq
+        path pol_cal_solns
 
     output:
         tuple val(pol), path("${label}_frb_${ant_idx}_${pol}_f.npy"), emit: data
@@ -167,6 +220,7 @@ process do_beamform {
         args="\$args --parset $fcm"
         args="\$args --calcfile $imfile"
         args="\$args --aips_c bandpass*txt"
+        args="\$args --aips_cache $aips_solns"
         args="\$args --an $ant_idx"
         args="\$args --pol $pol"
         args="\$args -o ${label}_frb_${ant_idx}_${pol}_f.npy"
@@ -174,12 +228,31 @@ process do_beamform {
         args="\$args --cpus=16"
         args="\$args --polcal_crop_width_s $params.polcal_crop_width_s"
 
+        # Resume from the progress of a failed attempt of this task
+        if [ "$params.bform_checkpoint_dir" != "" ]; then
+            args="\$args --checkpoint_dir $params.bform_checkpoint_dir/${label}_${ant_idx}_${pol}"
+        fi
+
         # Candidate file for cropping
         if [[ $label == "${params.label}" ]]; then
             args="\$args --snoopy $cand"
             args="\$args --DM $dm"
         fi
 
+        # Deripple, dedisperse and apply the polcal X delay and phase while
+        # beamforming, so the summed spectrum is ready to ifft
+        if [ "$params.fold_post_beamform" = "true" ]; then
+            args="\$args --fold_deripple $beamform_dir/.deripple_coeffs/ADE_R6_OSFIR.mat"
+            if [ "$params.deripple_cache_dir" != "" ]; then
+                export CELEBI_DERIPPLE_CACHE=$params.deripple_cache_dir
+            fi
+            args="\$args --fold_DM $dm"
+            args="\$args --fold_f0 $centre_freq"
+            if [[ $label == "${params.label}" ]] && [ -s $pol_cal_solns ] && [ "$params.nopolcal" != "true" ]; then
+                args="\$args --fold_polcal $pol_cal_solns"
+            fi
+        fi
+
         # High band FRBs need --uppersideband
         if [ "$params.uppersideband" = "true" ]; then
             args="\$args --uppersideband"
@@ -228,6 +301,153 @@ process do_beamform {
         """
 }
 
+process do_beamform_all {
+    /*
+        Produce a calibrated, beamformed fine spectrum summed over all
+        antennas for a particular polarisation from .vcraft voltages. This
+        replaces do_beamform, filter_antenna and sum_antennas with a single
+        process per polarisation.
+
+        Input
+            label: val
+                FRB name and context of process instance as a string (no
+                spaces)
+            data: val
+                Absolute path to data base directory (the dir. with the ak* 
+                directories)
+            imfile: path, calcfile: path
+                The .im and .calc files that are used by craftcor_tab.py to 
+                calculate geometric delays for beamforming
+            pol: val
+                One of "x" or "y" for the current polarisation being beamformed
+            flux_cal_solns: path
+                Flux calibration solutions. These should be the same solutions 
+                used to image the data and produce a position
+            aips_solns: path
+                The flux calibration solutions compiled by compile_aips_solns
+            fcm: path
+                fcm to use
+            cand: val
+                candidate file path
+            dm: val
+                DM of FRB
+            centre_freq: val
+                Central frequency of fine spectrum (MHz)
+            pol_cal_solns: path
+                Polarisation calibration solutions. If this is an empty file,
+                the polcal delay is not folded into beamforming.
+
+        Output
+            pol, summed spectrum: tuple(val, path)
+                Fine spectrum summed across all antennas in a single
+                polarisation
+
+                The polarisation is included to be able to group outputs by 
+                their polarisation
+    */
+    input:
+        val label
+        val data
+        tuple path(imfile), path(calcfile)
+        each pol
+        path flux_cal_solns
+        path aips_solns
+        path fcm
+        val cand
+        val dm
+        val centre_freq
+        path pol_cal_solns
+
+    output:
+        tuple val(pol), path("${label}_frb_sum_${pol}_f.npy"), emit: data
+        env FFTLEN, emit: fftlen
+        env bform_start_MJD, emit: bform_start_MJD
+
+    script:
+        """
+        mkdir delays    # needed by craftcor_tab.py
+        tar xvf $flux_cal_solns
+        ml apptainer
+        set -a
+        set -o allexport
+        args="-d $data"
+        args="\$args --parset $fcm"
+        args="\$args --calcfile $imfile"
+        args="\$args --aips_c bandpass*txt"
+        args="\$args --aips_cache $aips_solns"
+        args="\$args --pol $pol"
+        args="\$args -o ${label}_frb_sum_${pol}_f.npy"
+        args="\$args -i 1"
+        args="\$args --cpus=16"
+        args="\$args --polcal_crop_width_s $params.polcal_crop_width_s"
+
+        # Candidate file for cropping
+        if [[ $label == "${params.label}" ]]; then
+            args="\$args --snoopy $cand"
+            args="\$args --DM $dm"
+        fi
+
+        # Deripple, dedisperse and apply the polcal X delay and phase while
+        # beamforming, so the summed spectrum is ready to ifft
+        if [ "$params.fold_post_beamform" = "true" ]; then
+            args="\$args --fold_deripple $beamform_dir/.deripple_coeffs/ADE_R6_OSFIR.mat"
+            if [ "$params.deripple_cache_dir" != "" ]; then
+                export CELEBI_DERIPPLE_CACHE=$params.deripple_cache_dir
+            fi
+            args="\$args --fold_DM $dm"
+            args="\$args --fold_f0 $centre_freq"
+            if [[ $label == "${params.label}" ]] && [ -s $pol_cal_solns ] && [ "$params.nopolcal" != "true" ]; then
+                args="\$args --fold_polcal $pol_cal_solns"
+            fi
+        fi
+
+        # High band FRBs need --uppersideband
+        if [ "$params.uppersideband" = "true" ]; then
+            args="\$args --uppersideband"
+        fi
+
+        # Legacy compatibility: some very old FRBs need a hwfile
+        if [ ! "$params.hwfile" = "N/A" ]; then
+            args="\$args --hwfile $params.hwfile"
+        fi
+
+        apptainer exec -B /fred/oz313/:/fred/oz313/ $params.container bash -c 'source /opt/setup_proc_container && python3 $beamform_dir/craftcor_tab.py \$args'
+
+        export FFTLEN=`cat fftlen`
+
+        export bform_start_MJD=`cat corrected_start_MJD.txt`
+
+        # if dirs do not exist, make them
+        if [ ! -d ${params.out_dir}/htr ]; then
+            mkdir ${params.out_dir}/htr
+        fi
+
+        if [ ! -d ${params.out_dir}/htr/info ]; then 
+            mkdir ${params.out_dir}/htr/info
+        fi
+
+        # if txt file called ant_failed was produced, save it to htr/info folder of publish dir
+        declare -a ffarr=(`find ./ -maxdepth 1 -name "*_failed.txt"`)
+        if [[ \${#ffarr[@]} -gt 0 ]]; then
+            cp *_failed.txt ${params.out_dir}/htr/info/.
+        fi
+
+        if [ $label == "${params.label}" ]; then
+            cp frb_crop_MJD.txt ${params.out_dir}/htr/info/frb_crop_MJD.txt
+            cp corrected_start_MJD.txt ${params.out_dir}/htr/info/bform_start_MJD.txt
+        fi
+
+        # save txt file with cropping information of every antenna
+        cp ant_crop.txt ${params.out_dir}/htr/info/${label}_antcrop_all_${pol}_crop.txt
+        """
+
+    stub:
+        """
+        touch ${label}_frb_sum_${pol}_f.npy
+        export FFTLEN=100
+        """
+}
+
 process sum_antennas {
     /*
         Sum fine spectra across antennas for a particular polarisation
@@ -247,6 +467,8 @@ process sum_antennas {
                 The polarisation is included to be able to group outputs by 
                 their polarisation
     */
+    cpus 4
+
     input:
         val label
         tuple val(pol), path(spectra)
@@ -267,6 +489,10 @@ process sum_antennas {
         args="\$args -f ${label}_frb"
         args="\$args -p $pol"
         args="\$args -o ${label}_frb_sum_${pol}_f.npy"
+        args="\$args --cpus 4"
+        if [ "$params.weighted_sum" = "true" ]; then
+            args="\$args --weighted --bw $params.bw"
+        fi
 
         echo "python3 $beamform_dir/sum.py \$args"
         apptainer exec -B /fred/oz313/:/fred/oz313/ $params.container bash -c 'source /opt/setup_proc_container && python3 $beamform_dir/sum.py \$args'
@@ -310,7 +536,14 @@ process generate_deripple {
         ml apptainer
         set -a
         set -o allexport
-        apptainer exec -B /fred/oz313/:/fred/oz313/ $params.container bash -c 'source /opt/setup_proc_container && python3 $beamform_dir/generate_deripple.py \$FFTLEN $beamform_dir/.deripple_coeffs/ADE_R6_OSFIR.mat'
+        args="\$FFTLEN $beamform_dir/.deripple_coeffs/ADE_R6_OSFIR.mat"
+
+        # Coefficients are cached by filter and FFT length
+        if [ "$params.deripple_cache_dir" != "" ]; then
+            args="\$args --cache_dir $params.deripple_cache_dir"
+        fi
+
+        apptainer exec -B /fred/oz313/:/fred/oz313/ $params.container bash -c 'source /opt/setup_proc_container && python3 $beamform_dir/generate_deripple.py \$args'
 
         """
     
@@ -453,18 +686,26 @@ process ifft {
                 Polarisation and fine spectrum file
             dm: val
                 Dispersion measure the data has been dedispersed to
+            bform_start_MJD: val
+                MJD of the start of the beamformed crop
         
         Output:
             pol_time_series: path
-                ~3 ns dedispersed time series in a single polarisation    
+                ~3 ns dedispersed time series in a single polarisation. If
+                params.ifft_window_ms is set, the FRB's only covers the
+                candidate +/- that many ms
+            start_MJD: env
+                MJD of the first sample of pol_time_series
     */
     input:
         val label
         tuple val(pol), path(spectrum)
         val dm
+        val bform_start_MJD
 
     output:
-        path("${label}_${pol}_t_${dm}.npy")
+        path("${label}_${pol}_t_${dm}.npy"), emit: data
+        env start_MJD, emit: start_MJD
 
     script:
         """
@@ -483,6 +724,12 @@ process ifft {
 
         args="-f $spectrum"
         args="\$args -o ${label}_${pol}_t_${dm}.npy"
+        args="\$args --start_mjd $bform_start_MJD"
+        if [[ $label == "${params.label}" ]] && [ "$params.ifft_window_ms" != "0" ]; then
+            args="\$args --snoopy $params.snoopy"
+            args="\$args --margin_ms $params.ifft_window_ms"
+            args="\$args --bw $params.bw"
+        fi
 
         apptainer exec -B /fred/oz313/:/fred/oz313/ $params.container bash -c 'source /opt/setup_proc_container && python3 $beamform_dir/ifft.py \$args'
 
@@ -493,11 +740,17 @@ process ifft {
         fi
 
         cp *_t_*.npy ${params.publish_dir}/${params.label}/htr/
+
+        export start_MJD=`cat ${label}_${pol}_t_${dm}_start_MJD.txt`
+        if [ $label == "${params.label}" ]; then
+            cp ${label}_${pol}_t_${dm}_start_MJD.txt ${params.out_dir}/htr/info/
+        fi
         """
 
     stub:
         """
         touch ${label}_${pol}_t_${dm}.npy
+        export start_MJD=0
         """
 }
 
@@ -650,6 +903,11 @@ workflow beamform {
         Emit
             htr_data: path
                 Numpy files containing Stokes time series and dynamic spectra    
+            bform_start_MJD: val
+                MJD of the start of the beamformed crop
+            htr_start_MJD: val
+                MJD of the first sample of the time series, which is later
+                than bform_start_MJD if params.ifft_window_ms is set
     */
     take:
         label               // FRB label
@@ -664,37 +922,75 @@ workflow beamform {
         cand                // path to cand file
     
     main:
+        // a windowed time series needs room for the dynamic spectra's
+        // baseline crops either side of the burst
+        if (
+            params.ifft_window_ms && params.frb_baseline != null && params.frb_dynspec_guard != null
+            && params.ifft_window_ms < params.frb_dynspec_guard + 1.2 * params.frb_baseline
+        ) {
+            error "ifft_window_ms must be at least frb_dynspec_guard + 1.2 * frb_baseline"
+        }
+
         // preliminaries
         calcfiles = create_calcfiles(label, data, pos, fcm)
+        aips_solns = compile_aips_solns(flux_cal_solns)
 
         antennas = Channel
             .of(0..nants-1)
 
         // processing
 
-        // apply delays and calibration solutions to each antenna/pol fine spectra, align each antenna
-        do_beamform(
-            label, data, calcfiles, polarisations, antennas, flux_cal_solns, fcm, cand, dm
-        )
+        if (params.beamform_all_ants) {
+            // beamform and sum every antenna in a single process per polarisation
+            do_beamform_all(
+                label, data, calcfiles, polarisations, flux_cal_solns, aips_solns, fcm, cand, dm,
+                centre_freq, pol_cal_solns
+            )
+            summed = do_beamform_all.out.data
+            fftlen = do_beamform_all.out.fftlen.first()
+            bform_start_MJD = do_beamform_all.out.bform_start_MJD.first()
+        }
+        else {
+            // apply delays and calibration solutions to each antenna/pol fine spectra, align each antenna
+            do_beamform(
+                label, data, calcfiles, polarisations, antennas, flux_cal_solns, aips_solns, fcm, cand, dm,
+                centre_freq, pol_cal_solns
+            )
+
+            // filter antenna to make sure non-empty data is being beamformed
+            filter_antenna(label, do_beamform.out.data)
+
+            // sum filtered antenna data together to get summed X and Y polarisation fine spectra -> beamforming
+            summed = sum_antennas(label, filter_antenna.out.filtered_ant.groupTuple())
+            fftlen = do_beamform.out.fftlen.first()
+            bform_start_MJD = do_beamform.out.bform_start_MJD.first()
+        }
 
-        // filter antenna to make sure non-empty data is being beamformed
-        filter_antenna(label, do_beamform.out.data)
+        if (params.fold_post_beamform) {
+            // already derippled and dedispersed while beamforming
+            ifft(label, summed, dm, bform_start_MJD)
 
-        // sum filtered antenna data together to get summed X and Y polarisation fine spectra -> beamforming
-        sum_antennas(label, filter_antenna.out.filtered_ant.groupTuple())
+            // NB: already dedispersed to dm, which optimise_DM (process_frb.nf)
+            // allows for by only dedispersing by dm_opt - dm
+            pre_dedisp = summed
+        }
+        else {
+            // calculate derriple coefficients
+            coeffs = generate_deripple(fftlen)
 
-        // calculate derriple coefficients
-        coeffs = generate_deripple(do_beamform.out.fftlen.first())
+            // apply deripple coefficients
+            deripple(label, summed, fftlen, coeffs)
 
-        // apply deripple coefficients
-        deripple(label, sum_antennas.out, do_beamform.out.fftlen.first(), coeffs)
+            // coherently dedisperse fine spectra
+            dedisperse(label, dm, centre_freq, deripple.out)
 
-        // coherently dedisperse fine spectra
-        dedisperse(label, dm, centre_freq, deripple.out)
+            // inverse FFT back to complex time series data
+            ifft(label, dedisperse.out, dm, bform_start_MJD)
 
-        // inverse FFT back to complex time series data
-        ifft(label, dedisperse.out, dm)
-        xy = ifft.out.collect()
+            pre_dedisp = deripple.out
+        }
+        xy = ifft.out.data.collect()
+        htr_start_MJD = ifft.out.start_MJD.first()
 
         // if FRB, apply polcal solutions to x and y data products
         if ((label == "${params.label}") && !params.nopolcal) {
@@ -709,6 +1005,7 @@ workflow beamform {
         dynspec_fnames = generate_dynspecs.out.dynspec_fnames
         htr_data = generate_dynspecs.out.data
         xy
-        pre_dedisp = deripple.out
-        bform_start_MJD = do_beamform.out.bform_start_MJD.first()
+        pre_dedisp
+        bform_start_MJD
+        htr_start_MJD
 }
@@ -724,6 +724,12 @@ process apply_pol_cal_solns {
             args="\$args --fast"
         fi
 
+        # The X delay and phase were applied while beamforming, under the
+        # same conditions do_beamform folds them
+        if [ "$params.fold_post_beamform" = "true" ] && [[ $label == "${params.label}" ]] && [ -s $pol_cal_solns ] && [ "$params.nopolcal" != "true" ]; then
+            args="\$args --no_delay"
+        fi
+
         apptainer exec -B /fred/oz313/:/fred/oz313/ $params.container bash -c 'source /opt/setup_proc_container && python3 $beamform_dir/apply_polcal.py \$args'
 
         """
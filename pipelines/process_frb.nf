@@ -23,9 +23,12 @@ params.minDM = 0
 params.maxDM = 10
 params.DMstep = 0.01
 params.opt_DM_dt = 100
+params.opt_DM_search = "grid"     // or "coarse_to_fine": incoherent scan, then Brent refinement
+params.opt_DM_metric = "peak"     // or "snr", "structure"
 
 params.opt_gate = false
 params.skip_ics = false
+params.ics_all_ants = false  // make the ICS of all antennas in one job per polarisation
 
 params.pols = ['X', 'Y']
 polarisations = Channel
@@ -52,7 +55,8 @@ process load_coarse_dynspec {
             pol: val
                 One of "X" or "Y" for the current polarisation being beamformed
             ant_idx: val
-                Zero-based index of the antenna being beamformed
+                Zero-based index of the antenna being beamformed, or "all" to
+                incoherently sum all antennas
             fcm: path
                 fcm file to use
 
@@ -114,7 +118,9 @@ process load_coarse_dynspec {
 	args="\$args --ics"
 	args="\$args --cpus=8"
 	args="\$args --pol=$pol"
-	args="\$args --an=$ant_idx"
+	if [ "$ant_idx" != "all" ]; then
+		args="\$args --an=$ant_idx"
+	fi
 
 	echo "python3 $beamform_dir/craftcor_tab.py \$args"
 	# python3 $beamform_dir/craftcor_tab.py \$args
@@ -391,8 +397,12 @@ process find_DM_opt {
                 S/N maximising DM
             opt_DM_plot
                 max(I) vs DM plot
+            opt_DM_curve
+                Metric at every full resolution trial DM (and at every
+                coarse trial DM with coarse_to_fine)
     */
     publishDir "${params.publish_dir}/${params.label}/htr", mode: "copy"
+    cpus 8
 
     input:
         path crops
@@ -401,6 +411,7 @@ process find_DM_opt {
     output:
         env dmopt, emit: dm_opt
         path "*png"
+        path "opt_DM*curve.txt"
 
     script:
         """
@@ -422,6 +433,9 @@ process find_DM_opt {
         args="\$args --DM0 $dm"
         args="\$args --f0 $params.centre_freq_frb"
         args="\$args --dt $params.opt_DM_dt"
+        args="\$args --cpus 8"
+        args="\$args --search $params.opt_DM_search"
+        args="\$args --metric $params.opt_DM_metric"
 
         #dmopt=`python3 $beamform_dir/opt_DM.py \$args`
         apptainer exec -B /fred/oz313/:/fred/oz313/ $params.container bash -c 'source /opt/setup_proc_container && python3 $beamform_dir/opt_DM.py \$args'
@@ -431,6 +445,7 @@ process find_DM_opt {
         """
         dmopt=$dm
         touch stub.png
+        touch opt_DM_curve.txt
         """
 }
 
@@ -443,15 +458,26 @@ workflow optimise_DM {
         crops
         pol_cal_solns
         ds_args
+        bform_start_MJD
     
     main:
         find_DM_opt(crops, params.dm_frb)
         dm_opt = find_DM_opt.out.dm_opt
+
+        // with fold_post_beamform, pre_dedisp is already dedispersed to
+        // params.dm_frb. Dedispersion phases add, so only dedisperse by
+        // the difference
+        if (params.fold_post_beamform) {
+            dedisp_dm = dm_opt.map { (it as double) - (params.dm_frb as double) }
+        }
+        else {
+            dedisp_dm = dm_opt
+        }
         dedisperse(
-            params.label, dm_opt, params.centre_freq_frb, pre_dedisp
+            params.label, dedisp_dm, params.centre_freq_frb, pre_dedisp
         )
-        ifft(params.label, dedisperse.out, dm_opt)
-        xy = ifft.out.collect()
+        ifft(params.label, dedisperse.out, dm_opt, bform_start_MJD)
+        xy = ifft.out.data.collect()
         generate_dynspecs(
             params.label, xy, ds_args, params.centre_freq_frb, dm_opt, pol_cal_solns
         )
@@ -628,8 +654,9 @@ workflow process_frb {
 
     main:
         if (!params.skip_ics && params.nbits > 1) {
+            ics_antennas = params.ics_all_ants ? Channel.of("all") : antennas
             coarse_ds = load_coarse_dynspec(params.label, params.data_frb, polarisations, 
-                                            antennas,fcm)
+                                            ics_antennas,fcm)
             refined_candidate_path = "${params.publish_dir}/${params.label}/ics/${params.label}.cand"
             if ( new File(refined_candidate_path).exists()) {
                 refined_candidate = Channel.fromPath(refined_candidate_path)
@@ -807,7 +834,7 @@ workflow process_frb {
                 plot(
                     params.label, bform_frb.out.dynspec_fnames, bform_frb.out.htr_data,
                     params.centre_freq_frb, params.dm_frb,
-                    bform_frb.out.bform_start_MJD, refined_candidate
+                    bform_frb.out.htr_start_MJD, refined_candidate
                 )
 
                 // crops = plot.out.crops
@@ -819,7 +846,7 @@ workflow process_frb {
             // if(params.opt_DM) {
             //     optimise_DM(
             //         bform_frb.out.pre_dedisp, plot.out.crops, pol_cal_solns, 
-            //         "-ds -t -XYIQUV"
+            //         "-ds -t -XYIQUV", bform_frb.out.bform_start_MJD
             //     )
             //     dm = optimise_DM.out.dm_opt
             //     crops = optimise_DM.out.crops